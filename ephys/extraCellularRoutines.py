@@ -14,6 +14,7 @@ spike rate histograms and densities, and plotting a spike raster.
 import numpy as np
 import matplotlib.pyplot as plt
 import copy
+import traces as tm
 
 from itertools import repeat
 from scipy.stats import norm
@@ -54,35 +55,28 @@ def detectSpikes(orig_xsg, thresh, edge='falling', channel='chan0', filter_trace
     assert(edge in ['falling', 'rising'], "Edge must be 'falling' or 'rising'!")
     xsg = copy.deepcopy(orig_xsg)
 
-    # internal function to be used with a map
-    def detect(params): 
-        trace, thresh, filter_trace, sample_rate = params
-
-        if filter_trace:
-            #trace = filterthetrace(trace)
-            pass
-
-        # thresh is now a single value or an explicit wave the same size and shape as trace
-        # let's just make it explicit
-        if type(thresh) is not np.ndarray:
-            thresh = np.ones_like(trace) * thresh
-        
-        if edge == 'rising':
-            i, = np.where((trace[:-1] < thresh[:-1]) & (trace[1:] > thresh[1:]))
-        if edge == 'falling':
-            i, = np.where((trace[:-1] > thresh[:-1]) & (trace[1:] < thresh[1:]))
-        return i * 1000.0 / sample_rate
-                
-    if 'merged' in xsg.keys():
-        # important type expectation here --- could be list of floats or a list of expicit ndarrays
-        if type(thresh) is not list:  
-            thresh = repeat(thresh)
-        if type(filter_trace) is not list:
-            filter_trace = repeat(filter_trace)
+    # thresh is a single value, an explicit wave the same size and shape as a
+    # trial, or a list of these, one per trial.  Make it explicit per trial
+    def levels(thresh, nSamples):
+        if type(thresh) is list:
+            return np.column_stack([np.broadcast_to(np.asarray(t, dtype='float'), (nSamples,)) for t in thresh])
+        if np.ndim(thresh) == 1:
+            return np.asarray(thresh)[:, np.newaxis]
+        return thresh
+
+    if filter_trace:
+        #traces = filterthetraces(traces)
+        pass
 
-        xsg['spikeTimes'] = map(detect, zip(np.rollaxis(xsg['ephys'][channel], 1, 0), thresh, filter_trace, repeat(xsg['sampleRate'][0])))
+    # one scan over all trials, giving a table of crossings sorted by trial
+    if 'merged' in xsg.keys():
+        data = xsg['ephys'][channel] # samples x trials
+        times, trials = tm.findCrossings(data, levels(thresh, data.shape[0]), mode=edge, axis=0)
+        trialStarts = np.searchsorted(trials, np.arange(1, data.shape[1]))
+        xsg['spikeTimes'] = np.split(times * 1000.0 / xsg['sampleRate'][0], trialStarts)
     else:
-        xsg['spikeTimes'] = detect((xsg['ephys'][channel], thresh, filter_trace, xsg['sampleRate'])) # wrapping here to make it compatible with the zip for a single trial
+        times, = tm.findCrossings(xsg['ephys'][channel], thresh, mode=edge)
+        xsg['spikeTimes'] = times * 1000.0 / xsg['sampleRate']
 
     return xsg
 
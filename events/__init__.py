@@ -3,3 +3,4 @@ Basic routines for dealing with event arrays
 """
 
 from eventRoutines import *
+from eventTableRoutines import *
@@ -20,13 +20,15 @@ from sklearn.mixture import GMM
 import scipy.ndimage as nd
 import mahotas
 
+from eventTableRoutines import EventTable
+
 __all__ = ['findEvents', 'findEventsGMM', 'findEventsBackground',
            'getCounts', 'getStartsAndStops', 'getDurations', 'getAvgAmplitudes', 'getWeightedEvents',
            'fitGaussianMixture1D', 'getGMMBaselines']
 
 #----------------------------------------EVENT FINDING FUNCTIONS AND WRAPPERS-----------------------------------
 
-def findEvents(traces, stds, std_threshold=2.5, falling_std_threshold=None, baselines=None, boxWidth=3, minimum_length=2, alpha=None):
+def findEvents(traces, stds, std_threshold=2.5, falling_std_threshold=None, baselines=None, boxWidth=3, minimum_length=2, alpha=None, dtype=None):
     """Core event finding routine with flexible syntax.
 
     Uses the following inequality to determine if an event occured at a specific time in a cell:
@@ -56,15 +58,17 @@ def findEvents(traces, stds, std_threshold=2.5, falling_std_threshold=None, base
     :param: boxWidth - filter size for smoothing traces and background values before detection
     :param: minimum_length - minimum length of an event
     :param: alpha - optional scaling parameter for adjusting thresholds
+    :param: dtype - optional dtype to smooth and threshold in, defaults to that of traces if floating point, else float64
 
     :returns: numpy array same shape and size of traces, with each event given a unique integer label
     """
 
+    traces = np.asarray(traces, dtype=tm.float_dtype(traces, dtype))
     if traces.ndim == 2:
         traces = np.atleast_3d(traces) # time x cells x trials
         stds = np.atleast_2d(stds).T # cells x trials
     time, cells, trials = traces.shape
-    events = np.zeros_like(traces)
+    events = np.zeros(traces.shape, dtype=bool)
 
     # broadcasting of baselines.  ends up as time x cells x trials.  this is really annoying,
     # but relying on numpy to broadcast things was tricky and problembatic.  idea here is to
@@ -80,7 +84,7 @@ def findEvents(traces, stds, std_threshold=2.5, falling_std_threshold=None, base
                 full_baselines[:,cell,trial] = baselines
 
     elif baselines.shape ==(time, cells): # full, but only one trial
-        full_baselines = baselines[:,:,None] 
+        full_baselines = baselines[:,:,None].astype(traces.dtype)
     
     elif baselines.shape == (time, trials): # modeled on a trial by trial basis
             full_baselines = np.zeros_like(traces)
@@ -102,6 +106,9 @@ def findEvents(traces, stds, std_threshold=2.5, falling_std_threshold=None, base
     if boxWidth is not 0:
         traces_smoothed = nd.convolve1d(traces, np.array([1]*boxWidth)/float(boxWidth), axis=0)
         baselines_smoothed = nd.convolve1d(full_baselines, np.array([1]*boxWidth)/float(boxWidth), axis=0)
+    else:
+        traces_smoothed = traces
+        baselines_smoothed = full_baselines
 
     # detect events
     for trial in range(trials):
@@ -131,7 +138,7 @@ def findEvents(traces, stds, std_threshold=2.5, falling_std_threshold=None, base
     events = mahotas.label(events>0, np.array([1,1])[:,np.newaxis,np.newaxis])[0]
     return np.squeeze(events) 
 
-def findEventsGMM(traces, stds, std_threshold=2.5, falling_std_threshold=None, boxWidth=3, minimum_length=2):
+def findEventsGMM(traces, stds, std_threshold=2.5, falling_std_threshold=None, boxWidth=3, minimum_length=2, dtype=None):
     """Wrapper for findEvents with baseline estimation using a mixture of gaussians model.
 
     The major idea here is to use a mixture of two gaussians to model
@@ -155,6 +162,7 @@ def findEventsGMM(traces, stds, std_threshold=2.5, falling_std_threshold=None, b
     :param: baselines - optional estimation of the baseline values of the cells 
     :param: boxWidth - filter size for smoothing traces and background values before detection
     :param: minimum_length - minimum length of an event
+    :param: dtype - optional dtype to smooth and threshold in, as for findEvents
 
     :returns: numpy array same shape and size of traces, with each event given a unique integer label
     """
@@ -162,10 +170,10 @@ def findEventsGMM(traces, stds, std_threshold=2.5, falling_std_threshold=None, b
     if traces.ndim == 2:
         traces = np.atleast_3d(traces) # time x cells x trials
         stds = np.atleast_2d(stds).T # cells x trials
-    baselines = getGMMBaselines(traces) # time x trials (one population baseline trace for all cells)
-    return findEvents(traces, stds, std_threshold, falling_std_threshold, baselines, boxWidth, minimum_length)
+    baselines = getGMMBaselines(traces, dtype) # time x trials (one population baseline trace for all cells)
+    return findEvents(traces, stds, std_threshold, falling_std_threshold, baselines, boxWidth, minimum_length, dtype=dtype)
 
-def findEventsBackground(traces, stds, std_threshold=2.5, falling_std_threshold=None, boxWidth=3, minimum_length=2):
+def findEventsBackground(traces, stds, std_threshold=2.5, falling_std_threshold=None, boxWidth=3, minimum_length=2, dtype=None):
     """Wrapper for findEvents with baseline estimation using the background..
 
     Here, we estimate the population baseline for all the cells as the
@@ -180,6 +188,7 @@ def findEventsBackground(traces, stds, std_threshold=2.5, falling_std_threshold=
     :param: baselines - optional estimation of the baseline values of the cells 
     :param: boxWidth - filter size for smoothing traces and background values before detection
     :param: minimum_length - minimum length of an event
+    :param: dtype - optional dtype to smooth and threshold in, as for findEvents
 
     :returns: numpy array same shape and size of traces, with each event given a unique integer label
     """
@@ -187,136 +196,82 @@ def findEventsBackground(traces, stds, std_threshold=2.5, falling_std_threshold=
         traces = np.atleast_3d(traces) # time x cells x trials
         stds = np.atleast_2d(stds).T # cells x trials
     baselines = traces[:,0,:].copy() # time x trials (one population baseline trace for all cells)
-    return findEvents(traces, stds, std_threshold, falling_std_threshold, baselines, boxWidth, minimum_length)
+    return findEvents(traces, stds, std_threshold, falling_std_threshold, baselines, boxWidth, minimum_length, dtype=dtype)
 
 #----------------------------------------EVENT UTILITY FUNCTIONS-----------------------------------
+# these are views on an EventTable (see eventTableRoutines), which finds all
+# the events in one pass.  event_array can also be an EventTable, to summarise
+# the same events several ways without finding them again.
 
 def getStartsAndStops(event_array):
     """This routine takes an event_array and returns the starting and
     stopping times for all events in the array.
 
-    :param: event_array - 2d or 3d numpy event array (time x cells, or time x cells x trials))
+    :param: event_array - 2d or 3d numpy event array (time x cells, or time x cells x trials)), or an EventTable
     :returns: masked numpy arrays, one for starting times and stopping times.
               size is cells x max event number or cells x trials x max event number.
               masked array is to account for the variable number of events in each cell
     """
-
-    event_array = np.atleast_3d(event_array)
-    max_num_events = getCounts(event_array).max()
-    time, cells, trials = event_array.shape
-
-    starts = np.zeros((cells, trials, int(max_num_events)))
-    stops = np.zeros((cells, trials, int(max_num_events)))
-
-    starts[:] = np.nan
-    stops[:] = np.nan
-
-    for cell in range(cells):
-        for trial in range(trials):
-            event_ids = np.unique(event_array[:,cell,trial])[1:]
-            for i, event_id in enumerate(event_ids):
-                starts[cell, trial, i] = np.argwhere(event_array[:,cell,trial] == event_id).flatten()[0]
-                stops[cell, trial, i] = np.argwhere(event_array[:,cell,trial] == event_id).flatten()[-1]
-
-    starts = np.ma.array(starts, mask=np.isnan(starts))
-    starts = np.squeeze(starts)
-
-    stops = np.ma.array(stops, mask=np.isnan(stops))
-    stops = np.squeeze(stops)
-
-    return starts, stops
+    starts, stops = _eventTable(event_array).startsAndStops()
+    return np.squeeze(starts), np.squeeze(stops)
 
 def getCounts(event_array, time_range=None):
     """This routine takes an event_array and optionally a time range
     and returns the number of events in each cell.
 
-    :param: event_array - 2 or 3d numpy event array (time x cells or time x cells x trials)
+    :param: event_array - 2 or 3d numpy event array (time x cells or time x cells x trials), or an EventTable
     :param: time_range - optional list of 2 numbers limiting the time range to count events
     :returns: 1d or 2d numpy array of counts (cells or cells x trials)
     """
-    if time_range is not None:
-        event_array = event_array[time_range[0]:time_range[1],:] # note that this works for 2 or 3d arrays...
-
-    if event_array.ndim is 2:
-        event_array = event_array[:,:,np.newaxis]
-    time, cells, trials = event_array.shape
-    
-    counts = np.zeros((cells,trials))
-    for trial in range(trials):
-        for cell in range(cells):
-            counts[cell, trial] = np.unique(event_array[:,cell,trial]).size - 1
-    return np.squeeze(counts)
+    return np.squeeze(_eventTable(event_array, time_range=time_range).counts())
 
 def getDurations(event_array, time_range=None):
     """This routine takes an event_array (time x cells) and returns
     the duration of events in each cell.
 
-    :param: event_array - 2 or 3d numpy event array (time x cells, or time x cells x trials)
+    :param: event_array - 2 or 3d numpy event array (time x cells, or time x cells x trials), or an EventTable
     :param: time_range - optional list of 2 numbers limiting the time range to count events
     :returns: 2d masked numpy array of event durations. size is cells x largest number of events.
               masked entries are to account for variable number of events
     """
-    event_array = np.atleast_3d(event_array)
-    max_num_events = getCounts(event_array).max()
-    time, cells, trials = event_array.shape
-
-    durations = np.zeros((cells, trials, int(max_num_events)))
-    durations[:] = np.nan
+    return np.squeeze(_eventTable(event_array, time_range=time_range).durations())
 
-    for cell in range(cells):
-        for trial in range(trials):
-            event_ids = np.unique(event_array[:,cell,trial])[1:]
-            for i, event_id in enumerate(event_ids):
-                durations[cell, trial, i] = np.argwhere(event_array[:,cell,trial] == event_id).size
-    durations = np.ma.array(durations, mask=np.isnan(durations))
-    durations = np.squeeze(durations)
-    
-    return durations
-
-def getAvgAmplitudes(event_array, trace_array, time_range=None):
+def getAvgAmplitudes(event_array, trace_array, time_range=None, dtype=None):
     """This routine takes an event_array (time x cells) and
     corresponding trace array and returns the average amplitudes of
     events in each cell.
 
-    :param: event_array - 2 or 3d numpy event array (time x cells, or time x cells x trials)
+    :param: event_array - 2 or 3d numpy event array (time x cells, or time x cells x trials), or an
+            EventTable made with the traces (then trace_array can be None)
+    :param: trace_array - 2 or 3d numpy trace array, the same shape as event_array
     :param: time_range - optional list of 2 numbers limiting the time range to count events
+    :param: dtype - optional dtype of the amplitudes, defaults to that of trace_array if floating point, else float64
     :returns: 2d masked numpy array of event average amplitudes. size is cells x largest number of events.
               masked entries are account for variable number of events
     """
-    event_array = np.atleast_3d(event_array)
-    trace_array= np.atleast_3d(trace_array)
-
-    max_num_events = getCounts(event_array).max()
-    time, cells, trials = event_array.shape
-
-    amps = np.zeros((cells, trials, int(max_num_events)))
-    amps[:] = np.nan
-
-    for cell in range(cells):
-        for trial in range(trials):
-            event_ids = np.unique(event_array[:,cell,trial])[1:]
-            for i, event_id in enumerate(event_ids):
-                amps[cell, trial, i] = trace_array[event_array == event_id].mean()
-    amps = np.ma.array(amps, mask=np.isnan(amps))
-    amps = np.squeeze(amps)
+    return np.squeeze(_eventTable(event_array, trace_array, time_range, dtype).amplitudes())
 
-    return np.ma.masked_array(amps, np.isnan(amps))
-
-def getWeightedEvents(event_array, trace_array):
+def getWeightedEvents(event_array, trace_array, dtype=None):
     """This routine takes an event array and corresponding trace array
     and replaces the event labels with the average amplitude of the
     event.
 
-    :param: event_array - 2 or 3d numpy event array (time x cells, or time x cells x trials)
+    :param: event_array - 2 or 3d numpy event array (time x cells, or time x cells x trials), or an
+            EventTable made with the traces (then trace_array can be None)
     :param: trace_array - 2 or 3d numpy event array (time x cells, or time x cells x trials)
+    :param: dtype - optional dtype of the result, defaults to that of trace_array if floating point, else float64
     :returns: 2d numpy array same shape and size of event_array, zero where there
               weren't events, and the average event amplitude for the event otherwise.
     """
-    weighted_events = np.zeros_like(event_array, dtype=float)
-    
-    for i in np.unique(event_array)[1:]:
-        weighted_events[event_array==i] = trace_array[event_array==i].mean()
-    return weighted_events
+    return _eventTable(event_array, trace_array, dtype=dtype).weightedEvents()
+
+def _eventTable(event_array, trace_array=None, time_range=None, dtype=None):
+    """event_array as an EventTable, if it isn't one already"""
+    if isinstance(event_array, EventTable):
+        if time_range is not None:
+            raise ValueError('time_range can not be applied to an EventTable, make the table with it instead')
+        return event_array
+    return EventTable(event_array, trace_array, time_range, dtype)
 
 #----------------------------------------GMM UTILITY FUNCTIONS-----------------------------------
 
@@ -353,15 +308,16 @@ def fitGaussianMixture1D(data, n=2, set_mean_priors=True):
             g.aic(data), 
             g)
 
-def getGMMBaselines(traces):
+def getGMMBaselines(traces, dtype=None):
     """Wrapper for fitGaussianMixture1D() for findEventsGMM().
     
     :param: traces - 2 or 3d numpy array of dF/F (time x cells, or time x cells x trials)
+    :param: dtype - optional dtype of the baselines, defaults to that of traces if floating point, else float64
     :returns: 1 or 2d numpy array of estimated baseline (time or time x trials).
     """
     traces = np.atleast_3d(traces) # time x cells x trials
     time, cells, trials = traces.shape
-    gmmBaselines = np.zeros((time, trials)) # one baseline estimation for each trial
+    gmmBaselines = np.zeros((time, trials), dtype=tm.float_dtype(traces, dtype)) # one baseline estimation for each trial
 
     for trial in range(trials):
         for frame in range(time):
@@ -376,7 +332,7 @@ def findEventsAtThreshold(traces, stds, rising_threshold, falling_threshold=0.75
     """----------------DEPRECATED-----------------------------
 
     Routine to find events based on the method in Dombeck et al., 2007.  
-    Relies on the multi-dimensional findLevels function in traceRoutines.
+    Relies on the multi-dimensional findCrossings function in traceRoutines.
 
     Finds all two sets of points in `traces` that cross threshold multiples
     of `stds`.  The first_mode and second_mode parameters determine if the
@@ -387,7 +343,7 @@ def findEventsAtThreshold(traces, stds, rising_threshold, falling_threshold=0.75
     This routine is called by findEventsDombeck().
 
     :param: traces - 2 or 3d numpy array of dF/F traces (time x cells, or time x cells x trial)
-    :param: stds - 1 or 2d numpy array of values representing noise levels in the data (cells, or cells x trials)
+    :param: stds - number, or 1 or 2d numpy array of values representing noise levels in the data (cells, or cells x trials)
     :param: rising_threshold - float used for first crossings
     :param: falling_threshold - float used for second crossings
     :param: boxWidth - filter size
@@ -399,19 +355,26 @@ def findEventsAtThreshold(traces, stds, rising_threshold, falling_threshold=0.75
     # insure that we have at least one 'trial' dimension.
     if traces.ndim == 2:
         traces = np.atleast_3d(traces)
-        stds = np.atleast_2d(stds)
 
     time, cells, trials = traces.shape
-    # normally tm.findLevels works with a single number, but if the shapes are right then it will broadcast correctly with a larger array
-    first_crossings = tm.findLevelsNd(traces, np.array(stds)*rising_threshold, mode=first_mode, axis=0, boxWidth=boxWidth)
-    second_crossings = tm.findLevelsNd(traces, np.array(stds)*falling_threshold, mode=second_mode, axis=0, boxWidth=boxWidth)
-    
-    events = np.zeros_like(traces)
+    # a single noise level, one per cell, or one per cell and trial
+    stds = np.asarray(stds, dtype='float')
+    if stds.ndim == 1:
+        stds = stds[:, np.newaxis]
+    stds = np.broadcast_to(stds, (cells, trials))
+    # crossing tables, sorted by cell, then trial, then time
+    first_times, first_cells, first_trials = tm.findCrossings(traces, stds*rising_threshold, mode=first_mode, axis=0, boxWidth=boxWidth)
+    second_times, second_cells, second_trials = tm.findCrossings(traces, stds*falling_threshold, mode=second_mode, axis=0, boxWidth=boxWidth)
+    first_bounds = np.searchsorted(first_cells * trials + first_trials, np.arange(cells * trials + 1))
+    second_bounds = np.searchsorted(second_cells * trials + second_trials, np.arange(cells * trials + 1))
+
+    events = np.zeros(traces.shape, dtype=np.int32)
     i=1
     for cell in range(cells):
         for trial in range(trials):
-            rising_event_locations = np.where(first_crossings[:,cell,trial])[0] # peel off the tuple
-            falling_event_locations = np.where(second_crossings[:,cell,trial])[0] # peel off the tuple
+            trace = cell * trials + trial
+            rising_event_locations = first_times[first_bounds[trace]:first_bounds[trace+1]]
+            falling_event_locations = second_times[second_bounds[trace]:second_bounds[trace+1]]
         
             possible_pairs = []
             for r in rising_event_locations:
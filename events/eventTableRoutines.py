@@ -0,0 +1,212 @@
+"""
+Event tables: every event of a time x cells x trials event array as one row
+of a structured array, found in a single pass by run length encoding the
+labels along time.
+
+    >>> table = EventTable(event_array, trace_array)   # doctest: +SKIP
+    >>> table.events['duration'].mean()                # doctest: +SKIP
+    >>> starts, stops = table.startsAndStops()         # doctest: +SKIP
+
+An event is a label within one cell and trial.  The event finding routines
+label each run of frames separately, so this is the same as one event per
+label.  The getCounts/getStartsAndStops/... routines are built on this.
+"""
+import numpy as np
+
+import traces as tm
+
+__all__ = ['EventTable', 'getEventTable']
+
+class EventTable(object):
+    """The events of an event array, one row each, with their start, stop,
+    duration and (given the traces) amplitude, peak and area.
+
+    self.events is a structured array with the fields:
+        cell, trial - where the event is
+        start, stop - first and last frame of the event
+        duration - number of frames with the event's label
+        label - the event's label in event_array
+    and with a trace_array also:
+        amplitude - mean of the trace over the event
+        peak - max of the trace over the event
+        area - sum of the trace over the event (frames x trace units)
+
+    Rows are sorted by cell, trial and label (which is time order for
+    labels from the event finding routines).  Sums are accumulated in
+    float64, and amplitude, peak and area are in the dtype of trace_array
+    if it is floating point, else float64.
+
+    :param event_array: 1, 2 or 3d numpy event array (time, time x cells, or time x cells x trials)
+    :param trace_array: optional traces of the same shape, for amplitudes
+    :param time_range: optional list of 2 numbers limiting the time range to
+                       find events in.  Starts and stops are still frames of event_array.
+    :param dtype: optional dtype of the amplitudes, defaults to that of trace_array if floating point, else float64
+    """
+    def __init__(self, event_array, trace_array=None, time_range=None, dtype=None):
+        event_array = np.asarray(event_array)
+        offset = 0
+        if time_range is not None:
+            offset = slice(time_range[0], time_range[1]).indices(event_array.shape[0])[0]
+            event_array = event_array[time_range[0]:time_range[1]]
+        self.shape = event_array.shape
+        event_array = _asTimeCellsTrials(event_array)
+        self.time, self.cells, self.trials = event_array.shape
+        self.hasAmplitudes = trace_array is not None
+
+        # one row per trace (cell x trial), frames along it, flattened
+        labels = _traceMajor(event_array)
+        self._runStarts = _runStarts(labels, self.time)
+        self._runLengths = np.diff(np.append(self._runStarts, labels.size))
+        runLabels = labels[self._runStarts]
+
+        # event runs, grouped by trace and label.  Usually labels increase along
+        # each trace and each label is one run, so the runs are the events as they are
+        eventRuns = np.flatnonzero(runLabels != 0)
+        runTraces = self._runStarts[eventRuns] // max(self.time, 1)
+        runLabels = runLabels[eventRuns]
+        if not np.all((runTraces[1:] > runTraces[:-1]) | (runLabels[1:] > runLabels[:-1])):
+            order = np.lexsort((runLabels, runTraces))
+            eventRuns, runTraces, runLabels = eventRuns[order], runTraces[order], runLabels[order]
+        first = np.ones(eventRuns.size, dtype=bool)
+        first[1:] = (runTraces[1:] != runTraces[:-1]) | (runLabels[1:] != runLabels[:-1])
+        groups = np.flatnonzero(first)
+        merged = groups.size < eventRuns.size
+        def combine(ufunc, values):
+            return ufunc.reduceat(values, groups) if merged else values
+
+        # the event (row) each run belongs to, -1 for runs of zeros
+        self._runEvents = np.full(self._runStarts.size, -1, dtype=np.intp)
+        self._runEvents[eventRuns] = np.cumsum(first) - 1
+
+        fields = [('cell', np.intp), ('trial', np.intp), ('start', np.intp), ('stop', np.intp),
+                  ('duration', np.intp), ('label', event_array.dtype)]
+        if self.hasAmplitudes:
+            amplitudeDtype = tm.float_dtype(trace_array, dtype)
+            fields += [('amplitude', amplitudeDtype), ('peak', amplitudeDtype), ('area', amplitudeDtype)]
+        self.events = np.zeros(groups.size, dtype=fields)
+        if not groups.size:
+            return
+
+        traceIndex = runTraces[groups]
+        self.events['cell'] = traceIndex // self.trials
+        self.events['trial'] = traceIndex % self.trials
+        self.events['label'] = runLabels[groups]
+        runStarts = self._runStarts[eventRuns] - runTraces * self.time
+        self.events['start'] = runStarts[groups] + offset
+        self.events['stop'] = combine(np.maximum, runStarts + self._runLengths[eventRuns] - 1) + offset
+        self.events['duration'] = combine(np.add, self._runLengths[eventRuns])
+
+        if self.hasAmplitudes:
+            trace_array = _asTimeCellsTrials(trace_array)
+            if time_range is not None:
+                trace_array = trace_array[time_range[0]:time_range[1]]
+            if trace_array.shape != event_array.shape:
+                raise ValueError('trace_array must be the same shape as event_array')
+            values = _traceMajor(trace_array)
+            # sums and maxima of all runs, zeros included, as reduceat needs the boundaries
+            runSums = np.add.reduceat(values, self._runStarts, dtype=np.float64)[eventRuns]
+            runPeaks = np.maximum.reduceat(values, self._runStarts)[eventRuns]
+            area = combine(np.add, runSums)
+            self.events['area'] = area
+            self.events['amplitude'] = area / self.events['duration']
+            self.events['peak'] = combine(np.maximum, runPeaks)
+
+    def __len__(self):
+        return self.events.size
+
+    def __repr__(self):
+        return 'EventTable(%d events, %d cells x %d trials x %d frames)' % (len(self), self.cells,
+                                                                             self.trials, self.time)
+
+    def counts(self):
+        """Number of events in each cell and trial, cells x trials (float, as getCounts)"""
+        traceIndex = self.events['cell'] * self.trials + self.events['trial']
+        counts = np.bincount(traceIndex, minlength=self.cells * self.trials)
+        return counts.reshape(self.cells, self.trials).astype(np.float64)
+
+    def perEvent(self, values, dtype=np.float64):
+        """Arrange one value per event (row) as cells x trials x max event
+        number, masked where a cell has fewer events.
+
+        :param values: 1d array, one value per row of self.events (or a field name)
+        :param dtype: dtype of the result
+        :returns: masked numpy array, cells x trials x max event number
+        """
+        if isinstance(values, basestring):
+            values = self.events[values]
+        traceIndex = self.events['cell'] * self.trials + self.events['trial']
+        counts = np.bincount(traceIndex, minlength=self.cells * self.trials)
+        # rows are sorted by trace, so the event number is the row less the trace's first row
+        eventNumber = np.arange(len(self)) - np.searchsorted(traceIndex, traceIndex)
+
+        maxEvents = counts.max() if counts.size else 0
+        arranged = np.full((self.cells * self.trials, maxEvents), np.nan, dtype=dtype)
+        arranged[traceIndex, eventNumber] = values
+        arranged = arranged.reshape(self.cells, self.trials, maxEvents)
+        return np.ma.array(arranged, mask=np.isnan(arranged))
+
+    def startsAndStops(self):
+        """Masked cells x trials x max event number arrays of the first and last frames of the events"""
+        return self.perEvent('start'), self.perEvent('stop')
+
+    def durations(self):
+        """Masked cells x trials x max event number array of the number of frames in each event"""
+        return self.perEvent('duration')
+
+    def amplitudes(self):
+        """Masked cells x trials x max event number array of the mean trace over each event"""
+        self._needAmplitudes()
+        return self.perEvent('amplitude', self.events.dtype['amplitude'])
+
+    def weightedEvents(self, field='amplitude'):
+        """An array the shape of the event array, with each event's frames
+        set to its amplitude (or another field), and zero elsewhere.
+        """
+        if field in ('amplitude', 'peak', 'area'):
+            self._needAmplitudes()
+        values = self.events[field]
+        # value of each run of frames, 0 for runs that aren't events
+        runValues = np.zeros(self._runStarts.size, dtype=tm.float_dtype(values))
+        isEvent = self._runEvents >= 0
+        runValues[isEvent] = values[self._runEvents[isEvent]]
+        weighted = np.repeat(runValues, self._runLengths).reshape(self.cells, self.trials, self.time)
+        return np.ascontiguousarray(np.rollaxis(weighted, 2, 0)).reshape(self.shape)
+
+    def _needAmplitudes(self):
+        if not self.hasAmplitudes:
+            raise ValueError('EventTable was made without a trace_array, so has no amplitudes')
+
+def getEventTable(event_array, trace_array=None, time_range=None, dtype=None):
+    """The events of an event array as a structured array, one row per event.
+
+    :param: event_array - 2 or 3d numpy event array (time x cells, or time x cells x trials)
+    :param: trace_array - optional traces of the same shape, for the amplitude, peak and area of each event
+    :param: time_range - optional list of 2 numbers limiting the time range to find events in
+    :param: dtype - optional dtype of the amplitudes, defaults to that of trace_array if floating point, else float64
+    :returns: structured numpy array with the fields cell, trial, start, stop,
+              duration and label (and amplitude, peak and area), see EventTable
+    """
+    return EventTable(event_array, trace_array, time_range, dtype).events
+
+def _asTimeCellsTrials(A):
+    """A 1, 2 or 3d array (or memmap) as time x cells x trials"""
+    A = np.asarray(A)
+    if A.ndim == 1:
+        return A[:, np.newaxis, np.newaxis]
+    if A.ndim == 2:
+        return A[:, :, np.newaxis]
+    return A
+
+def _traceMajor(A):
+    """time x cells x trials -> flat array of the traces one after another"""
+    return np.ascontiguousarray(A.reshape(A.shape[0], -1).T).ravel()
+
+def _runStarts(labels, time):
+    """Indices in the trace major labels where a run of one label starts,
+    including at the start of each trace"""
+    if not labels.size:
+        return np.zeros(0, dtype=np.intp)
+    boundaries = np.empty(labels.size, dtype=bool)
+    np.not_equal(labels[1:], labels[:-1], out=boundaries[1:])
+    boundaries[::time] = True
+    return np.flatnonzero(boundaries)
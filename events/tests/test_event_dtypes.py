@@ -0,0 +1,45 @@
+"""float32 traces give the same events as float64, without upcasting."""
+import numpy as np
+import pytest
+
+pytest.importorskip('mahotas')
+pytest.importorskip('sklearn')
+
+import events as em
+from events import eventRoutines
+
+def make_traces(dtype, seed=0):
+    random = np.random.RandomState(seed)
+    traces = random.randn(500, 6, 2) * 0.1
+    for start in (50, 200, 400):
+        traces[start:start + 20, ::2] += 1.
+    return traces.astype(dtype)
+
+@pytest.mark.parametrize('falling', [None, 1.])
+def test_events_match_float64(falling):
+    stds = np.full((6, 2), 0.1)
+    events32 = em.findEvents(make_traces(np.float32), stds, falling_std_threshold=falling)
+    events64 = em.findEvents(make_traces(np.float64), stds, falling_std_threshold=falling)
+    np.testing.assert_array_equal(events32 > 0, events64 > 0)
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_amplitudes_keep_dtype(dtype):
+    traces = make_traces(dtype)
+    events = em.findEvents(traces, np.full((6, 2), 0.1))
+    assert em.getWeightedEvents(events, traces).dtype == dtype
+    assert em.getAvgAmplitudes(events, traces).dtype == dtype
+    assert em.getWeightedEvents(events, traces, dtype=np.float64).dtype == np.float64
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_gmm_baselines_dtype(dtype, monkeypatch):
+    # only the dtype handling, with the fit replaced by the min of each frame
+    def fit(data, n=2):
+        return np.array([data.min(), data.max()]), None, None, None, None, None
+    monkeypatch.setattr(eventRoutines, 'fitGaussianMixture1D', fit)
+    traces = make_traces(dtype)[:20]
+    baselines = em.getGMMBaselines(traces)
+    assert baselines.dtype == dtype
+    np.testing.assert_array_equal(baselines, traces.min(axis=1))
+    assert em.getGMMBaselines(traces, dtype=np.float64).dtype == np.float64
+    assert em.getGMMBaselines(traces[:, :, 0], dtype=np.float64).shape == (20, 1)
+    assert em.getGMMBaselines(np.round(traces * 100).astype(int)).dtype == np.float64
@@ -0,0 +1,53 @@
+"""The event table gives the same summaries as scanning each label."""
+import numpy as np
+import pytest
+
+pytest.importorskip('mahotas')
+pytest.importorskip('sklearn')
+
+import events as em
+
+def make_events(seed=0):
+    random = np.random.RandomState(seed)
+    traces = random.randn(400, 5, 3)
+    events = np.zeros(traces.shape, dtype=np.int32)
+    label = 0
+    for cell in range(5):
+        for trial in range(3):
+            above = np.r_[False, traces[:, cell, trial] > 1., False]
+            for start, stop in np.flatnonzero(np.diff(above)).reshape(-1, 2):
+                label += 1
+                events[start:stop, cell, trial] = label
+    return events, traces
+
+def test_table_matches_label_scan():
+    events, traces = make_events()
+    table = em.getEventTable(events, traces)
+    assert len(table) == events.max()
+    for row in table:
+        frames = np.flatnonzero(events[:, row['cell'], row['trial']] == row['label'])
+        assert (row['start'], row['stop'], row['duration']) == (frames[0], frames[-1], frames.size)
+        values = traces[frames, row['cell'], row['trial']]
+        np.testing.assert_allclose([row['amplitude'], row['peak'], row['area']],
+                                   [values.mean(), values.max(), values.sum()])
+
+def test_getters_are_views_on_the_table():
+    events, traces = make_events()
+    table = em.EventTable(events, traces)
+    np.testing.assert_array_equal(em.getCounts(table), [[len(np.unique(e)) - 1 for e in cell.T] for cell in events.transpose(1, 0, 2)])
+    starts, stops = em.getStartsAndStops(events)
+    np.testing.assert_array_equal(starts.compressed(), table.events['start'])
+    np.testing.assert_array_equal(stops.compressed(), table.events['stop'])
+    np.testing.assert_array_equal(em.getDurations(table).compressed(), table.events['duration'])
+    np.testing.assert_allclose(em.getAvgAmplitudes(events, traces).compressed(), table.events['amplitude'])
+    weighted = em.getWeightedEvents(events, traces)
+    assert weighted.shape == events.shape
+    np.testing.assert_array_equal(weighted == 0, events == 0)
+
+def test_split_label_and_time_range():
+    events = np.array([0, 3, 3, 0, 3, 5, 5, 0])
+    table = em.getEventTable(events, np.arange(8.), time_range=(1, None))
+    np.testing.assert_array_equal(table['start'], [1, 5])
+    np.testing.assert_array_equal(table['stop'], [4, 6])
+    np.testing.assert_array_equal(table['duration'], [3, 2])
+    np.testing.assert_allclose(table['amplitude'], [7 / 3., 5.5])
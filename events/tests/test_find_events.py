@@ -0,0 +1,29 @@
+"""findEventsAtThreshold takes one noise level, one per cell or one per
+cell and trial, and they all give the same events."""
+import numpy as np
+import pytest
+
+pytest.importorskip('mahotas')
+pytest.importorskip('sklearn')
+
+from events import eventRoutines as er
+
+def make_traces(seed=0):
+    random = np.random.RandomState(seed)
+    traces = random.randn(300, 4, 2) * 0.1
+    for start in (40, 150):
+        traces[start:start + 15, 1:3] += 1.
+    return traces
+
+def test_stds_broadcast():
+    traces = make_traces()
+    expected = er.findEventsAtThreshold(traces, np.full((4, 2), 0.1), 3.)
+    assert expected.max() > 0
+    for stds in (0.1, np.full(4, 0.1), np.full((4, 2), 0.1)):
+        np.testing.assert_array_equal(er.findEventsAtThreshold(traces, stds, 3.), expected)
+
+def test_stds_2d_traces():
+    traces = make_traces()[:, :, 0]
+    expected = er.findEventsAtThreshold(traces, np.full(4, 0.1), 3.)
+    assert expected.max() > 0
+    np.testing.assert_array_equal(er.findEventsAtThreshold(traces, 0.1, 3.), expected)
@@ -1,7 +1,9 @@
 try: 
     from AG_fft_tools import correlate2d,fast_ffts
+    from AG_fft_tools.downsample import downsample
 except ImportError:
     from image_registration.fft_tools import correlate2d,fast_ffts
+    from image_registration.fft_tools.downsample import downsample
 import warnings
 import numpy as np
 
@@ -9,7 +11,7 @@ __all__ = ['cross_correlation_shifts','cross_correlation_shifts_FITS']
 
 def cross_correlation_shifts(image1, image2, errim1=None, errim2=None,
         maxoff=None, verbose=False, gaussfit=False, return_error=False,
-        zeromean=True, **kwargs):
+        zeromean=True, pyramid_levels=0, **kwargs):
     """ Use cross-correlation and a 2nd order taylor expansion to measure the
     offset between two images
 
@@ -47,9 +49,19 @@ def cross_correlation_shifts(image1, image2, errim1=None, errim2=None,
         The transition zone occurs at a *total* S/N ~ 1000 (i.e., the total
         signal in the map divided by the standard deviation of the map - 
         it depends on how many pixels have signal)
+    pyramid_levels: int
+        If > 0, use a coarse-to-fine search instead of the full-resolution
+        cross-correlation: the peak is found on images block-averaged by
+        2**pyramid_levels, then refined at each finer level by a local
+        spatial-domain correlation around the previous estimate (see
+        coarse_to_fine_peak).  Much faster for large images with small
+        offsets, especially when maxoff is small compared to the image.
+        Cannot be combined with gaussfit, return_error or correlate2d
+        keywords (other than quiet).
 
     **kwargs are passed to correlate2d, which in turn passes them to convolve.
     The available options include image padding for speed and ignoring NaNs.
+    They are not available with pyramid_levels, which does not use correlate2d.
 
     References
     ----------
@@ -81,6 +93,21 @@ def cross_correlation_shifts(image1, image2, errim1=None, errim2=None,
     image2 = np.nan_to_num(image2)
 
     quiet = kwargs.pop('quiet') if 'quiet' in kwargs else not verbose
+
+    if pyramid_levels:
+        if gaussfit or return_error:
+            raise ValueError("gaussfit and return_error are not available with pyramid_levels")
+        if kwargs:
+            raise ValueError("correlate2d keywords (%s) are not available with pyramid_levels"
+                    % ", ".join(sorted(kwargs)))
+        yshift_int,xshift_int,local_values = coarse_to_fine_peak(image1, image2,
+                levels=pyramid_levels, maxoff=maxoff)
+        if np.all(local_values == 0):
+            warnings.warn("WARNING: No signal found!  Offset is defaulting to 0,0")
+            return 0,0
+        shiftsubx,shiftsuby = taylor_subpixel_offset(local_values)[:2]
+        return -(xshift_int+shiftsubx), -(yshift_int+shiftsuby)
+
     ccorr = (correlate2d(image1,image2,quiet=quiet,**kwargs) / image1.size)
     # allow for NaNs set by convolve (i.e., ignored pixels)
     ccorr[ccorr!=ccorr] = 0
@@ -141,13 +168,7 @@ def cross_correlation_shifts(image1, image2, errim1=None, errim2=None,
 
         local_values = ccorr[ymax-1:ymax+2,xmax-1:xmax+2]
 
-        d1y,d1x = np.gradient(local_values)
-        d2y,d2x,dxy = second_derivative(local_values)
-
-        fx,fy,fxx,fyy,fxy = d1x[1,1],d1y[1,1],d2x[1,1],d2y[1,1],dxy[1,1]
-
-        shiftsubx=(fyy*fx-fy*fxy)/(fxy**2-fxx*fyy)
-        shiftsuby=(fxx*fy-fx*fxy)/(fxy**2-fxx*fyy)
+        shiftsubx,shiftsuby,fxx,fyy = taylor_subpixel_offset(local_values)
 
         xshift = -(xshift_int+shiftsubx)
         yshift = -(yshift_int+shiftsuby)
@@ -173,6 +194,149 @@ def cross_correlation_shifts(image1, image2, errim1=None, errim2=None,
     else:
         return xshift,yshift
 
+def taylor_subpixel_offset(local_values):
+    """
+    Sub-pixel location of a peak from a 2nd order taylor expansion
+
+    Parameters
+    ----------
+    local_values: np.ndarray
+        3x3 array of cross-correlation values centered on the integer peak
+
+    Returns
+    -------
+    shiftsubx,shiftsuby,fxx,fyy
+        The sub-pixel offsets of the peak from the central pixel and the
+        second derivatives at the central pixel (used for error estimates)
+    """
+    d1y,d1x = np.gradient(local_values)
+    d2y,d2x,dxy = second_derivative(local_values)
+
+    fx,fy,fxx,fyy,fxy = d1x[1,1],d1y[1,1],d2x[1,1],d2y[1,1],dxy[1,1]
+
+    shiftsubx=(fyy*fx-fy*fxy)/(fxy**2-fxx*fyy)
+    shiftsuby=(fxx*fy-fx*fxy)/(fxy**2-fxx*fyy)
+
+    return shiftsubx,shiftsuby,fxx,fyy
+
+def wrapped_correlation(image1, image2, yshift, xshift):
+    """
+    A single value of the periodic cross-correlation, computed in the spatial
+    domain without rolling (copying) either image:
+
+    sum(image1 * np.roll(np.roll(image2, yshift, 0), xshift, 1))
+
+    This is the value correlate2d(image1,image2) has at (ycen+yshift,
+    xcen+xshift), where ycen,xcen is the center pixel used by
+    cross_correlation_shifts.
+    """
+    ny,nx = image1.shape
+    sy,sx = yshift % ny, xshift % nx
+    rows = ((slice(sy,None),slice(0,ny-sy)), (slice(0,sy),slice(ny-sy,None)))
+    cols = ((slice(sx,None),slice(0,nx-sx)), (slice(0,sx),slice(nx-sx,None)))
+    total = 0.
+    for rows1,rows2 in rows:
+        for cols1,cols2 in cols:
+            total += (image1[rows1,cols1]*image2[rows2,cols2]).sum()
+    return total
+
+def coarse_to_fine_peak(image1, image2, levels=2, maxoff=None):
+    """
+    Find the integer peak of the cross-correlation of two images without
+    computing the full-resolution cross-correlation.
+
+    The images are block-averaged by 2 ``levels`` times.  The full
+    cross-correlation is only computed for the smallest pair; at each finer
+    level the previous estimate is doubled and refined by hill-climbing on
+    spatial-domain correlation values (wrapped_correlation) of its 3x3
+    neighbourhood, which is typically a dozen or so dot products.
+
+    Parameters
+    ----------
+    image1: np.ndarray
+        The reference image (zero-mean, no NaNs)
+    image2: np.ndarray
+        The offset image (zero-mean, no NaNs)
+    levels: int
+        Number of factor-of-2 downsamplings
+    maxoff: int
+        Maximum allowed offset (in full resolution pixels)
+
+    Returns
+    -------
+    yshift,xshift,local_values
+        The integer location of the peak relative to the center pixel of the
+        cross-correlation (as in cross_correlation_shifts, NOT the image
+        offset, which has the opposite sign) and the 3x3 cross-correlation
+        values around it, normalized by the image size like
+        cross_correlation_shifts does.
+    """
+    pyramid = [(image1,image2)]
+    for level in range(levels):
+        im1,im2 = pyramid[-1]
+        if min(im1.shape) < 6:
+            break
+        pyramid.append((downsample(im1,2),downsample(im2,2)))
+    levels = len(pyramid)-1
+
+    # full cross-correlation at the coarsest level
+    im1,im2 = pyramid[-1]
+    ccorr = correlate2d(im1,im2,quiet=True)
+    ylen,xlen = im1.shape
+    xcen = xlen/2-(1-xlen%2) 
+    ycen = ylen/2-(1-ylen%2) 
+    if maxoff is not None:
+        coarse_maxoff = int(np.ceil(maxoff/2.**levels))
+        subccorr = ccorr[max(ycen-coarse_maxoff,0):ycen+coarse_maxoff+1,
+                         max(xcen-coarse_maxoff,0):xcen+coarse_maxoff+1]
+        ymax,xmax = np.unravel_index(subccorr.argmax(), subccorr.shape)
+        yshift = ymax + max(ycen-coarse_maxoff,0) - ycen
+        xshift = xmax + max(xcen-coarse_maxoff,0) - xcen
+    else:
+        ymax,xmax = np.unravel_index(ccorr.argmax(), ccorr.shape)
+        yshift,xshift = ymax-ycen,xmax-xcen
+
+    # refine at each finer level; the last one is the full resolution
+    for level in range(levels-1,-1,-1):
+        if maxoff is not None:
+            level_maxoff = maxoff / 2.**level
+        else:
+            level_maxoff = np.inf
+        yshift,xshift,local_values = _climb_correlation(pyramid[level][0],
+                pyramid[level][1], 2*yshift, 2*xshift, level_maxoff)
+
+    if levels == 0:
+        # images too small to downsample: the coarse peak is final
+        yshift,xshift,local_values = _climb_correlation(image1, image2,
+                yshift, xshift, np.inf if maxoff is None else maxoff)
+
+    return yshift,xshift,local_values/image1.size
+
+def _climb_correlation(image1, image2, yshift, xshift, maxoff):
+    """
+    Hill-climb the cross-correlation from (yshift,xshift) until the center of
+    the 3x3 neighbourhood is its maximum (neighbours beyond maxoff are never
+    stepped onto).  Returns the peak and its 3x3 (un-normalized) values.
+    """
+    values = {}
+    def correlation(dy,dx):
+        if (dy,dx) not in values:
+            values[dy,dx] = wrapped_correlation(image1,image2,dy,dx)
+        return values[dy,dx]
+
+    while True:
+        local_values = np.array([[correlation(yshift+dy,xshift+dx)
+                                  for dx in (-1,0,1)] for dy in (-1,0,1)])
+        allowed = local_values.copy()
+        for dy in (-1,0,1):
+            for dx in (-1,0,1):
+                if max(abs(yshift+dy),abs(xshift+dx)) > maxoff:
+                    allowed[dy+1,dx+1] = -np.inf
+        dy,dx = np.unravel_index(allowed.argmax(), allowed.shape)
+        if allowed[dy,dx] <= local_values[1,1]:
+            return yshift,xshift,local_values
+        yshift,xshift = yshift+dy-1,xshift+dx-1
+
 def second_derivative(image):
     """
     Compute the second derivative of an image
@@ -1,5 +1,5 @@
 import shift
-from shift import shiftnd,shift2d
+from shift import shiftnd,shift2d,shift_stack
 from correlate2d import correlate2d
 from fast_ffts import get_ffts
 from upsample import dftups,upsample_image
@@ -114,6 +114,87 @@ def shiftnd(data, offset, phase=0, nthreads=1, use_numpy_fft=False,
     else:
         return result
 
+def shift_stack(stack, deltax, deltay, out=None, block_size=64):
+    """
+    FFT-based sub-pixel shift of every frame in an x,y,frame stack.
+    Will turn NaNs into zeros
+
+    Equivalent to calling shift2d on each frame (up to the Nyquist terms of
+    even-sized axes, which are kept real), but the frequency vectors are
+    computed once and the phase ramps are built as outer products of 1D
+    exponentials instead of full meshgrids.  Frames are transformed in blocks
+    with real FFTs along the first two axes, so only ``block_size`` frames of
+    complex temporaries are held at a time.
+
+    To apply the shifts measured by register_series, use
+    ``shift_stack(series, -x_shifts, -y_shifts)``.
+
+    Parameters
+    ----------
+    stack : np.ndarray
+        3D stack, x by y by frames (may be a memmap)
+    deltax : float or np.ndarray
+        Shift along the second axis, either one value or one per frame
+    deltay : float or np.ndarray
+        Shift along the first axis, either one value or one per frame
+
+    Other Parameters
+    ----------------
+    out : np.ndarray
+        Array to write the shifted stack into, e.g. a np.memmap.  Pass
+        ``out=stack`` to shift in place.  If None, a new array is allocated.
+    block_size : int
+        Number of frames transformed at once
+
+    Returns
+    -------
+    The shifted stack (``out`` if it was given)
+    """
+
+    if stack.ndim != 3:
+        raise ValueError("stack must be 3d (x by y by frames).")
+    nx,ny,nframes = stack.shape
+
+    deltax = np.ones(nframes) * deltax
+    deltay = np.ones(nframes) * deltay
+    if deltax.shape != (nframes,) or deltay.shape != (nframes,):
+        raise ValueError("Need one shift per frame.")
+
+    if out is None:
+        if stack.dtype.kind == 'f':
+            out = np.empty(stack.shape, dtype=stack.dtype)
+        else:
+            out = np.empty(stack.shape, dtype='float')
+    elif out.shape != stack.shape:
+        raise ValueError("out must have the same shape as stack.")
+
+    # the last transformed axis is the half-length rfft axis
+    yfreq = np.fft.fftfreq(nx)[:,np.newaxis]
+    xfreq = np.fft.rfftfreq(ny)[:,np.newaxis]
+
+    for start in range(0, nframes, block_size):
+        frames = slice(start, min(start+block_size, nframes))
+
+        block = np.asarray(stack[:,:,frames], dtype='float')
+        if np.any(np.isnan(block)):
+            block = np.nan_to_num(block)
+
+        yramp = np.exp(-1j*2*np.pi*yfreq*deltay[frames])
+        xramp = np.exp(-1j*2*np.pi*xfreq*deltax[frames])
+        # keep the Nyquist terms real so the shifted frames stay real
+        if nx % 2 == 0:
+            yramp[nx//2] = yramp[nx//2].real
+        if ny % 2 == 0:
+            xramp[-1] = xramp[-1].real
+
+        blockfft = np.fft.rfftn(block, axes=(0,1))
+        blockfft *= yramp[:,np.newaxis,:]
+        blockfft *= xramp[np.newaxis,:,:]
+
+        out[:,:,frames] = np.fft.irfftn(blockfft, s=(nx,ny), axes=(0,1))
+
+    return out
+
 if __name__ == "__main__":
     # A visual breakdown of the Fourier shift theorem
     # Lecture: http://www.cs.unm.edu/~williams/cs530/theorems6.pdf
@@ -45,3 +45,46 @@ def test_shifts_2d(imsize,dx,dy):
     rr2 = ((inds[0] - (imsize-1)/2. - dy)**2  + (inds[1] - (imsize-1)/2. - dx)**2)**0.5
 
     assert np.all(np.abs(sg-gaussian(rr2) < 0.05))
+
+@pytest.mark.parametrize(('imsize','block_size'),
+    list(itertools.product(range(9,27,2),(1,3,64))))
+def test_shift_stack_odd(imsize,block_size):
+
+    nframes = 7
+    stack = np.random.randn(imsize, imsize+2, nframes)
+    dx = np.linspace(-2.5,2.5,nframes)
+    dy = np.linspace(1.5,-1.5,nframes)
+
+    ss = shift.shift_stack(stack, dx, dy, block_size=block_size)
+
+    for ii in range(nframes):
+        assert np.allclose(ss[:,:,ii], shift.shift2d(stack[:,:,ii], dx[ii], dy[ii]))
+
+@pytest.mark.parametrize(('imsize','block_size'),
+    list(itertools.product(range(10,28,2),(1,3,64))))
+def test_shift_stack_even(imsize,block_size):
+
+    nframes = 7
+    inds = np.indices([imsize,imsize+1])
+    rr = ((inds[0] - (imsize-1)/2.)**2  + (inds[1] - imsize/2.)**2)**0.5
+    stack = gaussian(rr/2.)[:,:,np.newaxis] * np.arange(1,nframes+1)
+    dx = np.linspace(-2.5,2.5,nframes)
+    dy = np.linspace(1.5,-1.5,nframes)
+
+    ss = shift.shift_stack(stack, dx, dy, block_size=block_size)
+
+    for ii in range(nframes):
+        assert np.allclose(ss[:,:,ii], shift.shift2d(stack[:,:,ii], dx[ii], dy[ii]))
+
+def test_shift_stack_inplace_memmap(tmpdir):
+
+    stack = np.random.randn(15, 12, 10)
+    expected = shift.shift_stack(stack, 1.25, -0.5)
+
+    out = np.memmap(str(tmpdir.join('shifted.dat')), dtype='float',
+            mode='w+', shape=stack.shape)
+    shift.shift_stack(stack, 1.25, -0.5, out=out, block_size=3)
+    assert np.allclose(out, expected)
+
+    shift.shift_stack(stack, 1.25, -0.5, out=stack, block_size=4)
+    assert np.allclose(stack, expected)
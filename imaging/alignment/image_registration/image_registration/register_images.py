@@ -1,9 +1,11 @@
 try: 
     from AG_fft_tools import correlate2d,fast_ffts
     from AG_fft_tools import dftups,upsample_image,shift
+    from cross_correlation_shifts import coarse_to_fine_peak
 except ImportError:
     from image_registration.fft_tools import correlate2d,fast_ffts
     from image_registration.fft_tools import dftups,upsample_image,shift
+    from image_registration.cross_correlation_shifts import coarse_to_fine_peak
 import warnings
 import numpy as np
 
@@ -11,11 +13,12 @@ import multiprocessing as mp
 
 
 
-__all__ = ['register_images', 'register_series', 'register_series_parallel', 'dftregistration']
+__all__ = ['register_images', 'register_series', 'register_series_parallel',
+           'dftregistration', 'fft_series']
 
 def register_images(im1, im2, usfac=1, return_registered=False,
         return_error=False, zeromean=True, DEBUG=False, maxoff=None,
-        nthreads=1, use_numpy_fft=False):
+        nthreads=1, use_numpy_fft=False, pyramid_levels=0, copy=True):
     """
     Sub-pixel image registration (see dftregistration for lots of details)
 
@@ -38,6 +41,16 @@ def register_images(im1, im2, usfac=1, return_registered=False,
     maxoff : int
         Maximum allowed offset to measure (setting this helps avoid spurious
         peaks)
+    pyramid_levels : int
+        If > 0, find the integer-pixel peak with a coarse-to-fine search (see
+        cross_correlation_shifts.coarse_to_fine_peak) instead of the 2x
+        upsampled FFT cross-correlation; only the local DFT upsampling around
+        that peak is then done at full resolution.
+    copy : bool
+        If True (default) im1 and im2 are never modified; a float copy is
+        only made when there are NaNs to zero or a mean to subtract.  If
+        False, NaNs are zeroed and the mean subtracted in place (the images
+        must be floating point).
     DEBUG : bool
         Test code used during development.  Should DEFINITELY be removed.
 
@@ -53,25 +66,25 @@ def register_images(im1, im2, usfac=1, return_registered=False,
     if not im1.shape == im2.shape:
         raise ValueError("Images must have same shape.")
 
-    if zeromean:
-        im1 = im1 - (im1[im1==im1].mean())
-        im2 = im2 - (im2[im2==im2].mean())
-
-    if np.any(np.isnan(im1)):
-        im1 = im1.copy()
-        im1[im1!=im1] = 0
-    if np.any(np.isnan(im2)):
-        im2 = im2.copy()
-        im2[im2!=im2] = 0
+    im1 = _prepare_image(im1, zeromean=zeromean, copy=copy)
+    im2 = _prepare_image(im2, zeromean=zeromean, copy=copy)
 
     fft2,ifft2 = fftn,ifftn = fast_ffts.get_ffts(nthreads=nthreads, use_numpy_fft=use_numpy_fft)
 
+    if pyramid_levels:
+        row_shift,col_shift = coarse_to_fine_peak(im1, im2,
+                levels=pyramid_levels, maxoff=maxoff)[:2]
+        initial_shift = (row_shift,col_shift)
+    else:
+        initial_shift = None
+
     im1fft = fft2(im1)
     im2fft = fft2(im2)
 
     output = dftregistration(im1fft,im2fft,usfac=usfac,
             return_registered=return_registered, return_error=return_error,
-            zeromean=zeromean, DEBUG=DEBUG, maxoff=maxoff)
+            zeromean=zeromean, DEBUG=DEBUG, maxoff=maxoff,
+            initial_shift=initial_shift)
 
     output = [-output[1], -output[0], ] + [o for o in output[2:]]
 
@@ -81,10 +94,106 @@ def register_images(im1, im2, usfac=1, return_registered=False,
     return output
     
 ################################################################################################
-def dftregistration(buf1ft,buf2ft,buf3ft, usfac=1, return_registered=False,
-        return_error=False, zeromean=False, DEBUG=False, maxoff=None,
+def _nanfill(block, zeromean=False):
+    """
+    Zero the NaNs of a float image or x,y,frame block in place and, if
+    zeromean, subtract the NaN-aware mean of each frame first.  Only one
+    block-sized boolean mask is allocated.  Returns the subtracted means.
+    """
+    nans = np.isnan(block)
+    has_nans = nans.any()
+    if has_nans:
+        block[nans] = 0
+    if not zeromean:
+        return np.zeros(block.shape[2:])
+
+    npix = block.shape[0]*block.shape[1]
+    if has_nans:
+        counts = npix - nans.sum(axis=0).sum(axis=0)
+    else:
+        counts = npix
+    means = block.sum(axis=0).sum(axis=0) / np.maximum(counts, 1)
+    block -= means
+    if has_nans:
+        block[nans] = 0
+    return means
+
+def _prepare_image(image, zeromean=False, copy=True):
+    """
+    NaN-zeroed (and optionally zero-mean) version of a single image,
+    following the copy contract of register_images
+    """
+    if copy:
+        if not zeromean and not np.any(np.isnan(image)):
+            return image
+        image = np.array(image, dtype='float')
+    elif image.dtype.kind != 'f':
+        if zeromean:
+            raise ValueError("copy=False requires floating point images.")
+        # integers can't hold NaNs or a subtracted mean
+        return image
+    _nanfill(image, zeromean=zeromean)
+    return image
+
+def fft_series(series, zeromean=False, copy=True, block_size=64, out=None,
         nthreads=1, use_numpy_fft=False):
     """
+    Forward FFT of every frame of an x,y,frame series, with NaNs set to zero
+    (and, if zeromean, the NaN-aware mean of each frame subtracted) on the fly.
+
+    The series is processed ``block_size`` frames at a time, so besides the
+    output only one block of float temporaries and one block-sized NaN mask
+    are ever held.
+
+    Parameters
+    ----------
+    series : np.ndarray, 3d, x by y by frames (may be a memmap)
+    zeromean : bool
+        Subtract the NaN-aware mean of each frame before transforming
+    copy : bool
+        If True (default) series is never modified.  If False, NaNs are zeroed
+        (and means subtracted) in place, which avoids the per-block copy; the
+        series must then be floating point.
+    block_size : int
+        Number of frames preprocessed at once
+    out : np.ndarray
+        Complex array to write the transforms into.  If None, one is allocated.
+
+    Returns
+    -------
+    seriesfft, means : complex 3d array, 1d array
+        The transformed frames and the mean subtracted from each (zeros if
+        zeromean is False)
+    """
+    if series.ndim != 3:
+        raise ValueError("series must be 3d (x by y by frames).")
+    if not copy and series.dtype.kind != 'f':
+        raise ValueError("copy=False requires a floating point series.")
+
+    fft2,ifft2 = fast_ffts.get_ffts(nthreads=nthreads, use_numpy_fft=use_numpy_fft)
+
+    nframes = series.shape[2]
+    if out is None:
+        out = np.empty(series.shape, dtype='complex128')
+    means = np.zeros(nframes)
+
+    for start in range(0, nframes, block_size):
+        frames = slice(start, min(start+block_size, nframes))
+        if copy:
+            block = np.array(series[:,:,frames], dtype='float')
+        else:
+            block = series[:,:,frames]
+        means[frames] = _nanfill(block, zeromean=zeromean)
+        for i in range(block.shape[2]):
+            out[:,:,start+i] = fft2(block[:,:,i])
+
+    return out, means
+
+################################################################################################
+def dftregistration(buf1ft,buf2ft,buf3ft=None, usfac=1, return_registered=False,
+        return_error=False, zeromean=False, DEBUG=False, maxoff=None,
+        nthreads=1, use_numpy_fft=False, initial_shift=None):
+    """
     translated from matlab:
     http://www.mathworks.com/matlabcentral/fileexchange/18401-efficient-subpixel-image-registration-by-cross-correlation/content/html/efficient_subpixel_registration.html
 
@@ -118,12 +227,19 @@ def dftregistration(buf1ft,buf2ft,buf3ft, usfac=1, return_registered=False,
     SP 11282015:
     buf3ft    Fourier transform of green channel image to register, 
            DC in (1,1) [DO NOT FFTSHIFT]
+           (optional; if None only buf2ft is registered)
     SP end
     
     usfac     Upsampling factor (integer). Images will be registered to 
            within 1/usfac of a pixel. For example usfac = 20 means the
            images will be registered within 1/20 of a pixel. (default = 1)
 
+    initial_shift  (Optional) integer (row_shift,col_shift) of the
+           crosscorrelation peak found by other means (e.g.
+           cross_correlation_shifts.coarse_to_fine_peak).  The full IFFT
+           crosscorrelation is then skipped and only the DFT upsampling
+           around this estimate is done; maxoff is ignored.
+
     Outputs
     output =  [error,diffphase,net_row_shift,net_col_shift]
     error     Translation invariant normalized RMS error between f and g
@@ -155,11 +271,18 @@ def dftregistration(buf1ft,buf2ft,buf3ft, usfac=1, return_registered=False,
     # peak
     elif usfac == 1:
         [m,n]=shape(buf1ft);
-        CC = ifft2(buf1ft * conj(buf2ft));
-        if maxoff is None:
+        if initial_shift is not None:
+            # evaluate the inverse DFT at the known peak only
+            rloc,cloc = initial_shift[0] % m, initial_shift[1] % n
+            row_ramp = np.exp(1j*2*np.pi*np.arange(m)*rloc/m)
+            col_ramp = np.exp(1j*2*np.pi*np.arange(n)*cloc/n)
+            CCmax = row_ramp.dot(buf1ft * conj(buf2ft)).dot(col_ramp)/(m*n)
+        elif maxoff is None:
+            CC = ifft2(buf1ft * conj(buf2ft));
             rloc,cloc = np.unravel_index(abs(CC).argmax(), CC.shape)
             CCmax=CC[rloc,cloc]; 
         else:
+            CC = ifft2(buf1ft * conj(buf2ft));
             # set the interior of the shifted array to zero
             # (i.e., ignore it)
             CC[maxoff:-maxoff,:] = 0
@@ -189,59 +312,67 @@ def dftregistration(buf1ft,buf2ft,buf3ft, usfac=1, return_registered=False,
     else:
         
         if DEBUG: import pylab
-        # First upsample by a factor of 2 to obtain initial estimate
-        # Embed Fourier data in a 2x larger array
         [m,n]=shape(buf1ft);
-        mlarge=m*2;
-        nlarge=n*2;
-        CClarge=zeros([mlarge,nlarge], dtype='complex');
-        #CClarge[m-fix(m/2):m+fix((m-1)/2)+1,n-fix(n/2):n+fix((n-1)/2)+1] = fftshift(buf1ft) * conj(fftshift(buf2ft));
-        CClarge[round(mlarge/4.):round(mlarge/4.*3),round(nlarge/4.):round(nlarge/4.*3)] = fftshift(buf1ft) * conj(fftshift(buf2ft));
-        # note that matlab uses fix which is trunc... ?
-      
-        # Compute crosscorrelation and locate the peak 
-        CC = ifft2(ifftshift(CClarge)); # Calculate cross-correlation
-        if maxoff is None:
-            rloc,cloc = np.unravel_index(abs(CC).argmax(), CC.shape)
-            CCmax=CC[rloc,cloc]; 
-        else:
-            # set the interior of the shifted array to zero
-            # (i.e., ignore it)
-            CC[maxoff:-maxoff,:] = 0
-            CC[:,maxoff:-maxoff] = 0
-            rloc,cloc = np.unravel_index(abs(CC).argmax(), CC.shape)
-            CCmax=CC[rloc,cloc]; 
 
-        if DEBUG:
-            pylab.figure(1)
-            pylab.clf()
-            pylab.subplot(131)
-            pylab.imshow(real(CC)); pylab.title("Cross-Correlation (upsampled 2x)")
-            pylab.subplot(132)
-            ups = dftups((buf1ft) * conj((buf2ft)),mlarge,nlarge,2,0,0); pylab.title("dftups upsampled 2x")
-            pylab.imshow(real(((ups))))
-            pylab.subplot(133)
-            pylab.imshow(real(CC)/real(ups)); pylab.title("Ratio upsampled/dftupsampled")
-            print "Upsample by 2 peak: ",rloc,cloc," using dft version: ",np.unravel_index(abs(ups).argmax(), ups.shape)
-            #print np.unravel_index(ups.argmax(),ups.shape)
-        
-        # Obtain shift in original pixel grid from the position of the
-        # crosscorrelation peak 
-        [m,n] = shape(CC); md2 = trunc(m/2); nd2 = trunc(n/2);
-        if rloc > md2 :
-            row_shift2 = rloc - m;
+        if initial_shift is not None:
+            # the integer peak is already known: skip straight to the DFT
+            # refinement (md2,nd2 as they would be for the 2x array)
+            md2 = m; nd2 = n;
+            row_shift2,col_shift2 = float(initial_shift[0]),float(initial_shift[1])
         else:
-            row_shift2 = rloc;
-        if cloc > nd2:
-            col_shift2 = cloc - n;
-        else:
-            col_shift2 = cloc;
-        row_shift2=row_shift2/2.;
-        col_shift2=col_shift2/2.;
-        if DEBUG: print "row_shift/col_shift from ups2: ",row_shift2,col_shift2
+            # First upsample by a factor of 2 to obtain initial estimate
+            # Embed Fourier data in a 2x larger array
+            mlarge=m*2;
+            nlarge=n*2;
+            CClarge=zeros([mlarge,nlarge], dtype='complex');
+            #CClarge[m-fix(m/2):m+fix((m-1)/2)+1,n-fix(n/2):n+fix((n-1)/2)+1] = fftshift(buf1ft) * conj(fftshift(buf2ft));
+            CClarge[int(round(mlarge/4.)):int(round(mlarge/4.*3)),int(round(nlarge/4.)):int(round(nlarge/4.*3))] = fftshift(buf1ft) * conj(fftshift(buf2ft));
+            # note that matlab uses fix which is trunc... ?
+      
+            # Compute crosscorrelation and locate the peak 
+            CC = ifft2(ifftshift(CClarge)); # Calculate cross-correlation
+            if maxoff is None:
+                rloc,cloc = np.unravel_index(abs(CC).argmax(), CC.shape)
+                CCmax=CC[rloc,cloc]; 
+            else:
+                # set the interior of the shifted array to zero
+                # (i.e., ignore it)
+                CC[maxoff:-maxoff,:] = 0
+                CC[:,maxoff:-maxoff] = 0
+                rloc,cloc = np.unravel_index(abs(CC).argmax(), CC.shape)
+                CCmax=CC[rloc,cloc]; 
 
-        # If upsampling > 2, then refine estimate with matrix multiply DFT
-        if usfac > 2:
+            if DEBUG:
+                pylab.figure(1)
+                pylab.clf()
+                pylab.subplot(131)
+                pylab.imshow(real(CC)); pylab.title("Cross-Correlation (upsampled 2x)")
+                pylab.subplot(132)
+                ups = dftups((buf1ft) * conj((buf2ft)),mlarge,nlarge,2,0,0); pylab.title("dftups upsampled 2x")
+                pylab.imshow(real(((ups))))
+                pylab.subplot(133)
+                pylab.imshow(real(CC)/real(ups)); pylab.title("Ratio upsampled/dftupsampled")
+                print "Upsample by 2 peak: ",rloc,cloc," using dft version: ",np.unravel_index(abs(ups).argmax(), ups.shape)
+                #print np.unravel_index(ups.argmax(),ups.shape)
+        
+            # Obtain shift in original pixel grid from the position of the
+            # crosscorrelation peak 
+            [m,n] = shape(CC); md2 = trunc(m/2); nd2 = trunc(n/2);
+            if rloc > md2 :
+                row_shift2 = rloc - m;
+            else:
+                row_shift2 = rloc;
+            if cloc > nd2:
+                col_shift2 = cloc - n;
+            else:
+                col_shift2 = cloc;
+            row_shift2=row_shift2/2.;
+            col_shift2=col_shift2/2.;
+            if DEBUG: print "row_shift/col_shift from ups2: ",row_shift2,col_shift2
+
+        # If upsampling > 2 (or the 2x estimate was skipped), then refine
+        # estimate with matrix multiply DFT
+        if usfac > 2 or initial_shift is not None:
             #%% DFT computation %%%
             # Initial shift estimate in upsampled grid
             zoom_factor=1.5
@@ -334,13 +465,17 @@ def dftregistration(buf1ft,buf2ft,buf3ft, usfac=1, return_registered=False,
 
 
             #apply offsets to red then green channel fourier transforms and store in output; in that order.    
+            # the phase ramp is separable, so build it as an outer product
+            # of 1D exponentials rather than from a full meshgrid
+            nr,nc=shape(buf2ft);
+            Nr = np.fft.ifftshift(np.linspace(-np.fix(nr/2),np.ceil(nr/2)-1,nr))
+            Nc = np.fft.ifftshift(np.linspace(-np.fix(nc/2),np.ceil(nc/2)-1,nc))
+            row_ramp = np.exp(1j*2*np.pi*(-row_shift*Nr/nr))[:,np.newaxis]
+            col_ramp = np.exp(1j*2*np.pi*(-col_shift*Nc/nc)+1j*diffphase)[np.newaxis,:]
             for transform in [buf2ft, buf3ft]:
-                nr,nc=shape(transform);
-                Nr = np.fft.ifftshift(np.linspace(-np.fix(nr/2),np.ceil(nr/2)-1,nr))
-                Nc = np.fft.ifftshift(np.linspace(-np.fix(nc/2),np.ceil(nc/2)-1,nc))
-                [Nc,Nr] = np.meshgrid(Nc,Nr);
-                Greg = transform * np.exp(1j*2*np.pi*(-row_shift*Nr/nr-col_shift*Nc/nc));
-                Greg = Greg*np.exp(1j*diffphase);  
+                if transform is None:
+                    continue
+                Greg = transform * row_ramp * col_ramp
                 output.append(Greg)
 
         elif (usfac == 0):
@@ -354,7 +489,7 @@ def dftregistration(buf1ft,buf2ft,buf3ft, usfac=1, return_registered=False,
 
 def register_series(seriesRed, seriesGreen, target=None, usfac=1, return_registered=True,
         return_error=False, zeromean=False, DEBUG=False, maxoff=None,
-        nthreads=1, use_numpy_fft=False):
+        nthreads=1, use_numpy_fft=False, copy=True, block_size=64):
     """
     Sub-pixel image registration of a series of images (see dftregistration
     for lots of details)
@@ -377,6 +512,12 @@ def register_series(seriesRed, seriesGreen, target=None, usfac=1, return_registe
     maxoff : int
         Maximum allowed offset to measure (setting this helps avoid spurious
         peaks)
+    copy : bool
+        If True (default) seriesRed, seriesGreen and target are never
+        modified; NaNs are zeroed block by block while the frames are
+        transformed (see fft_series).  If False, NaNs are zeroed in place.
+    block_size : int
+        Number of frames preprocessed at once
     DEBUG : bool
         Test code used during development.  Should DEFINITELY be removed.
 
@@ -392,25 +533,19 @@ def register_series(seriesRed, seriesGreen, target=None, usfac=1, return_registe
     if target is None:
         target = seriesRed[:,:,0]
 
-    # prepare the target array
-    target[np.isnan(target)] = 0
-
-    # prepare the seriesRed and seriesGreen array
-    seriesRed[np.isnan(seriesRed)] = 0
-    seriesGreen[np.isnan(seriesGreen)] = 0
     # import the fft functions
     fft2,ifft2 = fftn,ifftn = fast_ffts.get_ffts(nthreads=nthreads, use_numpy_fft=use_numpy_fft)
 
-    # let's pre-transform everything
-    targetfft = fft2(target)
-
-    seriesRedfft = np.empty_like(seriesRed, dtype='complex128')
-    for i in range(seriesRed.shape[2]):
-        seriesRedfft[:,:,i] = fft2(seriesRed[:,:,i])
+    # let's pre-transform everything, zeroing NaNs on the way
+    targetfft = fft2(_prepare_image(target, copy=copy))
 
-    seriesGreenfft = np.empty_like(seriesGreen, dtype='complex128')
-    for i in range(seriesGreen.shape[2]):
-        seriesGreenfft[:,:,i] = fft2(seriesGreen[:,:,i])
+    seriesRedfft = fft_series(seriesRed, copy=copy, block_size=block_size,
+            nthreads=nthreads, use_numpy_fft=use_numpy_fft)[0]
+    if seriesGreen is seriesRed:
+        seriesGreenfft = seriesRedfft
+    else:
+        seriesGreenfft = fft_series(seriesGreen, copy=copy, block_size=block_size,
+                nthreads=nthreads, use_numpy_fft=use_numpy_fft)[0]
     
     # loop over seriesRed, using this series for alignment of both red and green channels.
     #make sure red and green sizes are the same. If not, pad. 
@@ -461,8 +596,9 @@ def aligner(target_and_frame):
 
     fft2,ifft2 = fftn,ifftn = fast_ffts.get_ffts(nthreads=1, use_numpy_fft=use_numpy_fft)
 
-    frameRed_fft = fft2(frameRed)
-    frameGreen_fft = fft2(frameGreen)
+    # the frames are this process's own (unpickled) copies
+    frameRed_fft = fft2(_prepare_image(frameRed, copy=False))
+    frameGreen_fft = fft2(_prepare_image(frameGreen, copy=False))
     output = dftregistration(target_fft, frameRed_fft, frameGreen_fft, usfac, return_registered, return_error, 
                              zeromean, DEBUG, maxoff, nthreads, use_numpy_fft)
 
@@ -505,18 +641,18 @@ def register_series_parallel(seriesRed, seriesGreen, target=None, usfac=1, retur
     Returns
     -------
     newseries, dx,dy : 3d array, 2d array, 2d array
+
+    seriesRed, seriesGreen and target are not modified: NaNs are zeroed by the
+    worker processes on their own copies of each frame.
     """
     if target is None:
-        target = series[:,:,0]
-    target[np.isnan(target)] = 0
-    seriesRed[np.isnan(seriesRed)] = 0
-    seriesGreen[np.isnan(seriesGreen)] = 0
+        target = seriesRed[:,:,0]
 
     # import the fft functions
     fft2,ifft2 = fftn,ifftn = fast_ffts.get_ffts(nthreads=1, use_numpy_fft=use_numpy_fft)
 
     # let's pre-transform just the target
-    targetfft = fft2(target)
+    targetfft = fft2(_prepare_image(target))
 
     list_of_target_and_frames = [(frameRed, frameGreen, targetfft, usfac, return_registered, 
                                   return_error, zeromean, DEBUG, 
@@ -6,3 +6,6 @@ from registration_testing import (upsample_ft_raw, make_offset_images,
         register_accuracy_test, register_noise_test, compare_methods,
         plot_compare_methods, chi2, edge_weight, fit_extended_shifts,
         test_extended_shifts)
+from registration_benchmarks import (make_synthetic_movie, measure_shifts,
+        benchmark, run_benchmarks, print_results, load_history, save_history,
+        compare_to_history)
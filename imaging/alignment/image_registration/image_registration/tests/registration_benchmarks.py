@@ -0,0 +1,346 @@
+"""
+Speed / accuracy benchmarks for the registration routines.
+
+Synthetic x,y,frame movies are generated with known rigid motion (optionally
+with non-rigid warping, noise and bleaching on top), each registration method
+is timed on them, and the frames/sec, peak RSS and shift error are recorded.
+Appending each run to a JSON history file makes regressions visible over time:
+
+>>> results = run_benchmarks(imsizes=(64,), usfacs=(1,), nframes=4,
+...         methods=('register_series',), history_file=None) # doctest: +SKIP
+>>> print_results(results) # doctest: +SKIP
+>>> save_history(results, 'registration_benchmarks.json') # doctest: +SKIP
+>>> compare_to_history(results, 'registration_benchmarks.json') # doctest: +SKIP
+
+Each benchmark runs in its own process (``isolate=True``) so the peak RSS
+reported belongs to that benchmark alone.
+"""
+from image_registration.cross_correlation_shifts import cross_correlation_shifts
+from image_registration.register_images import register_images, register_series, register_series_parallel
+from image_registration.chi2_shifts import chi2_shift
+from image_registration.fft_tools import fast_ffts, shift_stack
+from image_registration.version import __version__
+from registration_testing import make_extended
+
+import numpy as np
+import scipy.ndimage as nd
+
+import itertools
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import sys
+import time
+
+methods = ('register_images', 'register_images_pyramid', 'register_series',
+           'register_series_parallel', 'chi2_shift', 'cross_correlation_shifts',
+           'cross_correlation_shifts_pyramid')
+
+# methods whose accuracy depends on an upsampling factor
+usfac_methods = ('register_images', 'register_images_pyramid',
+                 'register_series', 'register_series_parallel', 'chi2_shift')
+
+# number of coarse-to-fine levels used by the *_pyramid methods
+pyramid_levels = 3
+
+# the fields identifying a benchmark case in the history
+case_keys = ('method', 'imsize', 'nframes', 'usfac', 'nthreads',
+             'max_shift', 'nonrigid_amp', 'noise', 'bleach_tau')
+
+def make_synthetic_movie(imsize=128, nframes=100, max_shift=5.0,
+        nonrigid_amp=0.0, noise=0.05, bleach_tau=None, seed=None):
+    """
+    Make an x,y,frame movie of an extended-emission image moving with a known
+    rigid trajectory.
+
+    Parameters
+    ----------
+    imsize : int
+        Frames are imsize by imsize
+    nframes : int
+        Number of frames
+    max_shift : float
+        Largest rigid shift (in pixels) of the smooth random-walk trajectory
+    nonrigid_amp : float
+        Amplitude (in pixels) of a zero-mean sinusoidal warp added to each
+        frame on top of the rigid motion.  It does not change the rigid
+        ground truth, but makes the registration problem harder.
+    noise : float
+        Gaussian noise level, as a fraction of the reference image std
+    bleach_tau : float or None
+        Exponential bleaching time constant in frames
+    seed : int or None
+        Seed for np.random, for reproducible movies
+
+    Returns
+    -------
+    movie, reference, dx, dy
+        The movie, the noiseless unshifted reference frame, and the true
+        per-frame shifts along the second (dx) and first (dy) axes, in the
+        convention returned by register_images and friends
+    """
+    if seed is not None:
+        np.random.seed(seed)
+
+    reference = make_extended(imsize)
+    reference = reference / reference.mean()
+
+    # smooth random walk, scaled so the largest excursion is max_shift
+    walk = nd.gaussian_filter1d(np.random.randn(2, nframes).cumsum(axis=1),
+                                max(nframes/20., 1), axis=1)
+    walk -= walk[:,:1]
+    if np.abs(walk).max() > 0:
+        walk *= max_shift / np.abs(walk).max()
+    dx, dy = walk
+
+    movie = shift_stack(np.repeat(reference[:,:,np.newaxis], nframes, axis=2), dx, dy)
+
+    if nonrigid_amp:
+        yy, xx = np.indices(reference.shape, dtype='float')
+        for ii in range(nframes):
+            phase = np.random.uniform(0, 2*np.pi, 2)
+            warp_y = nonrigid_amp * np.sin(2*np.pi*xx/(imsize/2.) + phase[0])
+            warp_x = nonrigid_amp * np.sin(2*np.pi*yy/(imsize/2.) + phase[1])
+            movie[:,:,ii] = nd.map_coordinates(movie[:,:,ii],
+                    [yy+warp_y, xx+warp_x], order=1, mode='wrap')
+
+    if bleach_tau:
+        movie *= np.exp(-np.arange(nframes)/float(bleach_tau))
+
+    if noise:
+        movie += np.random.randn(*movie.shape) * noise * reference.std()
+
+    return movie, reference, dx, dy
+
+def measure_shifts(method, movie, reference, usfac=1, nthreads=1):
+    """
+    Measure the shift of every frame of *movie* relative to *reference* with
+    one of the registration routines (named as in ``methods``).
+
+    Returns
+    -------
+    dx, dy : np.ndarray, np.ndarray
+    """
+    if method == 'register_images':
+        shifts = [register_images(reference, frame, usfac=usfac, nthreads=nthreads)
+                  for frame in np.rollaxis(movie, 2)]
+    elif method == 'register_images_pyramid':
+        shifts = [register_images(reference, frame, usfac=usfac, nthreads=nthreads,
+                                  pyramid_levels=pyramid_levels)
+                  for frame in np.rollaxis(movie, 2)]
+    elif method == 'chi2_shift':
+        shifts = [chi2_shift(reference, frame, upsample_factor=usfac,
+                             nthreads=nthreads, return_error=False)
+                  for frame in np.rollaxis(movie, 2)]
+    elif method == 'cross_correlation_shifts':
+        shifts = [cross_correlation_shifts(reference, frame, nthreads=nthreads)
+                  for frame in np.rollaxis(movie, 2)]
+    elif method == 'cross_correlation_shifts_pyramid':
+        shifts = [cross_correlation_shifts(reference, frame,
+                                           pyramid_levels=pyramid_levels)
+                  for frame in np.rollaxis(movie, 2)]
+    elif method == 'register_series':
+        # the movie is ours to clobber, so skip the per-block copies
+        out = register_series(movie, movie, target=reference,
+                              usfac=usfac, nthreads=nthreads, copy=False)
+        return out[2], out[3]
+    elif method == 'register_series_parallel':
+        out = register_series_parallel(movie, movie, target=reference,
+                                       usfac=usfac, nthreads=nthreads)
+        return out[2], out[3]
+    else:
+        raise ValueError("Unknown method %s" % method)
+
+    dx, dy = np.array(shifts, dtype='float')[:,:2].T
+    return dx, dy
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process and its (reaped) children, in MB
+    """
+    # ru_maxrss is in bytes on OS X and kilobytes on linux
+    scale = 1024.**2 if sys.platform == 'darwin' else 1024.
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / scale
+
+def benchmark(method, imsize=128, nframes=50, usfac=1, nthreads=1,
+        max_shift=5.0, nonrigid_amp=0.0, noise=0.05, bleach_tau=None,
+        seed=0, repeat=1):
+    """
+    Time one registration method on one synthetic movie.
+
+    The movie is regenerated (with the same seed) for every repeat because the
+    series routines modify their inputs.  The fastest repeat is reported.
+
+    Returns
+    -------
+    A dictionary with the case parameters (see ``case_keys``) and 'seconds',
+    'frames_per_second', 'peak_rss_mb', 'rms_error' and 'max_error' (the
+    shift errors are in pixels, combining x and y)
+    """
+    times = []
+    for ii in range(repeat):
+        movie, reference, dx, dy = make_synthetic_movie(imsize, nframes,
+                max_shift=max_shift, nonrigid_amp=nonrigid_amp, noise=noise,
+                bleach_tau=bleach_tau, seed=seed)
+        t0 = time.time()
+        mdx, mdy = measure_shifts(method, movie, reference, usfac=usfac,
+                                  nthreads=nthreads)
+        times.append(time.time() - t0)
+
+    error = np.hypot(np.asarray(mdx)-dx, np.asarray(mdy)-dy)
+    seconds = min(times)
+
+    return {'method': method, 'imsize': imsize, 'nframes': nframes,
+            'usfac': usfac if method in usfac_methods else None,
+            'nthreads': nthreads, 'max_shift': max_shift,
+            'nonrigid_amp': nonrigid_amp, 'noise': noise,
+            'bleach_tau': bleach_tau,
+            'seconds': seconds,
+            'frames_per_second': nframes / seconds if seconds > 0 else float('inf'),
+            'peak_rss_mb': peak_rss_mb(),
+            'rms_error': float(np.sqrt((error**2).mean())),
+            'max_error': float(error.max())}
+
+def _benchmark_worker(queue, kwargs):
+    try:
+        queue.put(benchmark(**kwargs))
+    except Exception as ex:
+        queue.put(ex)
+
+def _isolated_benchmark(**kwargs):
+    queue = mp.Queue()
+    proc = mp.Process(target=_benchmark_worker, args=(queue, kwargs))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def run_benchmarks(methods=methods, imsizes=(64,128,256), usfacs=(1,10,100),
+        nthreads=(1,2,4), nframes=50, isolate=True, verbose=True,
+        history_file=None, **kwargs):
+    """
+    Run ``benchmark`` over every combination of method, image size, usfac and
+    thread count.
+
+    usfac is only varied for the methods that take it.  The thread count is
+    only varied for register_series_parallel (which uses a process pool) and,
+    if fftw is installed, for the FFT-based methods.
+
+    Parameters
+    ----------
+    isolate : bool
+        Run every benchmark in a fresh process so peak RSS is per-benchmark
+    history_file : str or None
+        If given, the results are appended to this JSON history
+    kwargs
+        Passed to ``benchmark`` (max_shift, nonrigid_amp, noise, bleach_tau,
+        seed, repeat)
+
+    Returns
+    -------
+    A list of result dictionaries (see ``benchmark``)
+    """
+    run = _isolated_benchmark if isolate else benchmark
+
+    results = []
+    for method, imsize in itertools.product(methods, imsizes):
+        these_usfacs = usfacs if method in usfac_methods else usfacs[:1]
+        if method == 'register_series_parallel' or fast_ffts.has_fftw:
+            these_nthreads = nthreads
+        else:
+            these_nthreads = nthreads[:1]
+
+        for usfac, nthr in itertools.product(these_usfacs, these_nthreads):
+            result = run(method=method, imsize=imsize, nframes=nframes,
+                         usfac=usfac, nthreads=nthr, **kwargs)
+            results.append(result)
+            if verbose:
+                print_results([result], header=len(results) == 1)
+
+    if history_file is not None:
+        save_history(results, history_file)
+
+    return results
+
+def print_results(results, header=True):
+    """
+    Print benchmark results as a table
+    """
+    columns = ('method', 'imsize', 'usfac', 'nthreads', 'frames_per_second',
+               'peak_rss_mb', 'rms_error')
+    if header:
+        print "%33s %7s %6s %8s %12s %10s %10s" % ('method', 'imsize', 'usfac',
+                'nthreads', 'frames/sec', 'RSS (MB)', 'rms error')
+    for r in results:
+        print "%33s %7i %6s %8i %12.2f %10.1f %10.4f" % tuple(r[c] for c in columns)
+
+def load_history(filename):
+    """
+    Load the list of recorded benchmark runs (empty if the file doesn't exist)
+    """
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return json.load(f)
+
+def save_history(results, filename):
+    """
+    Append a run of benchmark results, along with some information about the
+    machine and library versions, to a JSON history file
+    """
+    history = load_history(filename)
+    history.append({'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'version': __version__,
+                    'numpy': np.__version__,
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'has_fftw': fast_ffts.has_fftw,
+                    'results': results})
+    with open(filename, 'w') as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+
+def compare_to_history(results, filename, speed_tolerance=0.2,
+        error_tolerance=0.02):
+    """
+    Compare results against the most recent recorded run of each case.
+
+    Parameters
+    ----------
+    speed_tolerance : float
+        Fractional drop in frames/sec that counts as a regression
+    error_tolerance : float
+        Increase in rms shift error (pixels) that counts as a regression
+
+    Returns
+    -------
+    A list of (current, previous) result pairs that regressed
+    """
+    previous = {}
+    for run in load_history(filename):
+        for r in run['results']:
+            previous[tuple(r[k] for k in case_keys)] = r
+
+    regressions = []
+    for r in results:
+        old = previous.get(tuple(r[k] for k in case_keys))
+        if old is None:
+            continue
+        slower = r['frames_per_second'] < (1-speed_tolerance) * old['frames_per_second']
+        worse = r['rms_error'] > old['rms_error'] + error_tolerance
+        if slower or worse:
+            regressions.append((r, old))
+    return regressions
+
+if __name__ == "__main__":
+    history_file = sys.argv[1] if len(sys.argv) > 1 else 'registration_benchmarks.json'
+    results = run_benchmarks()
+    for current, old in compare_to_history(results, history_file):
+        print "REGRESSION: %(method)s imsize=%(imsize)i usfac=%(usfac)s nthreads=%(nthreads)i" % current,
+        print "%.2f -> %.2f frames/sec, %.4f -> %.4f rms error" % (old['frames_per_second'],
+                current['frames_per_second'], old['rms_error'], current['rms_error'])
+    save_history(results, history_file)
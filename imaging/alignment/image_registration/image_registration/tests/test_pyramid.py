@@ -0,0 +1,64 @@
+from image_registration import cross_correlation_shifts, register_images
+from image_registration.cross_correlation_shifts import (coarse_to_fine_peak,
+        wrapped_correlation)
+from image_registration.fft_tools import correlate2d
+from image_registration.tests.registration_testing import (make_extended,
+        make_offset_extended)
+import numpy as np
+import pytest
+import itertools
+
+shifts = [-7.3, -1.5, 0.0, 2.25, 6.8]
+sizes = [63, 128]
+
+@pytest.mark.parametrize(('yshift','xshift','imsize'),
+    [(-3,2,16), (0,0,17), (5,-7,32)])
+def test_wrapped_correlation(yshift, xshift, imsize):
+    np.random.seed(0)
+    im1 = np.random.randn(imsize, imsize)
+    im2 = np.random.randn(imsize, imsize)
+    ccorr = correlate2d(im1, im2, quiet=True)
+    cen = imsize/2-(1-imsize%2)
+    np.testing.assert_almost_equal(wrapped_correlation(im1, im2, yshift, xshift),
+                                   ccorr[cen+yshift, cen+xshift])
+
+@pytest.mark.parametrize(('xsh','ysh','imsize','levels'),
+    list(itertools.product(shifts,shifts,sizes,(1,3))))
+def test_pyramid_cross_correlation_shifts(xsh, ysh, imsize, levels):
+    image = make_extended(imsize)
+    offset_image = make_offset_extended(image, xsh, ysh, noise=0.1)
+    full = cross_correlation_shifts(image, offset_image)
+    pyramid = cross_correlation_shifts(image, offset_image,
+                                       pyramid_levels=levels)
+    np.testing.assert_array_almost_equal(full, pyramid)
+
+@pytest.mark.parametrize(('xsh','ysh','imsize','usfac'),
+    list(itertools.product(shifts,shifts,sizes,(1,2,20))))
+def test_pyramid_register_images(xsh, ysh, imsize, usfac):
+    image = make_extended(imsize)
+    offset_image = make_offset_extended(image, xsh, ysh, noise=0.1)
+    full = register_images(image, offset_image, usfac=usfac)
+    pyramid = register_images(image, offset_image, usfac=usfac,
+                              pyramid_levels=2)
+    np.testing.assert_array_almost_equal(full, pyramid)
+
+def test_pyramid_maxoff():
+    image = make_extended(128)
+    offset_image = make_offset_extended(image, 3.2, -2.6, noise=0.1)
+    yshift,xshift,local_values = coarse_to_fine_peak(image-image.mean(),
+            offset_image-offset_image.mean(), levels=3, maxoff=5)
+    assert max(abs(yshift),abs(xshift)) <= 5
+    assert local_values.shape == (3,3)
+    assert local_values.argmax() == 4
+
+def test_pyramid_gaussfit():
+    image = make_extended(32)
+    with pytest.raises(ValueError):
+        cross_correlation_shifts(image, image, gaussfit=True, pyramid_levels=2)
+
+def test_pyramid_correlate2d_kwargs():
+    image = make_extended(32)
+    with pytest.raises(ValueError):
+        cross_correlation_shifts(image, image, pyramid_levels=2, boundary='wrap')
+    # quiet is not a correlate2d keyword here, so it is still allowed
+    cross_correlation_shifts(image, image, pyramid_levels=2, quiet=True)
@@ -0,0 +1,60 @@
+from image_registration import register_images, register_series, fft_series
+from image_registration.tests.registration_benchmarks import make_synthetic_movie
+import numpy as np
+import pytest
+
+def nan_movie(seed=0):
+    movie, reference, dx, dy = make_synthetic_movie(imsize=32, nframes=7,
+                                                    max_shift=3, seed=seed)
+    movie[3:5,10:20,2] = np.nan
+    movie[:,:,4] = np.nan
+    reference[0,0] = np.nan
+    return movie, reference
+
+@pytest.mark.parametrize('block_size', [1,3,64])
+def test_register_series_copy(block_size):
+    movie, reference = nan_movie()
+    green = movie*2
+    movie0, reference0, green0 = movie.copy(), reference.copy(), green.copy()
+    out = register_series(movie, green, target=reference, usfac=10,
+                          block_size=block_size)
+    # the inputs are untouched
+    np.testing.assert_array_equal(movie, movie0)
+    np.testing.assert_array_equal(green, green0)
+    np.testing.assert_array_equal(reference, reference0)
+    # and the results are those of the NaN-zeroed inputs, zeroed in place
+    filled = [np.nan_to_num(x) for x in (movie0, green0, reference0)]
+    out_inplace = register_series(filled[0], filled[1], target=filled[2],
+                                  usfac=10, copy=False)
+    for a,b in zip(out, out_inplace):
+        np.testing.assert_array_almost_equal(a, b)
+
+def test_register_series_nocopy():
+    movie, reference = nan_movie()
+    register_series(movie, movie, target=reference, copy=False)
+    assert not np.any(np.isnan(movie))
+    assert not np.any(np.isnan(reference))
+
+@pytest.mark.parametrize('block_size', [1,4])
+def test_fft_series_zeromean(block_size):
+    movie = nan_movie()[0]
+    seriesfft, means = fft_series(movie, zeromean=True, block_size=block_size)
+    for ii in range(movie.shape[2]):
+        frame = movie[:,:,ii]
+        if np.all(np.isnan(frame)):
+            expected = np.zeros(frame.shape)
+        else:
+            expected = np.nan_to_num(frame - frame[frame==frame].mean())
+        np.testing.assert_array_almost_equal(np.fft.fft2(expected),
+                                             seriesfft[:,:,ii])
+
+def test_register_images_copy():
+    movie, reference = nan_movie()
+    image = movie[:,:,2]
+    image0, reference0 = image.copy(), reference.copy()
+    shifts = register_images(reference, image, usfac=10)
+    np.testing.assert_array_equal(image, image0)
+    np.testing.assert_array_equal(reference, reference0)
+    shifts_inplace = register_images(reference, image, usfac=10, copy=False)
+    np.testing.assert_array_almost_equal(shifts, shifts_inplace)
+    assert not np.any(np.isnan(image))
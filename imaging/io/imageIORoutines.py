@@ -3,6 +3,7 @@ import glob
 import numpy as np
 import matplotlib.pyplot as plt
 import os
+import sys
 import time
 import scipy.signal as sig
 
@@ -11,6 +12,8 @@ from IPython.core import display
 import IPython.core.pylabtools as pylabtools
 
 import tempfile
+import threading
+import Queue
 
 import subprocess
 import tifffile
@@ -21,7 +24,7 @@ except ImportError:
 
 import cPickle as pickle
 
-__all__ = ['play', 'embed', 'save3dNPArrayAsMovie', 'writeMultiImageStack', 'imread', 'imreadStack', 'imsave', 'imview', 'splitAndResaveChannels', 'readMultiImageTifStack', 'readImagesFromList', 'downsample2d', 'downsample3d', 'load', 'save']
+__all__ = ['play', 'embed', 'save3dNPArrayAsMovie', 'writeMultiImageStack', 'imread', 'imreadStack', 'imreadBlocks', 'imsave', 'imview', 'splitAndResaveChannels', 'readMultiImageTifStack', 'readImagesFromList', 'downsample2d', 'downsample3d', 'load', 'save']
 
 
 def save3dNPArrayAsMovie(fileName, npArray, frameRate=6):
@@ -118,6 +121,81 @@ def imreadStack(filenameList):
         imageStack[:,:,:,i] = array
     return imageStack
 
+def imreadBlocks(filenameList, framesPerBlock=500, prefetch=True):
+    """Generator over blocks of frames from a list of (multiframe) tiff files.
+
+    Only framesPerBlock frames are read at a time, so a whole session can be
+    processed in constant memory.  Blocks never span two files.  With
+    prefetch, the next block is read by a background thread while the
+    current one is being used, overlapping file reads with computation;
+    at most two blocks are held in addition to the current one.
+
+    Blocks are frame by X by Y, as tifffile returns them (use
+    np.transpose(block, [1,2,0]) for our x,y,frame convention).
+
+    :param filenameList: list of strings representing the files to read, in order
+    :param framesPerBlock: maximum number of frames per block
+    :param prefetch: boolean flag to read ahead in a background thread
+    :returns: generator of (fileIndex, firstFrame, block) tuples, firstFrame counting within the file
+    """
+
+    def readBlocks():
+        for fileIndex, fileName in enumerate(filenameList):
+            with tifffile.tifffile(fileName) as tif:
+                nFrames = len(tif.pages)
+                for start in range(0, nFrames, framesPerBlock):
+                    stop = min(start + framesPerBlock, nFrames)
+                    block = tif.asarray(key=slice(start, stop))
+                    block = block.reshape((stop - start,) + block.shape[-2:])
+                    yield fileIndex, start, block
+
+    if not prefetch:
+        for item in readBlocks():
+            yield item
+        return
+
+    blocks = Queue.Queue(maxsize=2)
+    done = object()
+    failed = object()
+    stop = threading.Event()
+
+    def put(item):
+        # give up if the consumer has gone away
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for item in readBlocks():
+                if not put(item):
+                    return
+            put(done)
+        except Exception:
+            # with the traceback, so the error points at the failing read
+            put((failed, sys.exc_info()))
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = blocks.get()
+            if item is done:
+                break
+            if item[0] is failed:
+                errorType, error, traceback = item[1]
+                raise errorType, error, traceback
+            yield item
+    finally:
+        # let the reader finish if we were abandoned early
+        stop.set()
+        thread.join()
+
 def imsave(npArray, filename):
     """Simple for tifffile's imsave to account for our x : y : frame representation.  Can
     take either 2 or 3d numpy arrays.
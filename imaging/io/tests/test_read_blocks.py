@@ -0,0 +1,66 @@
+"""imreadBlocks gives the frames of a plain full read, block by block, and
+errors in the reader thread come out with the reader's traceback."""
+import os
+import sys
+import traceback
+
+import numpy as np
+import pytest
+
+pytest.importorskip('IPython')
+
+# the imaging package imports the alignment routines, so import the module on its own
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import imageIORoutines as io
+import tifffile
+
+def write_files(directory, frameCounts, shape=(6, 9), seed=0):
+    random = np.random.RandomState(seed)
+    filenames, movies = [], []
+    for i, nFrames in enumerate(frameCounts):
+        movie = random.randint(0, 4000, (nFrames,) + shape).astype('uint16')
+        filename = str(directory.join('movie%d.tif' % i))
+        tifffile.imsave(filename, movie)
+        filenames.append(filename)
+        movies.append(movie)
+    return filenames, movies
+
+@pytest.mark.parametrize('framesPerBlock', [1, 4, 7, 500])
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_blocks_match_full_read(tmpdir, framesPerBlock, prefetch):
+    filenames, movies = write_files(tmpdir, [7, 1, 10])
+    blocks = list(io.imreadBlocks(filenames, framesPerBlock=framesPerBlock, prefetch=prefetch))
+    for fileIndex, filename in enumerate(filenames):
+        fileBlocks = [(start, block) for i, start, block in blocks if i == fileIndex]
+        starts = [start for start, block in fileBlocks]
+        assert starts == range(0, len(movies[fileIndex]), framesPerBlock)
+        assert all(len(block) <= framesPerBlock for start, block in fileBlocks)
+        frames = np.concatenate([block for start, block in fileBlocks])
+        np.testing.assert_array_equal(frames, movies[fileIndex])
+        full = tifffile.imread(filename)
+        np.testing.assert_array_equal(frames, full.reshape((-1,) + full.shape[-2:]))
+    # files in order
+    assert [i for i, start, block in blocks] == sorted(i for i, start, block in blocks)
+
+def test_reader_error_keeps_traceback(tmpdir):
+    filenames, movies = write_files(tmpdir, [5])
+    broken = str(tmpdir.join('broken.tif'))
+    with open(broken, 'wb') as f:
+        f.write('not a tiff file at all')
+    blocks = io.imreadBlocks(filenames + [broken], framesPerBlock=2, prefetch=True)
+    read = []
+    with pytest.raises(Exception) as error:
+        for item in blocks:
+            read.append(item)
+    # the blocks before the bad file still arrive
+    np.testing.assert_array_equal(np.concatenate([block for i, start, block in read]), movies[0])
+    # and the traceback runs through the reader thread's read, not just the consumer
+    functions = [frame[2] for frame in traceback.extract_tb(error.tb)]
+    assert 'readBlocks' in functions
+    assert 'reader' in functions
+
+def test_abandoned_generator_stops_reader(tmpdir):
+    filenames, movies = write_files(tmpdir, [20, 20])
+    blocks = io.imreadBlocks(filenames, framesPerBlock=1, prefetch=True)
+    np.testing.assert_array_equal(next(blocks)[2], movies[0][:1])
+    blocks.close()
@@ -1,8 +1,22 @@
 import numpy as np
-import pymorph
-import mahotas
 
-def imimposemin(image, mask, connectivity):
+def imimposemin(image, mask, connectivity=None):
+    """Impose regional minima on image where mask is set, as matlab's imimposemin.
+
+    The result is the reconstruction by erosion of the marker (very low under
+    mask, very high elsewhere) over min(image + h, marker), so its only
+    regional minima are the mask pixels.
+
+    :param image: 2d numpy array
+    :param mask: boolean array, same shape as image
+    :param connectivity: 4 or 8 (as in matlab), or a 3x3 structuring element.
+                         Defaults to 4 (pymorph.secross()).
+    :returns: image with the minima imposed
+    """
+    if image.ndim != 2:
+        raise ValueError('imimposemin only handles 2d images, not %dd' % image.ndim)
+    connectivity = structuring_element(connectivity)
+
     fm = image.copy()
     fm[mask] = -922337203685477580
     fm[np.logical_not(mask)] = 922337203685477580
@@ -20,20 +34,165 @@ def imimposemin(image, mask, connectivity):
 
     g = np.minimum(fp1, fm)
 
-    # may need to complement and uncomplement
-    j = infrec(fm, g)
+    # reconstruction by erosion of fm over g, done as the complement of a
+    # reconstruction by dilation (as matlab's imimposemin does)
+    j = -infrec(-fm, -g, connectivity)
     return j
 
+def structuring_element(connectivity=None):
+    """3x3 structuring element for a connectivity: 4 (the default) or 8, as in
+    matlab, or a 3x3 structuring element, returned as a boolean array."""
+    if connectivity is None or (np.isscalar(connectivity) and connectivity == 4):
+        return np.array([[0,1,0],[1,1,1],[0,1,0]], bool)
+    if np.isscalar(connectivity) and connectivity == 8:
+        return np.ones((3, 3), bool)
+    if np.isscalar(connectivity):
+        raise ValueError('connectivity must be 4, 8 or a 3x3 structuring element, not %r' % (connectivity,))
+    Bc = np.asarray(connectivity, bool)
+    if Bc.shape != (3, 3):
+        raise ValueError('connectivity must be 4, 8 or a 3x3 structuring element, not shape %s' % (Bc.shape,))
+    return Bc
+
 def infrec(f, g, Bc=None):
-    if Bc is None: Bc = pymorph.secross()
-    n = f.size
-    return fast_conditional_dilate(f, g, Bc, n);
+    return hybrid_reconstruct(f, g, structuring_element(Bc))
 
 def fast_conditional_dilate(f, g, Bc=None, n=1):
-    if Bc is None: Bc = pymorph.secross()
-    f = pymorph.intersec(f,g)
+    Bc = structuring_element(Bc)
+    f = np.minimum(f, g)
     for i in xrange(n):
         prev = f
-        f = pymorph.intersec(mahotas.dilate(f, Bc), g)
-        if pymorph.isequal(f, prev): break
+        f = np.minimum(flat_dilate(f, Bc), g)
+        if np.array_equal(f, prev): break
     return f
+
+def flat_dilate(f, Bc):
+    """Flat dilation of a 2d image by a 3x3 structuring element, pixels outside
+    the image ignored.
+
+    Exact for any values: mahotas.dilate adds a (boolean) structuring element
+    to integer images, and scipy.ndimage filters go through doubles, so both
+    get the +-9.2e18 markers imimposemin uses wrong.
+    """
+    rows, cols = f.shape
+    padded = np.pad(f, 1, mode='edge')
+    dilated = None
+    for dy, dx in zip(*np.nonzero(Bc)):
+        shifted = padded[dy:dy + rows, dx:dx + cols]
+        dilated = shifted.copy() if dilated is None else np.maximum(dilated, shifted)
+    return dilated
+
+def hybrid_reconstruct(f, g, Bc=None):
+    """Grayscale reconstruction by dilation of the marker f under the mask g.
+
+    Gives the same result as iterating fast_conditional_dilate to stability,
+    using Vincent's hybrid algorithm (L. Vincent, "Morphological grayscale
+    reconstruction in image analysis", IEEE Trans. Image Proc. 2, 1993): one
+    raster and one anti-raster scan propagate values across most of the image,
+    then only the pixels that can still change are propagated from a queue.
+    Each scan is vectorised along the rows, and the queue is processed a
+    wavefront at a time.
+
+    :param f: marker image (2d numpy array)
+    :param g: mask image, same shape as f
+    :param Bc: 3x3 structuring element defining the connectivity, or 4 or 8
+               (default: 4, pymorph.secross())
+    :returns: the reconstruction, min(f, g) grown under g
+    """
+    Bc = structuring_element(Bc)
+    if np.ndim(f) != 2:
+        raise ValueError('hybrid_reconstruct only handles 2d images, not %dd' % np.ndim(f))
+
+    g = np.asarray(g)
+    J = np.minimum(f, g)
+    if J.dtype.kind == 'f':
+        lowest = -np.inf
+    else:
+        lowest = np.iinfo(J.dtype).min
+
+    _reconstruction_scan(J, g, Bc, lowest)
+    _reconstruction_scan(J[::-1, ::-1], g[::-1, ::-1], Bc[::-1, ::-1], lowest)
+
+    # queue the pixels that could still raise a neighbour scanned before them
+    # in the anti-raster pass
+    rows, cols = J.shape
+    queued = np.zeros(J.shape, bool)
+    for dy, dx in _offsets(Bc):
+        if dy < 0 or (dy == 0 and dx < 0):
+            continue
+        p, q = _neighbour_slices(rows, cols, dy, dx)
+        queued[p] |= (J[q] < J[p]) & (J[q] < g[q])
+
+    # propagate from the queue, one wavefront at a time
+    Jflat = J.ravel()
+    gflat = g.ravel()
+    frontier = np.flatnonzero(queued)
+    while frontier.size:
+        frontierRows, frontierCols = np.divmod(frontier, cols)
+        values = Jflat[frontier]
+        raised = []
+        for dy, dx in _offsets(Bc):
+            r = frontierRows + dy
+            c = frontierCols + dx
+            inside = (r >= 0) & (r < rows) & (c >= 0) & (c < cols)
+            q = r[inside] * cols + c[inside]
+            candidates = np.minimum(values[inside], gflat[q])
+            grow = candidates > Jflat[q]
+            np.maximum.at(Jflat, q[grow], candidates[grow])
+            raised.append(q[grow])
+        frontier = np.unique(np.concatenate(raised))
+
+    return J
+
+def _offsets(Bc):
+    return [(dy - 1, dx - 1) for dy, dx in zip(*np.nonzero(Bc)) if (dy, dx) != (1, 1)]
+
+def _neighbour_slices(rows, cols, dy, dx):
+    """Slices p, q such that J[q] is the (dy, dx) neighbour of J[p]."""
+    def axis(n, d):
+        return slice(max(-d, 0), n - max(d, 0)), slice(max(d, 0), n - max(-d, 0))
+    py, qy = axis(rows, dy)
+    px, qx = axis(cols, dx)
+    return (py, px), (qy, qx)
+
+def _clip_scan(lower, upper):
+    """x[i] = clip(x[i-1], lower[i], upper[i]), x[0] = lower[0], along the last axis.
+
+    Clips compose into clips, so the running composition is computed by
+    doubling in log2(n) vectorised steps.
+    """
+    lower = lower.copy()
+    upper = upper.copy()
+    n = lower.shape[-1]
+    step = 1
+    while step < n:
+        newLower = np.clip(lower[..., :-step], lower[..., step:], upper[..., step:])
+        newUpper = np.clip(upper[..., :-step], lower[..., step:], upper[..., step:])
+        lower[..., step:] = newLower
+        upper[..., step:] = newUpper
+        step *= 2
+    return lower
+
+def _reconstruction_scan(J, g, Bc, lowest):
+    """One raster scan of the sequential reconstruction, in place on J:
+    J(p) = min(max(J(p), J(q) for q in the neighbours of p scanned before it), g(p))
+    """
+    rows, cols = J.shape
+    above = [dx for dy, dx in _offsets(Bc) if dy == -1]
+    left = bool(Bc[1, 0])
+    shifted = np.empty(cols, J.dtype)
+    for r in range(rows):
+        row = J[r]
+        if r > 0:
+            for dx in above:
+                shifted.fill(lowest)
+                if dx < 0:
+                    shifted[-dx:] = J[r - 1, :dx]
+                elif dx > 0:
+                    shifted[:-dx] = J[r - 1, dx:]
+                else:
+                    shifted[:] = J[r - 1]
+                row = np.maximum(row, shifted)
+        row = np.minimum(row, g[r])
+        if left:
+            row = _clip_scan(row, g[r])
+        J[r] = row
@@ -1,6 +1,6 @@
 import numpy as np
-import pymorph
 import scipy.ndimage as nd
+import scipy.sparse as sparse
 
 __all__ = ['boxcar', 'regionProps']
 
@@ -15,45 +15,100 @@ def boxcar(imageSeries, boxWidth=3, axis=2):
     """
     return nd.convolve1d(imageSeries, np.array([1]*boxWidth)/float(boxWidth), axis=axis)
 
-def regionProps(mask, image=None):
-    """Calculates some basic properties of ROIs in a mask.
+def regionProps(mask, image=None, perFrame=False):
+    """Calculates some basic properties of ROIs in a mask, for all labels at once.
 
-    Properties calculated:  centroids, boxes, areas.  If the original image is passed in,
-    this also calcluate the mean value in each region.
+    Every property is computed in one pass over the flattened label image with
+    np.bincount (and ndimage.find_objects for the boxes), so the cost does not
+    grow with the number of labels.
 
-    Keys of returned dictionary:  'centroid', 'boundingBox', 'area', and optionally, 'meanIntensity'
+    Fields of the returned table (record i is label i+1; labels with no
+    pixels get an area of 0, NaN centroids and a bounding box of -1s):
+
+    'label', 'area', 'centroid' (x, y), 'com' (intensity weighted centroid,
+    the same as the centroid if no image is given), 'boundingBox' (xstart,
+    ystart, xstop, ystop, stops exclusive as in slices), and if an image is
+    passed in, 'meanIntensity' and 'maxIntensity'.  With perFrame and an
+    X by Y by time image, 'frameMeans' holds the mean of each region in every
+    frame.
 
     :param mask: a 2d labeled image
-    :param image: an optional 2p numpy array, original image, for calculation of mean intensity values
-    :returns: a dictionary of lists, each containing property values
+    :param image: an optional 2 or 3d numpy array, original image (or X by Y by time series, which is
+                  averaged over time), for calculation of intensity values
+    :param perFrame: also calculate the mean intensity of every region in every frame of a 3d image
+    :returns: a numpy structured array with one record per label, indexed like a table (props['area'])
     """
+    mask = np.asarray(mask)
+    labels = mask.ravel()
+    numLabels = max(labels.max(), 0)
+    Xsize, Ysize = mask.shape
+
+    def perLabel(weights=None):
+        return np.bincount(labels, weights=weights, minlength=numLabels+1)[1:]
+
+    area = perLabel()
+    nonEmpty = area > 0
+
+    pixelIndex = np.arange(labels.size)
+    xs, ys = np.divmod(pixelIndex, Ysize)
+    centroids = np.column_stack([_average(perLabel(xs), area), _average(perLabel(ys), area)])
+
+    fields = [('label', 'int'), ('area', 'int'), ('centroid', 'float', (2,)),
+              ('com', 'float', (2,)), ('boundingBox', 'int', (4,))]
 
     if image is not None:
-        if len(image.shape) >= 3:
+        if image.ndim >= 3:
             meanImage = np.mean(image, axis=2)
         else:
             meanImage = image
+        values = meanImage.ravel().astype('float')
 
-        min = meanImage.min()
-        if min < 0:
-            meanImage -= meanImage.min()
+        # center of mass weights must be non-negative
+        weights = values - min(values.min(), 0)
+        totals = perLabel(weights)
+        coms = np.column_stack([_average(perLabel(weights * xs), totals),
+                                _average(perLabel(weights * ys), totals)])
+        # regions with no weight at all fall back to their centroid
+        coms[totals == 0] = centroids[totals == 0]
 
-        means = pymorph.grain(meanImage, labels=mask, measurement='mean', option='data')
+        means = _average(perLabel(values), area)
+        maxes = np.full(numLabels, np.nan)
+        if nonEmpty.any():
+            maxes[nonEmpty] = nd.maximum(values.reshape(mask.shape), mask, np.flatnonzero(nonEmpty) + 1)
+        fields += [('meanIntensity', 'float'), ('maxIntensity', 'float')]
     else:
-        means = None
-        
-    numLabels = mask.max()
-    centroids = pymorph.blob(mask, measurement='centroid', output='data')
-    boxes = pymorph.blob(mask, measurement='boundingbox', output='data')
-    area = pymorph.blob(mask, measurement='area', output='data')
-
-    coms = []
-    for i in range(1, numLabels+1):
-        coms.append(nd.measurements.center_of_mass(meanImage, labels=mask==i))
-
-    if means is not None:
-        props = [{'meanIntensity':means[i], 'centroid':centroids[i], 'com':coms[i], 'boundingBox':boxes[i], 'area':area[i]} for i in range(numLabels)]
-    else:
-        props = [{'centroid':centroids[i], 'com':coms[i], 'boundingBox':boxes[i], 'area':area[i]} for i in range(numLabels)]
+        coms = centroids
+
+    if perFrame:
+        if image is None or image.ndim != 3:
+            raise ValueError('perFrame needs an X by Y by time image')
+        nFrames = image.shape[2]
+        inRegion = np.flatnonzero(labels > 0)
+        regionMatrix = sparse.csr_matrix((np.ones(inRegion.size), (labels[inRegion] - 1, inRegion)),
+                                         shape=(numLabels, labels.size))
+        frameSums = regionMatrix.dot(image.reshape(labels.size, nFrames))
+        frameMeans = _average(frameSums, area[:, np.newaxis])
+        fields += [('frameMeans', 'float', (nFrames,))]
+
+    boxes = -np.ones((numLabels, 4), dtype='int')
+    for i, objectSlice in enumerate(nd.find_objects(mask, numLabels)):
+        if objectSlice is not None:
+            boxes[i] = [objectSlice[0].start, objectSlice[1].start, objectSlice[0].stop, objectSlice[1].stop]
+
+    props = np.zeros(numLabels, dtype=fields)
+    props['label'] = np.arange(1, numLabels+1)
+    props['area'] = area
+    props['centroid'] = centroids
+    props['com'] = coms
+    props['boundingBox'] = boxes
+    if image is not None:
+        props['meanIntensity'] = means
+        props['maxIntensity'] = maxes
+    if perFrame:
+        props['frameMeans'] = frameMeans
     return props
 
+def _average(sums, counts):
+    """sums / counts, NaN where counts is 0"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
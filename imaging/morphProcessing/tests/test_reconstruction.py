@@ -0,0 +1,113 @@
+"""hybrid_reconstruct gives the same grayscale reconstruction as iterating a
+conditional dilation to stability.  Needs no mahotas or pymorph."""
+import os
+import sys
+
+import numpy as np
+import pytest
+import scipy.ndimage as nd
+
+# the imaging package imports its io routines (IPython, tifffile), so import the module on its own
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from imimposemin import (hybrid_reconstruct, imimposemin, structuring_element,
+                         fast_conditional_dilate, flat_dilate)
+
+def iterated_reconstruction(f, g, Bc):
+    J = np.minimum(f, g)
+    while True:
+        grown = np.minimum(nd.grey_dilation(J, footprint=Bc, mode='nearest'), g)
+        if np.array_equal(grown, J):
+            return J
+        J = grown
+
+def make_images(shape, dtype, seed, smooth):
+    random = np.random.RandomState(seed)
+    g = random.rand(*shape)
+    if smooth:
+        g = nd.gaussian_filter(g, 2)
+    f = np.where(random.rand(*shape) < 0.02, g, g.min() - 1)    # a few markers under g
+    if dtype == 'int':
+        f = np.round(f * 1000).astype(int)
+        g = np.round(g * 1000).astype(int)
+    return f, g
+
+@pytest.mark.parametrize('connectivity', [4, 8])
+@pytest.mark.parametrize('dtype', ['int', 'float'])
+@pytest.mark.parametrize('shape', [(1, 40), (40, 1), (2, 2), (37, 53), (64, 64)])
+@pytest.mark.parametrize('smooth', [False, True])
+@pytest.mark.parametrize('seed', range(3))
+def test_matches_iterated_dilation(connectivity, dtype, shape, smooth, seed):
+    f, g = make_images(shape, dtype, seed, smooth)
+    Bc = structuring_element(connectivity)
+    result = hybrid_reconstruct(f, g, Bc)
+    assert result.dtype == np.minimum(f, g).dtype
+    np.testing.assert_array_equal(result, iterated_reconstruction(f, g, Bc))
+
+def test_marker_above_mask():
+    # every marker pixel above the mask: the reconstruction is the mask itself
+    g = np.random.RandomState(0).randint(0, 50, (20, 30))
+    np.testing.assert_array_equal(hybrid_reconstruct(g + 1, g), g)
+
+def test_long_snake():
+    # a one pixel wide path that doubles back, so the scans alone can't fill it
+    g = np.zeros((21, 21), int)
+    g[::4, 1:-1] = 5
+    g[1::4, -2] = 5
+    g[3::4, 1] = 5
+    f = np.zeros_like(g)
+    f[0, 1] = 5
+    for connectivity in (4, 8):
+        Bc = structuring_element(connectivity)
+        np.testing.assert_array_equal(hybrid_reconstruct(f, g, Bc), iterated_reconstruction(f, g, Bc))
+
+def iterated_erosion_reconstruction(f, g, Bc):
+    # in pure numpy: scipy.ndimage filters go through doubles, which can't hold
+    # the +-9.2e17 markers imimposemin uses exactly
+    rows, cols = f.shape
+    J = np.maximum(f, g)
+    while True:
+        padded = np.pad(J, 1, mode='edge')
+        eroded = np.min([padded[dy:dy + rows, dx:dx + cols] for dy, dx in zip(*np.nonzero(Bc))], axis=0)
+        shrunk = np.maximum(eroded, g)
+        if np.array_equal(shrunk, J):
+            return J
+        J = shrunk
+
+@pytest.mark.parametrize('connectivity', [4, 8])
+def test_imimposemin_is_reconstruction_by_erosion(connectivity):
+    image = np.round(nd.gaussian_filter(np.random.RandomState(1).rand(40, 40), 3) * 1000).astype(int)
+    mask = np.zeros(image.shape, bool)
+    mask[10, 10] = mask[30, 25] = True
+    imposed = imimposemin(image, mask, connectivity)
+
+    fm = np.where(mask, -922337203685477580, 922337203685477580)
+    expected = iterated_erosion_reconstruction(fm, np.minimum(image + 1, fm), structuring_element(connectivity))
+    np.testing.assert_array_equal(imposed, expected)
+    # the marked pixels are the minima, everything else is above the image
+    assert np.all(imposed[mask] == -922337203685477580)
+    assert np.all(imposed[~mask] > image[~mask])
+
+@pytest.mark.parametrize('connectivity', [4, 8])
+def test_flat_dilate(connectivity):
+    f = np.random.RandomState(2).randint(-100, 100, (17, 23))
+    Bc = structuring_element(connectivity)
+    np.testing.assert_array_equal(flat_dilate(f, Bc), nd.grey_dilation(f, footprint=Bc, mode='nearest'))
+
+@pytest.mark.parametrize('connectivity', [4, 8])
+def test_iterative_reference_with_markers(connectivity):
+    # the inputs watershedSegment reconstructs: markers near the int64 limits
+    random = np.random.RandomState(3)
+    image = random.randint(0, 50, (40, 40))
+    mask = random.rand(40, 40) < 0.02
+    fm = np.where(mask, -9223372036854775800, 9223372036854775800)
+    g = np.minimum(image + 1, fm)
+    Bc = structuring_element(connectivity)
+    np.testing.assert_array_equal(hybrid_reconstruct(-fm, -g, Bc), fast_conditional_dilate(-fm, -g, Bc, fm.size))
+
+def test_connectivity_errors():
+    with pytest.raises(ValueError):
+        structuring_element(6)
+    with pytest.raises(ValueError):
+        structuring_element(np.ones((3, 3, 3)))
+    with pytest.raises(ValueError):
+        imimposemin(np.zeros((3, 4, 4)), np.zeros((3, 4, 4), bool))
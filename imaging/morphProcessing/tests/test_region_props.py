@@ -0,0 +1,90 @@
+"""regionProps gives, for every label at once, what measuring each label's
+pixels on their own gives, including labels with no pixels."""
+import os
+import sys
+import warnings
+
+import numpy as np
+import pytest
+
+# the imaging package imports its io routines (IPython, tifffile), so import the module on its own
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from morphProcessingRoutines import regionProps
+
+def make_mask(shape=(30, 40), seed=0):
+    """Labels 1-6 as random rectangles, with label 4 left empty"""
+    random = np.random.RandomState(seed)
+    mask = np.zeros(shape, dtype='int')
+    for label in (1, 2, 3, 5, 6):
+        x, y = random.randint(0, shape[0] - 5), random.randint(0, shape[1] - 5)
+        mask[x:x + random.randint(2, 6), y:y + random.randint(2, 6)] = label
+    return mask
+
+def check_label(props, mask, image, label):
+    row = props[label - 1]
+    assert row['label'] == label
+    xs, ys = np.nonzero(mask == label)
+    assert row['area'] == xs.size
+    if xs.size == 0:
+        assert np.isnan(row['centroid']).all() and np.isnan(row['com']).all()
+        np.testing.assert_array_equal(row['boundingBox'], -1)
+        if image is not None:
+            assert np.isnan(row['meanIntensity']) and np.isnan(row['maxIntensity'])
+        return
+    np.testing.assert_allclose(row['centroid'], [xs.mean(), ys.mean()])
+    np.testing.assert_array_equal(row['boundingBox'], [xs.min(), ys.min(), xs.max() + 1, ys.max() + 1])
+    if image is None:
+        np.testing.assert_allclose(row['com'], row['centroid'])
+        return
+    meanImage = image.mean(axis=2) if image.ndim == 3 else image
+    values = meanImage[xs, ys]
+    np.testing.assert_allclose(row['meanIntensity'], values.mean())
+    np.testing.assert_allclose(row['maxIntensity'], values.max())
+    weights = values - min(meanImage.min(), 0)
+    if weights.sum() > 0:
+        np.testing.assert_allclose(row['com'], [np.average(xs, weights=weights), np.average(ys, weights=weights)])
+    else:
+        np.testing.assert_allclose(row['com'], row['centroid'])
+
+@pytest.mark.parametrize('imageKind', ['none', '2d', '3d', 'negative'])
+def test_matches_per_label(imageKind):
+    mask = make_mask()
+    random = np.random.RandomState(1)
+    image = {'none': None,
+             '2d': random.rand(*mask.shape),
+             '3d': random.rand(mask.shape[0], mask.shape[1], 5),
+             'negative': random.randn(*mask.shape)}[imageKind]
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        props = regionProps(mask, image)
+    assert len(props) == mask.max()
+    for label in range(1, mask.max() + 1):
+        check_label(props, mask, image, label)
+
+def test_zero_weight_com_is_centroid():
+    # label 2 sits on zeros of a non-negative image, so has no weight for its center of mass
+    mask = make_mask()
+    image = np.random.RandomState(2).rand(*mask.shape)
+    image[mask == 2] = 0
+    props = regionProps(mask, image)
+    np.testing.assert_allclose(props['com'][1], props['centroid'][1])
+    for label in range(1, mask.max() + 1):
+        check_label(props, mask, image, label)
+
+def test_per_frame():
+    mask = make_mask()
+    series = np.random.RandomState(3).rand(mask.shape[0], mask.shape[1], 7)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        props = regionProps(mask, series, perFrame=True)
+    for label in range(1, mask.max() + 1):
+        if (mask == label).any():
+            np.testing.assert_allclose(props['frameMeans'][label - 1], series[mask == label].mean(axis=0))
+        else:
+            assert np.isnan(props['frameMeans'][label - 1]).all()
+    with pytest.raises(ValueError):
+        regionProps(mask, series[:, :, 0], perFrame=True)
+
+def test_empty_mask():
+    props = regionProps(np.zeros((5, 5), dtype='int'), np.ones((5, 5)))
+    assert len(props) == 0
@@ -2,6 +2,9 @@ import matplotlib as mpl
 
 from PyQt4 import QtCore, QtGui
 import sys
+import threading
+import Queue
+from collections import OrderedDict
 
 import matplotlib.pyplot as plt
 
@@ -21,7 +24,8 @@ try:
 except ImportError:
     print 'CellPicker:  POLY MODE DISABLED! get nxutils'
 
-from sklearn.decomposition import NMF
+from summaryImages import SummaryImages, traceCorrelationMap
+from roiRegistry import ROIRegistry
 
 import pdb
 
@@ -146,7 +150,59 @@ class MatplotlibWidget(FigureCanvas):
     def mouseDoubleClickEvent(self, event):
         self.setFocus()
         event.accept()
-    
+
+def localNMF(X, nComponents, W=None, H=None, maxIter=200, tol=1e-4, seed=0):
+    """Non-negative matrix factorisation X ~ W.H by hierarchical alternating
+    least squares (HALS), which converges in far fewer iterations than
+    multiplicative or projected gradient updates on small, local problems.
+
+    Either factor can be given to warm start the fit, e.g. with the temporal
+    components H of a fit to a neighbouring patch.  If only H is given, W is
+    started from its least squares projection onto X.
+
+    :param X: non-negative pixels by time array
+    :param nComponents: number of components
+    :param W: optional starting pixels by nComponents array
+    :param H: optional starting nComponents by time array
+    :param maxIter: maximum number of iterations
+    :param tol: stop when the residual improves by less than this fraction
+    :param seed: random seed for the starting factors, if not given
+    :returns: tuple of W and H
+    """
+    X = np.asarray(X, dtype='float')
+    eps = 1e-10
+    scale = np.sqrt(max(X.mean(), eps) / nComponents)
+    random = np.random.RandomState(seed)
+    if H is None:
+        H = random.rand(nComponents, X.shape[1]) * scale
+    else:
+        H = np.array(H, dtype='float')
+    if W is None:
+        W = np.maximum(X.dot(H.T) / np.maximum(np.diag(H.dot(H.T)), eps), eps)
+    else:
+        W = np.array(W, dtype='float')
+
+    normX = np.einsum('ij,ij->', X, X)
+    previous = np.inf
+    for iteration in range(maxIter):
+        XHt = X.dot(H.T)
+        HHt = H.dot(H.T)
+        for k in range(nComponents):
+            W[:, k] = np.maximum(W[:, k] + (XHt[:, k] - W.dot(HHt[:, k])) / max(HHt[k, k], eps), eps)
+
+        WtX = W.T.dot(X)
+        WtW = W.T.dot(W)
+        for k in range(nComponents):
+            H[k] = np.maximum(H[k] + (WtX[k] - WtW[k].dot(H)) / max(WtW[k, k], eps), eps)
+
+        # squared residual, without forming W.H
+        residual = normX - 2 * np.einsum('ij,ij->', H, WtX) + np.einsum('ij,ij->', WtW, H.dot(H.T))
+        if previous - residual < tol * previous:
+            break
+        previous = residual
+
+    return W, H
+
 class CellPickerGUI(object):
     def setupUi(self, MainWindow, data, mask, cutoff):        
         MainWindow.setObjectName("MainWindow")
@@ -155,7 +211,9 @@ class CellPickerGUI(object):
         self.centralwidget = QtGui.QWidget(MainWindow)
         self.centralwidget.setObjectName("centralwidget")
         
-        self.image_widget = MatplotlibWidget(data, parent=self.centralwidget, cutoff=cutoff)
+        # mean, max, std and correlation images of the movie, computed once
+        self.summary = SummaryImages(data)
+        self.image_widget = MatplotlibWidget(self.summary.mean(), parent=self.centralwidget, cutoff=cutoff)
         # note that the widget size is hardcoded in the class (not the best, but at least it's all
         # in the constructor
         
@@ -289,10 +347,10 @@ class CellPickerGUI(object):
             self.currentBackgroundImage = self.data
             self.frame = 1
         elif self.data.ndim ==3:
-            self.currentBackgroundImage = self.data.mean(axis=2)
+            self.currentBackgroundImage = self.summary.mean()
             self.frame = self.data.shape[2]
         
-        self.data_white = self.data / self.data.mean(axis=2)[:,:,None]
+        self.data_white = self.data / self.summary.mean()[:,:,None]
         self.data_white = self.data_white - (self.data_white.mean(axis=0).mean(axis=0))[None,None,:]
 
         # ave/vid slider gui
@@ -361,12 +419,11 @@ class CellPickerGUI(object):
         self.image_widget.c.mouseSingleShiftClicked.connect(self.deleteCell)
         
         if mask is None:
-            self.currentMask = np.zeros_like(self.currentBackgroundImage, dtype='uint16')
+            self.rois = ROIRegistry(shape=self.currentBackgroundImage.shape)
         else:
-            self.currentMask = mask.astype('uint16')
+            self.rois = ROIRegistry(mask)
+        self.currentMask = self.rois.mask
 
-        self.listOfMasks = []
-        self.listOfMasks.append(self.currentMask)
         self.diskSize = 4
         self.contrastThreshold = 0.95
         self.cellRadius = 5
@@ -379,12 +436,22 @@ class CellPickerGUI(object):
         self.maskOn = True
         self.useNMF = True
 
+        # local NMF fits, by patch, and the background fits for the info panel
+        self.nmfCache = OrderedDict()
+        self.nmfCacheSize = 64
+        self.nmfMaxFrames = 500
+        self.nmfLock = threading.Lock()
+        self.nmfResults = Queue.Queue()
+        self.nmfRequest = 0
+        self.nmfTimer = QtCore.QTimer()
+        self.nmfTimer.timeout.connect(self.checkLocalNMF)
+
         self.makeNewMaskAndBackgroundImage()
     
     # ave/vid is clicked
     def avgBoxClicked(self, state):
         if state == QtCore.Qt.Checked:
-            self.currentBackgroundImage = self.data.mean(axis=2)
+            self.currentBackgroundImage = self.summary.mean()
             self.makeNewMaskAndBackgroundImage()
             self.horizontalSlider.setVisible(False)
             self.lineEdit.setVisible(False)
@@ -496,7 +563,7 @@ class CellPickerGUI(object):
         
         elif keyPressed == QtCore.Qt.Key_A:
             if self.checkBox.isChecked == QtCore.Qt.Checked:
-                self.currentBackgroundImage = self.data.mean(axis=2)
+                self.currentBackgroundImage = self.summary.mean()
                 self.makeNewMaskAndBackgroundImage()
                 self.horizontalSlider.setVisible(False)
                 self.lineEdit.setVisible(False)
@@ -511,6 +578,9 @@ class CellPickerGUI(object):
         elif keyPressed == QtCore.Qt.Key_K:
             self.correlateLastROI()
 
+        elif keyPressed == QtCore.Qt.Key_R:
+            self.showLocalCorrelation()
+
         elif keyPressed == QtCore.Qt.Key_I:
             self.updateInfoPanel()
 
@@ -538,33 +608,53 @@ class CellPickerGUI(object):
             self.makeNewMaskAndBackgroundImage()
         else:
             self.maskOn = True
-            self.currentMask = self.listOfMasks[-1].copy()
+            self.currentMask = self.rois.mask
             self.makeNewMaskAndBackgroundImage()
 
     def clearModeData(self):
         self.modeData = []
 
     def lastROI(self):
-        if len(self.listOfMasks) is 0:
-            print 'no mask!'
-            return None
-        elif len(self.listOfMasks) is 1:
+        lastROI = self.rois.lastChange()
+        if lastROI is None:
+            if len(self.rois) is 0:
+                print 'no mask!'
+                return None
             print 'only 1 ROI'
-            lastROI = self.currentMask.copy()
-        else:
-            lastROI = np.logical_xor(self.listOfMasks[-1], self.listOfMasks[-2]) 
+            lastROI = self.rois.mask > 0
         return lastROI
 
     def maskFromROINumber(self, ROI_number=None):
         if ROI_number is None:
             ROI_mask = self.lastROI()
         else:
-            ROI_mask = mahotas.label(self.currentMask)[0] == ROI_number
+            ROI_mask = self.rois.roiMask(ROI_number)
 
         assert(np.any(ROI_mask))
         return ROI_mask
 
 
+    def showLocalCorrelation(self):
+        if self.data.ndim == 2:
+            print 'No series information!'
+            sys.stdout.flush()
+            return None
+        # computed once per movie, on first use
+        self.currentBackgroundImage = self.summary.localCorrelation()
+        self.makeNewMaskAndBackgroundImage()
+
+    def correlateLastROI(self):
+        # show the correlation of every pixel with the last ROI's trace
+        if self.data.ndim == 2:
+            print 'No series information!'
+            sys.stdout.flush()
+            return None
+        ROI_mask = self.lastROI()
+        if ROI_mask is None or not np.any(ROI_mask):
+            return None
+        self.currentBackgroundImage = traceCorrelationMap(self.data, self.timeCourseROI(ROI_mask))
+        self.makeNewMaskAndBackgroundImage()
+
     def timeCourseROI(self, ROI_mask):
         if self.data.ndim ==3:
             nPixels=np.sum(ROI_mask)
@@ -595,7 +685,7 @@ class CellPickerGUI(object):
 
         axes1 = plt.plot(trace)
         axes1[0].get_axes().set_xlim(0, trace.shape[0])
-        axes1[0].get_axes().set_ylim(self.data.min()*0.9, self.max_of_trace*1.1)
+        axes1[0].get_axes().set_ylim(self.summary.min().min()*0.9, self.max_of_trace*1.1)
         axes1[0].get_axes().set_title('Activity Plot')
 
         # Mask display
@@ -623,11 +713,7 @@ class CellPickerGUI(object):
         local_data = self.data[xcenter-box_size:xcenter+box_size, ycenter-box_size:ycenter+box_size, :]
         x,y,frame = local_data.shape
         
-        corr_map = np.empty((x,y))
-        for xv in range(x):
-            for yv in range(y):
-                corr_map[xv,yv] = np.correlate(local_data[xv,yv,:]-local_data[xv,yv,:].mean(), trace-trace.mean())
-       
+        corr_map = traceCorrelationMap(local_data, trace, normalize=False)
         corr_map[np.isnan(corr_map)] = 0
         corr_map = corr_map/corr_map.max()
         
@@ -681,10 +767,55 @@ class CellPickerGUI(object):
         axes9.cla()
         axes9.get_axes().set_yticklabels([])
         axes9.get_axes().set_xticklabels([])
-        
-        modes, thresh_modes, fit_data, this_cell, is_cell, limits = self.doLocalNMF(xcenter, ycenter, ROI_mask, n_comp=4)
+        axes6.get_axes().set_title('fitting modes...')
+
+        # the modes are drawn by showLocalNMF when the fit finishes
+        self.nmfAxes = [axes6, axes7, axes8, axes9]
+        self.startLocalNMF(xcenter, ycenter, ROI_mask, n_comp=4)
 
-        for i, (mode, fit_d, t, is_a_cell, ax) in enumerate(zip(modes, fit_data, this_cell, is_cell, [axes6, axes7, axes8, axes9])):
+        plt.draw()
+
+    def startLocalNMF(self, x, y, roi, n_comp=4):
+        # fit in a background thread, so the gui stays responsive.
+        # only the result of the latest request is shown.
+        self.nmfRequest += 1
+        request = self.nmfRequest
+
+        def fit():
+            try:
+                result = self.doLocalNMF(x, y, roi, n_comp=n_comp)
+            except Exception, e:
+                print 'local NMF failed: %s' % e
+                sys.stdout.flush()
+                result = None
+            self.nmfResults.put((request, result))
+
+        thread = threading.Thread(target=fit)
+        thread.daemon = True
+        thread.start()
+        self.nmfTimer.start(100)
+
+    def checkLocalNMF(self):
+        # polled by nmfTimer in the gui thread, which does all the drawing
+        while True:
+            try:
+                request, result = self.nmfResults.get_nowait()
+            except Queue.Empty:
+                break
+            if request == self.nmfRequest:
+                self.nmfTimer.stop()
+                if result is not None:
+                    self.showLocalNMF(result)
+
+    def showLocalNMF(self, result):
+        modes, thresh_modes, fit_data, this_cell, is_cell, limits = result
+
+        for ax in self.nmfAxes:
+            ax.cla()
+            ax.get_axes().set_yticklabels([])
+            ax.get_axes().set_xticklabels([])
+
+        for i, (mode, fit_d, t, is_a_cell, ax) in enumerate(zip(modes, fit_data, this_cell, is_cell, self.nmfAxes)):
             ax.imshow(np.flipud(mode))
 
             ax.set_xlim(0,mode.shape[0])
@@ -745,17 +876,11 @@ class CellPickerGUI(object):
             if np.any(np.logical_and(poly_mask, self.currentMask)):
                 return None
 
-            self.currentMask = self.currentMask.astype('uint16')
-
             # need center of mass for polygon
 #            center_of_mass = scipy.ndimage.measurements.center_of_mass(poly_mask)
 
             # add poly_mask to mask
-            newMask = (poly_mask * self.currentMaskNumber) + self.currentMask
-            newMask = newMask.astype('uint16')
-
-            self.listOfMasks.append(newMask)
-            self.currentMask = self.listOfMasks[-1]
+            self.rois.addROI(poly_mask, self.currentMaskNumber)
 
             sys.stdout.flush()
             self.makeNewMaskAndBackgroundImage()
@@ -775,18 +900,12 @@ class CellPickerGUI(object):
     @QtCore.Slot(tuple)
     def addCell(self, eventTuple):
         if self.maskOn:
-            if self.data.ndim == 2:
-                self.aveData = self.data.copy()
-            else:
-                self.aveData = self.data.mean(axis = 2)
+            self.aveData = self.summary.mean()
 
             x, y = eventTuple
             localValue = self.currentMask[x,y]
             print str(self.mode) + ' ' + 'x: ' + str(x) + ', y: ' + str(y) + ', mask val: ' + str(localValue) 
 
-            # ensure mask is uint16
-            self.currentMask = self.currentMask.astype('uint16')
-
             sys.stdout.flush()
 
             ########## NORMAL MODE 
@@ -794,24 +913,11 @@ class CellPickerGUI(object):
                 if localValue > 0 and localValue != self.currentMaskNumber:
                     print 'we are altering mask at at %d, %d' % (x, y)
 
-                    # copy the old mask
-                    newMask = self.currentMask.copy()
-
-                    # make a labeled image of the current mask
-                    labeledCurrentMask = mahotas.label(newMask)[0]
-                    roiNumber = labeledCurrentMask[x, y]
-
-                    # set that ROI to zero
-                    newMask[labeledCurrentMask == roiNumber] = self.currentMaskNumber
-                    newMask = newMask.astype('uint16')
-
-                    self.listOfMasks.append(newMask)
-                    self.currentMask = self.listOfMasks[-1]
+                    # set that ROI to the current mask number
+                    self.rois.recolorROI(self.rois.labelAt(x, y), self.currentMaskNumber)
                 elif localValue > 0 and self.data.ndim ==3:
                     # update info panel
-                    labeledCurrentMask = mahotas.label(self.currentMask.copy())[0]
-                    roiNumber = labeledCurrentMask[x, y]
-                    self.updateInfoPanel(ROI_number=roiNumber)
+                    self.updateInfoPanel(ROI_number=self.rois.labelAt(x, y))
 
                 elif localValue == 0:
 
@@ -865,11 +971,7 @@ class CellPickerGUI(object):
                     newCell[mahotas.dilate(self.currentMask>0)] = 0
                     newCell = self.excludePixels(newCell, 10)
 
-                    newMask = (newCell * self.currentMaskNumber) + self.currentMask
-                    newMask = newMask.astype('uint16')
-
-                    self.listOfMasks.append(newMask.copy())
-                    self.currentMask = newMask.copy()
+                    self.rois.addROI(newCell, self.currentMaskNumber)
 
             elif self.mode is 'OGB':
                 # build structuring elements
@@ -905,11 +1007,7 @@ class CellPickerGUI(object):
                 modes, thresh_modes, fit_data, this_cell, is_cell, limits = self.doLocaNMF(x,y)
 
                 newCell = np.logical_and(dilateMean, safeUnselected)
-                newMask = (newCell * self.currentMaskNumber) + self.currentMask
-                newMask = newMask.astype('uint16')
-
-                self.listOfMasks.append(newMask.copy())
-                self.currentMask = newMask.copy()
+                self.rois.addROI(newCell, self.currentMaskNumber)
 
             ########## SQUARE MODE 
             elif self.mode is 'square':
@@ -929,11 +1027,7 @@ class CellPickerGUI(object):
                         return None
 
                     # add square_mask to mask
-                    newMask = (square_mask * self.currentMaskNumber) + self.currentMask
-                    newMask = newMask.astype('uint16')
-
-                    self.listOfMasks.append(newMask)
-                    self.currentMask = self.listOfMasks[-1]
+                    self.rois.addROI(square_mask, self.currentMaskNumber)
 
                     # clear current mode data
                     self.clearModeData()
@@ -961,13 +1055,7 @@ class CellPickerGUI(object):
                     return None
 
                 # add circle_mask to mask
-                newMask = (circle_mask * self.currentMaskNumber) + self.currentMask
-                newMask = newMask.astype('uint16')
-
-
-
-                self.listOfMasks.append(newMask)
-                self.currentMask = self.listOfMasks[-1]
+                self.rois.addROI(circle_mask, self.currentMaskNumber)
 
             ########## POLY MODE 
             elif self.mode is 'poly':
@@ -980,17 +1068,12 @@ class CellPickerGUI(object):
     def excludePixels(self, image, size_cutoff=1):
         labeled_image = mahotas.label(image)[0]
 
-        for label_id in range(labeled_image.max()+1):
-            label_id_index = labeled_image == label_id
-            if label_id_index.sum() <= size_cutoff:
-                labeled_image[label_id_index] = 0
-
-        return labeled_image>0
-
-    def doLocalNMF(self, x, y, roi, n_comp=7, diskSizeMultiplier=3):
-        # do NMF decomposition
-        n = NMF(n_components=n_comp, tol=1e-1)
+        # keep the labels with more than size_cutoff pixels
+        keep = np.bincount(labeled_image.ravel()) > size_cutoff
+        keep[0] = False
+        return keep[labeled_image]
 
+    def doLocalNMF(self, x, y, roi, n_comp=7, diskSizeMultiplier=3, timeBin=None):
         xmin_nmf = max(0,int(x - self.diskSize*diskSizeMultiplier))
         xmax_nmf = min(int(x + self.diskSize*diskSizeMultiplier), self.data.shape[0])
         ymin_nmf = max(0, int(y - self.diskSize*diskSizeMultiplier))
@@ -999,10 +1082,10 @@ class CellPickerGUI(object):
         xcenter_nmf = (xmax_nmf - xmin_nmf) / 2
         ycenter_nmf = (ymax_nmf - ymin_nmf) / 2
 
-        reshaped_sub_region_data = self.data_white[xmin_nmf:xmax_nmf, ymin_nmf:ymax_nmf, :].reshape(xmax_nmf-xmin_nmf * ymax_nmf-ymin_nmf, self.data.shape[2])
-        n.fit(reshaped_sub_region_data-reshaped_sub_region_data.min())
-        transformed_sub_region_data = n.transform(reshaped_sub_region_data-reshaped_sub_region_data.min())
-        modes = transformed_sub_region_data.reshape(xmax_nmf-xmin_nmf, ymax_nmf-ymin_nmf, n_comp).copy()
+        # do NMF decomposition
+        limits = (xmin_nmf, xmax_nmf, ymin_nmf, ymax_nmf)
+        W = self.localFactorization(limits, n_comp, timeBin)
+        modes = W.reshape(xmax_nmf-xmin_nmf, ymax_nmf-ymin_nmf, n_comp).copy()
 
         modes = [m for m in np.rollaxis(modes,2,0)]
         params = []
@@ -1054,6 +1137,48 @@ class CellPickerGUI(object):
 
         return modes, thresh_modes, fit_data, np.array(this_cell), np.array(is_cell), (xmin_nmf, xmax_nmf, ymin_nmf, ymax_nmf)
     
+    def localFactorization(self, limits, n_comp, timeBin=None):
+        """Spatial NMF components (pixels by n_comp) of the whitened data in a patch.
+
+        The patch time courses are averaged in bins of timeBin frames (by
+        default, enough to leave at most nmfMaxFrames bins).  Fits are cached
+        by patch, and a new patch is warm started from the temporal
+        components of the nearest cached fit that overlaps it.
+        """
+        xmin, xmax, ymin, ymax = limits
+        nFrames = self.data_white.shape[2]
+        if timeBin is None:
+            timeBin = max(1, int(np.ceil(nFrames / float(self.nmfMaxFrames))))
+
+        key = (limits, n_comp, timeBin)
+        with self.nmfLock:
+            if key in self.nmfCache:
+                return self.nmfCache[key][0]
+
+            # nearest overlapping patch fitted the same way
+            H = None
+            nearest = np.inf
+            for (otherLimits, otherComp, otherBin), (otherW, otherH) in self.nmfCache.items():
+                if otherComp != n_comp or otherBin != timeBin:
+                    continue
+                if otherLimits[0] >= xmax or otherLimits[1] <= xmin or otherLimits[2] >= ymax or otherLimits[3] <= ymin:
+                    continue
+                distance = np.hypot(otherLimits[0] - xmin, otherLimits[2] - ymin)
+                if distance < nearest:
+                    nearest = distance
+                    H = otherH
+
+        nBins = nFrames // timeBin
+        patch = np.asarray(self.data_white[xmin:xmax, ymin:ymax, :nBins*timeBin], dtype='float')
+        patch = patch.reshape((xmax-xmin) * (ymax-ymin), nBins, timeBin).mean(axis=2)
+        W, H = localNMF(patch - patch.min(), n_comp, H=H)
+
+        with self.nmfLock:
+            self.nmfCache[key] = (W, H)
+            while len(self.nmfCache) > self.nmfCacheSize:
+                self.nmfCache.popitem(last=False)
+        return W
+
     @QtCore.Slot(tuple)
     def deleteCell(self, eventTuple):
         x, y = eventTuple
@@ -1064,27 +1189,15 @@ class CellPickerGUI(object):
         if self.currentMask[x,y] > 0:
             #print 'we are deleting at %d, %d' % (x, y)
             
-            # copy the old mask
-            newMask = self.currentMask.copy()
-
-            #make a labeled image of the current mask
-            labeledCurrentMask = mahotas.label(newMask)[0]
-            roiNumber = labeledCurrentMask[x, y]
-            
             # set that ROI to zero
-            newMask[labeledCurrentMask == roiNumber] = 0
-            
-            self.listOfMasks.append(newMask)
-            self.currentMask = self.listOfMasks[-1]
+            self.rois.removeROI(self.rois.labelAt(x, y))
 
         sys.stdout.flush()
         self.makeNewMaskAndBackgroundImage()
     
     # go back to the previous mask
     def revert(self):
-        if len(self.listOfMasks) > 1:
-            self.listOfMasks.pop()
-            self.currentMask = self.listOfMasks[-1]
+        if self.rois.undo():
             self.makeNewMaskAndBackgroundImage()
         else:
             print 'No current mask!'
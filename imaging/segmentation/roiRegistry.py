@@ -0,0 +1,183 @@
+# incremental ROI bookkeeping for CellPicker masks
+import numpy as np
+import scipy.ndimage as nd
+
+__all__ = ['ROIRegistry']
+
+# 4-connected, as mahotas.label and scipy.ndimage.label use by default
+_connectivity = nd.generate_binary_structure(2, 1)
+
+class ROIRegistry(object):
+    """Incremental bookkeeping of the ROIs in a CellPicker mask.
+
+    Keeps the mask (uint16, 0 in the background and 1-8 for the feature the
+    ROI belongs to) together with a label image, and the flat pixel indices
+    and bounding box of each ROI, so that looking up, adding, recolouring or
+    deleting an ROI only touches that ROI's pixels instead of relabelling the
+    whole mask.
+
+    An ROI is a 4-connected component of the nonzero mask, whatever the
+    feature values, as if the mask was relabelled after every change: pixels
+    added touching an existing ROI join it, and pixels joining two ROIs merge
+    them.  So a mask gives the same ROIs while it is being drawn as after it
+    is saved and loaded again.  Only the label numbers can differ, as new
+    ROIs are numbered in the order they were drawn.
+
+    Undo is a log of diffs rather than full mask snapshots.  Each step is a
+    list of (pixel indices, old values, new values, old labels, new labels)
+    changes, so the memory used by the history scales with the size of the
+    edited ROIs.
+
+    :param mask: optional starting mask (2d array).  Its connected components
+                 become the starting ROIs (the only full labelling done).
+    :param shape: shape of an empty mask, if mask is None
+    """
+    def __init__(self, mask=None, shape=None):
+        if mask is None:
+            mask = np.zeros(shape, dtype='uint16')
+        self.mask = np.array(mask, dtype='uint16')
+        self.labels = np.zeros(self.mask.shape, dtype='int32')
+        self.pixels = {}
+        self.boxes = {}
+        self.history = []
+        self.nextLabel = 1
+
+        startingLabels, nROIs = nd.label(self.mask > 0, structure=_connectivity)
+        self.labels[:] = startingLabels
+        if nROIs:
+            order = np.argsort(startingLabels.ravel(), kind='mergesort')
+            counts = np.bincount(startingLabels.ravel(), minlength=nROIs + 1)
+            splits = np.cumsum(counts)[:-1]
+            for label, indices in enumerate(np.split(order, splits)[1:], 1):
+                self._register(label, indices)
+            self.nextLabel = nROIs + 1
+
+    def __len__(self):
+        return len(self.pixels)
+
+    def labelAt(self, x, y):
+        """Label of the ROI at x, y, 0 for the background"""
+        return int(self.labels[x, y])
+
+    def roiMask(self, label):
+        """Full size boolean mask of one ROI"""
+        roi = np.zeros(self.mask.shape, dtype=bool)
+        roi.flat[self.pixels[label]] = True
+        return roi
+
+    def addROI(self, newCell, value):
+        """Add the pixels of newCell that are not already in an ROI.
+
+        Each connected component of the new pixels becomes an ROI, unless it
+        touches existing ROIs: then it joins them (merging them, if it touches
+        more than one) under the lowest of their labels.  Existing pixels keep
+        their mask values.
+
+        :param newCell: full size boolean mask of the pixels to add
+        :param value: mask value (feature number) of the new pixels
+        :returns: list of the labels of the new or grown ROIs, in one undo step
+        """
+        indices = np.flatnonzero(newCell)
+        indices = indices[self.mask.flat[indices] == 0]
+        if indices.size == 0 or value == 0:
+            return []
+
+        # work in the bounding box of the new pixels, grown by one to see their neighbours
+        xs, ys = np.unravel_index(indices, self.mask.shape)
+        xstart, ystart = max(xs.min() - 1, 0), max(ys.min() - 1, 0)
+        xstop, ystop = min(xs.max() + 2, self.mask.shape[0]), min(ys.max() + 2, self.mask.shape[1])
+        new = np.zeros((xstop - xstart, ystop - ystart), dtype=bool)
+        new[xs - xstart, ys - ystart] = True
+        boxLabels = self.labels[xstart:xstop, ystart:ystop]
+        components, nComponents = nd.label(new, structure=_connectivity)
+
+        # the existing ROIs each component touches.  Components touching the
+        # same ROI end up in one ROI, so group them by the ROIs they share
+        groups = {}     # component or ROI -> the set of components and ROIs it is joined to
+        for component in range(1, nComponents + 1):
+            touching = nd.binary_dilation(components == component, structure=_connectivity)
+            neighbours = set(np.unique(boxLabels[touching & (boxLabels > 0)]))
+            group = set([('component', component)]) | set(('roi', label) for label in neighbours)
+            for member in list(group):
+                if member in groups:
+                    group |= groups[member]
+            for member in group:
+                groups[member] = group
+
+        step = []
+        added = []
+        componentOfPixel = components[xs - xstart, ys - ystart]
+        for component in range(1, nComponents + 1):
+            group = groups[('component', component)]
+            if min(c for kind, c in group if kind == 'component') != component:
+                continue    # added with the first component of its group
+            rois = sorted(label for kind, label in group if kind == 'roi')
+            if rois:
+                label = rois[0]
+            else:
+                label = self.nextLabel
+                self.nextLabel += 1
+            members = [c for kind, c in group if kind == 'component']
+            step.append(self._change(indices[np.in1d(componentOfPixel, members)], label, value))
+            for other in rois[1:]:
+                step.append(self._change(self.pixels[other], label))
+            added.append(label)
+        self.history.append(step)
+        return added
+
+    def recolorROI(self, label, value):
+        """Set the mask value of every pixel in an ROI, in one undo step"""
+        indices = self.pixels[label]
+        self.history.append([self._change(indices, label, value)])
+
+    def removeROI(self, label):
+        """Delete an ROI, in one undo step"""
+        indices = self.pixels[label]
+        self.history.append([self._change(indices, 0, 0)])
+
+    def undo(self):
+        """Revert the last step.  Returns False if there was nothing to undo."""
+        if not self.history:
+            return False
+        for indices, oldValues, newValues, oldLabels, newLabels in reversed(self.history.pop()):
+            self._apply(indices, oldValues, oldLabels)
+        return True
+
+    def lastChange(self):
+        """Boolean mask of the pixels changed by the last step, or None"""
+        if not self.history:
+            return None
+        changed = np.zeros(self.mask.shape, dtype=bool)
+        for change in self.history[-1]:
+            changed.flat[change[0]] = True
+        return changed
+
+    def _change(self, indices, label, value=None):
+        """Give the pixels at indices a label (0 to clear them) and, if given,
+        a new mask value.  Returns the change, for the undo log."""
+        oldValues = self.mask.flat[indices]
+        oldLabels = self.labels.flat[indices]
+        newValues = oldValues.copy() if value is None else np.full(indices.size, value, dtype='uint16')
+        newLabels = np.full(indices.size, label, dtype='int32')
+        self._apply(indices, newValues, newLabels)
+        return (indices, oldValues, newValues, oldLabels, newLabels)
+
+    def _apply(self, indices, values, labels):
+        affected = set(np.unique(self.labels.flat[indices])) | set(np.unique(labels))
+        affected.discard(0)
+        self.mask.flat[indices] = values
+        self.labels.flat[indices] = labels
+        for label in affected:
+            kept = self.pixels.get(label, np.zeros(0, dtype=indices.dtype))
+            kept = kept[self.labels.flat[kept] == label]
+            roiIndices = np.union1d(kept, indices[labels == label])
+            if roiIndices.size:
+                self._register(label, roiIndices)
+            else:
+                del self.pixels[label]
+                del self.boxes[label]
+
+    def _register(self, label, indices):
+        xs, ys = np.unravel_index(indices, self.mask.shape)
+        self.pixels[label] = indices
+        self.boxes[label] = (xs.min(), ys.min(), xs.max() + 1, ys.max() + 1)
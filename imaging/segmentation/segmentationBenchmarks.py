@@ -0,0 +1,128 @@
+# speed / correctness benchmarks for the segmentation routines
+"""
+Benchmarks watershedSegment on synthetic cell fields, comparing the queue based
+(hybrid) grayscale reconstruction used to impose the minima against the
+iterative conditional dilation it replaced.  Both must give identical masks.
+Some mahotas versions (1.4.11 at least) return uninitialised memory in the
+lines image of cwatershed(..., return_lines=True), which watershedSegment
+uses for the background markers, so there two runs of the same method can
+differ too.
+
+The minima used not to be imposed at all (reconstruction='none'), so the
+benchmark also reports how much the segmentation differs from that: the
+number of cells found without the reconstruction, and the fraction of
+pixels whose label changed.
+
+>>> results = benchmarkWatershed(imageSizes=(128, 256))  # doctest: +SKIP
+>>> printResults(results)  # doctest: +SKIP
+
+or from the shell: python segmentationBenchmarks.py
+"""
+import numpy as np
+import scipy.ndimage as nd
+import time
+
+from segmentationRoutines import watershedSegment
+
+__all__ = ['makeSyntheticCells', 'benchmarkWatershed', 'printResults']
+
+def makeSyntheticCells(imageSize=256, nCells=None, cellRadius=6, noise=0.05, seed=None):
+    """Make a synthetic field of cells, like a mean image of a GCaMP movie.
+
+    Cells are bright discs of varying brightness on a smooth, dimmer neuropil
+    background, blurred slightly and with gaussian noise added.
+
+    :param imageSize: the image is imageSize by imageSize
+    :param nCells: number of cells, defaults to covering about a quarter of the field
+    :param cellRadius: mean cell radius in pixels
+    :param noise: standard deviation of the noise, relative to the mean cell brightness
+    :param seed: optional random seed
+    :returns: tuple of the image (2d float array) and the true labeled cell mask
+    """
+    random = np.random.RandomState(seed)
+    if nCells is None:
+        nCells = int(0.25 * imageSize * imageSize / (np.pi * cellRadius * cellRadius))
+
+    x, y = np.indices((imageSize, imageSize))
+    labels = np.zeros((imageSize, imageSize), dtype='int')
+    image = np.zeros((imageSize, imageSize))
+    for cell in range(1, nCells + 1):
+        cx, cy = random.uniform(cellRadius, imageSize - cellRadius, 2)
+        radius = cellRadius * random.uniform(0.7, 1.3)
+        disc = (x - cx) ** 2 + (y - cy) ** 2 <= radius ** 2
+        labels[disc & (labels == 0)] = cell
+        image[disc] = np.maximum(image[disc], random.uniform(0.5, 1.5))
+
+    background = nd.gaussian_filter(random.rand(imageSize, imageSize), imageSize / 16.)
+    background = 0.2 * (background - background.min()) / (np.ptp(background) + 1e-12)
+    image = nd.gaussian_filter(image, 1) + background
+    image += random.randn(imageSize, imageSize) * noise
+    return image, labels
+
+def benchmarkWatershed(imageSizes=(128, 256, 512), cellRadius=6, diskSize=None, repeat=1, seed=0, verbose=True):
+    """Time watershedSegment with both reconstructions on synthetic cell fields.
+
+    :param imageSizes: image sizes to run
+    :param cellRadius: mean cell radius in pixels
+    :param diskSize: diskSize passed to watershedSegment, defaults to cellRadius
+    :param repeat: number of timing repeats (the best is kept)
+    :param seed: random seed for the synthetic images
+    :param verbose: print each result as it is measured
+    :returns: list of dicts with the image size, number of cells, seconds per method,
+              speedup, whether the two label images are identical, and the number of
+              cells and fraction of changed pixels without the reconstruction
+    """
+    if diskSize is None:
+        diskSize = cellRadius
+
+    results = []
+    for imageSize in imageSizes:
+        image, trueLabels = makeSyntheticCells(imageSize, cellRadius=cellRadius, seed=seed)
+        # watershedSegment expects an integer valued image, as from a (16 bit) tiff.
+        # mahotas' otsu needs a small range, and 64 bit ints overflow in mahotas.open
+        image = np.round((image - image.min()) * 1000).astype('uint16')
+
+        seconds = {}
+        segmented = {}
+        for method in ('hybrid', 'iterative'):
+            best = np.inf
+            for i in range(repeat):
+                start = time.time()
+                segmented[method] = watershedSegment(image, diskSize=diskSize, reconstruction=method)[1]
+                best = min(best, time.time() - start)
+            seconds[method] = best
+
+        unimposed = watershedSegment(image, diskSize=diskSize, reconstruction='none')[1]
+
+        result = {'imageSize': imageSize,
+                  'nCells': trueLabels.max(),
+                  'nSegmented': len(np.unique(segmented['hybrid'])) - 1,
+                  'hybridSeconds': seconds['hybrid'],
+                  'iterativeSeconds': seconds['iterative'],
+                  'speedup': seconds['iterative'] / seconds['hybrid'],
+                  'identical': np.array_equal(segmented['hybrid'], segmented['iterative']),
+                  'nUnimposed': len(np.unique(unimposed)) - 1,
+                  'changedFraction': np.mean((segmented['hybrid'] > 0) != (unimposed > 0))}
+        results.append(result)
+        if verbose:
+            printResults([result], header=len(results) == 1)
+    return results
+
+def printResults(results, header=True):
+    """Print the results of benchmarkWatershed as a table
+
+    :param results: list of dicts from benchmarkWatershed
+    :param header: print the column names
+    """
+    if header:
+        print '%10s %8s %10s %12s %14s %8s %10s %11s %8s' % ('imageSize', 'nCells', 'nSegmented',
+                                                           'hybrid (s)', 'iterative (s)', 'speedup', 'identical',
+                                                           'nUnimposed', 'changed')
+    for r in results:
+        print '%10i %8i %10i %12.3f %14.3f %8.1f %10s %11i %8.3f' % (r['imageSize'], r['nCells'], r['nSegmented'],
+                                                                  r['hybridSeconds'], r['iterativeSeconds'],
+                                                                  r['speedup'], r['identical'],
+                                                                  r['nUnimposed'], r['changedFraction'])
+
+if __name__ == '__main__':
+    benchmarkWatershed()
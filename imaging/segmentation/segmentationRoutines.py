@@ -6,14 +6,23 @@ import mahotas
 import scipy.stats as stats
 import scipy.signal as sig
 import scipy.ndimage as nd
+import scipy.sparse as sparse
+
+import multiprocessing as mp
 
 from CellPicker import pickCells
+from summaryImages import *
 
 __all__ = ['pickCells', 'extractTimeCoursesFromSeries', 
-           'extractTimeCoursesFromStack', 'avgFromROIInSeries', 
-           'avgFromROIInStack', 'allPixelsFromROIInSeries', 'watershedSegment']
-
-def extractTimeCoursesFromSeries(imageSeries, mask):
+           'extractTimeCoursesFromStack', 'extractTimeCoursesFromTiffs',
+           'extractTimeCoursesWithMatrix',
+           'roiMatrix', 'neuropilMatrix', 'avgFromROIInSeries', 
+           'avgFromROIInStack', 'allPixelsFromROIInSeries', 
+           'allPixelsFromROIsInSeries', 'watershedSegment',
+           'tiledWatershedSegment', 'segmentPlanes',
+           'SummaryImages', 'traceCorrelationMap', 'localCorrelationImage']
+
+def extractTimeCoursesFromSeries(imageSeries, mask, **kwargs):
     """Get timecourses of stack regions defined by a index 2-D array
 
     Really just a wrapper around extractTimeCoursesFromStack
@@ -24,33 +33,246 @@ def extractTimeCoursesFromSeries(imageSeries, mask):
 
     :param series: X by Y by time
     :param mask: 2-D labeled image of cell masks
-    :returns: numobjects by time numpy array
+    :param kwargs: passed on to extractTimeCoursesFromStack
+    :returns: numobjects by time numpy array (a tuple of two if neuropilRadii is given)
     """
-    return np.squeeze(extractTimeCoursesFromStack(np.expand_dims(imageSeries, axis=3), mask))
+    traces = extractTimeCoursesFromStack(np.expand_dims(imageSeries, axis=3), mask, **kwargs)
+    if isinstance(traces, tuple):
+        return tuple(np.squeeze(t) for t in traces)
+    return np.squeeze(traces)
     
-def extractTimeCoursesFromStack(imageStack, mask):
+def extractTimeCoursesFromStack(imageStack, mask, weights=None, neuropilRadii=None, framesPerBlock=500):
     """Get timecourses of stack regions defined by a index 2-D array
 
-    Returns a N by time by trial numpy array where N is the number of objects
-    in labelImage.
-
-    :param stack: X by Y by time by trial
-    :param labelImage: 2-D labeled image of cell masks
-    :returns: traces: a time by numobjects by trial numpy array
+    Returns a time by N by trial numpy array where N is the number of objects
+    in mask, plus one: column i is object i (label i, or footprint i-1) and
+    column 0 is the unlabeled background (empty for footprints).
+
+    All objects are extracted at once: the mask is turned into a sparse
+    object by pixel matrix (see roiMatrix) and the stack is streamed through
+    it framesPerBlock frames at a time (see extractTimeCoursesWithMatrix), so
+    memmapped stacks are never loaded whole.
+
+    :param imageStack: X by Y by time by trial (an array, memmap, or anything that can be sliced like one)
+    :param mask: 2-D labeled image of cell masks, or an X by Y by N array of weighted footprints
+    :param weights: optional X by Y array of per pixel weights for a labeled mask (not footprints)
+    :param neuropilRadii: optional (inner, outer) radii, in pixels, of a neuropil annulus around each object
+    :param framesPerBlock: number of frames (per trial) read from the stack at once
+    :returns: traces: a time by numobjects by trial numpy array.  If neuropilRadii
+              is given, a tuple of the traces and the neuropil traces (same shape),
+              both computed in a single pass over the stack.
     """
 
+    matrix = roiMatrix(mask, weights=weights)
+    nObjects = matrix.shape[0]
+
+    if neuropilRadii is not None:
+        if mask.ndim != 2:
+            raise ValueError('neuropilRadii needs a labeled mask, not footprints')
+        innerRadius, outerRadius = neuropilRadii
+        matrix = sparse.vstack([matrix, neuropilMatrix(mask, innerRadius, outerRadius)]).tocsr()
+
+    traces = extractTimeCoursesWithMatrix(imageStack, matrix, framesPerBlock=framesPerBlock)
+
+    if neuropilRadii is not None:
+        return traces[:, :nObjects, :], traces[:, nObjects:, :]
+    return traces
+
+def extractTimeCoursesWithMatrix(imageStack, matrix, framesPerBlock=500):
+    """Get timecourses of arbitrary weighted pixel sets with one sparse matrix
+    product per block of frames.
+
+    Row i of the result is matrix[i,:] dotted with the flattened (C order)
+    frame, so a row normalized matrix from roiMatrix or neuropilMatrix gives
+    the (weighted) mean of each object.
+
+    :param imageStack: X by Y by time by trial (an array, memmap, or anything that can be sliced like one)
+    :param matrix: sparse (or dense) nRows by X*Y matrix
+    :param framesPerBlock: number of frames (per trial) read from the stack at once
+    :returns: traces: a time by nRows by trial numpy array
+    """
     Xsize, Ysize, nTimePoints, nTrials = imageStack.shape
+    nRows = matrix.shape[0]
+    if matrix.shape[1] != Xsize * Ysize:
+        raise ValueError('matrix must have one column per pixel')
 
-    objectLabels = set(mask.ravel())
-    nObjects = max(objectLabels) + 1
-    traces = np.zeros((nTimePoints, nObjects, nTrials))
+    traces = np.zeros((nTimePoints, nRows, nTrials))
+    for start in range(0, nTimePoints, framesPerBlock):
+        stop = min(start + framesPerBlock, nTimePoints)
+        block = np.asarray(imageStack[:, :, start:stop, :])
+        values = matrix.dot(block.reshape(Xsize * Ysize, -1))
+        traces[start:stop] = values.reshape(nRows, stop - start, nTrials).transpose(1, 0, 2)
 
-    for obj in objectLabels:
-        index = mask == obj
-        traces[:, obj, :] = avgFromROIInStack(imageStack, index)
+    return traces
 
+def extractTimeCoursesFromTiffs(filenameList, mask, xShifts=None, yShifts=None, weights=None,
+                                neuropilRadii=None, asTrials=False, framesPerBlock=500, prefetch=True):
+    """Get timecourses of regions defined by a index 2-D array, straight from tiff files.
+
+    The movie is never loaded: blocks of frames are read from the files (see
+    imaging.io.imreadBlocks, which reads the next block in a background thread
+    while the current one is reduced), optionally registered, reduced to ROI
+    means with one sparse matrix product (see roiMatrix) and discarded.  Peak
+    memory is a few blocks no matter how long the session is.
+
+    :param filenameList: list of tiff files, in order
+    :param mask: 2-D labeled image of cell masks, or an X by Y by N array of weighted footprints
+    :param xShifts: optional per frame x shifts (over all files), as returned by register_series
+    :param yShifts: optional per frame y shifts (over all files), as returned by register_series
+    :param weights: optional X by Y array of per pixel weights for a labeled mask (not footprints)
+    :param neuropilRadii: optional (inner, outer) radii, in pixels, of a neuropil annulus around each object
+    :param asTrials: treat each file as a trial (all files must have the same number of frames)
+    :param framesPerBlock: number of frames read at once
+    :param prefetch: read the next block in a background thread
+    :returns: traces: a time by numobjects numpy array over the concatenated files, or
+              a time by numobjects by trial array if asTrials.  If neuropilRadii
+              is given, a tuple of the traces and the neuropil traces.
+    """
+    from imaging.io import imreadBlocks
+
+    matrix = roiMatrix(mask, weights=weights)
+    nObjects = matrix.shape[0]
+    if neuropilRadii is not None:
+        if mask.ndim != 2:
+            raise ValueError('neuropilRadii needs a labeled mask, not footprints')
+        innerRadius, outerRadius = neuropilRadii
+        matrix = sparse.vstack([matrix, neuropilMatrix(mask, innerRadius, outerRadius)]).tocsr()
+
+    if (xShifts is None) != (yShifts is None):
+        raise ValueError('give both xShifts and yShifts, or neither')
+    if xShifts is not None:
+        from image_registration.fft_tools import shift_stack
+
+    nPixels = matrix.shape[1]
+    traces = [[] for fileName in filenameList]
+    frame = 0
+    for fileIndex, start, block in imreadBlocks(filenameList, framesPerBlock=framesPerBlock, prefetch=prefetch):
+        nFrames = block.shape[0]
+        if block.shape[1:] != mask.shape[:2]:
+            raise ValueError('mask and images must have the same shape')
+
+        if xShifts is not None:
+            # the same registration register_series applies
+            registered = shift_stack(np.transpose(block, [1, 2, 0]),
+                                     -np.asarray(xShifts[frame:frame + nFrames]),
+                                     -np.asarray(yShifts[frame:frame + nFrames]))
+            pixels = registered.reshape(nPixels, nFrames)
+        else:
+            pixels = block.reshape(nFrames, nPixels).T
+
+        traces[fileIndex].append(matrix.dot(pixels).T)
+        frame += nFrames
+
+    traces = [np.concatenate(fileTraces) for fileTraces in traces]
+    if asTrials:
+        if len(set(t.shape[0] for t in traces)) > 1:
+            raise ValueError('all files must have the same number of frames to be trials')
+        traces = np.dstack(traces)
+    else:
+        traces = np.concatenate(traces)
+
+    if neuropilRadii is not None:
+        return traces[:, :nObjects], traces[:, nObjects:]
     return traces
 
+def roiMatrix(mask, weights=None):
+    """Build a sparse object by pixel matrix whose rows average each object.
+
+    Row i holds the pixels of label i, so row 0 is the unlabeled background,
+    as in extractTimeCoursesFromStack.  For footprints, row i holds footprint
+    i-1 (mask[:, :, i-1]) and row 0 is empty, so object i is row i either way.
+    Rows are scaled so every non-empty row sums to one.  Columns are pixels of
+    the flattened (C order) X by Y image.
+
+    :param mask: 2-D labeled image of cell masks, or an X by Y by N array of weighted footprints
+    :param weights: optional X by Y array of per pixel weights for a labeled mask
+                    (footprints carry their own weights, so can't be given weights)
+    :returns: scipy.sparse csr matrix, numobjects+1 by X*Y (row 0 the background)
+    """
+    if mask.ndim == 3:
+        if weights is not None:
+            raise ValueError('weights are for a labeled mask; weight the footprints themselves instead')
+        # weighted footprints, one per object along the last axis, after an empty background row
+        Xsize, Ysize, nFootprints = mask.shape
+        nObjects = nFootprints + 1
+        footprints = mask.reshape(Xsize * Ysize, nFootprints)
+        pixels, rows = np.nonzero(footprints)
+        values = footprints[pixels, rows].astype('float')
+        rows = rows + 1
+    else:
+        Xsize, Ysize = mask.shape
+        labels = mask.ravel()
+        nObjects = labels.max() + 1
+        rows = labels
+        pixels = np.arange(labels.size)
+        if weights is None:
+            values = np.ones(labels.size)
+        else:
+            values = np.asarray(weights, dtype='float').ravel()
+
+    rowSums = np.bincount(rows, weights=values, minlength=nObjects)
+    rowSums[rowSums == 0] = 1
+    values = values / rowSums[rows]
+
+    return sparse.csr_matrix((values, (rows, pixels)), shape=(nObjects, Xsize * Ysize))
+
+def neuropilMatrix(mask, innerRadius=2, outerRadius=8):
+    """Build a sparse object by pixel matrix averaging an annulus around each object.
+
+    The annulus of label i holds the pixels further than innerRadius but within
+    outerRadius of the object, excluding the pixels of every labeled object.
+    Annuli of neighbouring objects may overlap.  Row 0 (the background) is empty.
+
+    :param mask: 2-D labeled image of cell masks
+    :param innerRadius: pixels within this distance of the object are excluded
+    :param outerRadius: outer radius of the annulus
+    :returns: scipy.sparse csr matrix, numobjects by X*Y
+    """
+    Xsize, Ysize = mask.shape
+    nObjects = mask.max() + 1
+    cells = mask > 0
+
+    def disk(radius):
+        x, y = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+        return x * x + y * y <= radius * radius
+
+    innerDisk = disk(innerRadius)
+    outerDisk = disk(outerRadius)
+
+    rows = []
+    pixels = []
+    for label, objectSlice in enumerate(nd.find_objects(mask), 1):
+        if objectSlice is None:
+            continue
+        # a window around the object big enough to hold the annulus
+        x0 = max(objectSlice[0].start - outerRadius, 0)
+        x1 = min(objectSlice[0].stop + outerRadius, Xsize)
+        y0 = max(objectSlice[1].start - outerRadius, 0)
+        y1 = min(objectSlice[1].stop + outerRadius, Ysize)
+
+        local = mask[x0:x1, y0:y1] == label
+        annulus = nd.binary_dilation(local, structure=outerDisk)
+        if innerRadius > 0:
+            annulus &= ~nd.binary_dilation(local, structure=innerDisk)
+        annulus &= ~cells[x0:x1, y0:y1]
+
+        xx, yy = np.nonzero(annulus)
+        rows.append(np.ones(xx.size, dtype='int') * label)
+        pixels.append((xx + x0) * Ysize + (yy + y0))
+
+    if rows:
+        rows = np.concatenate(rows)
+        pixels = np.concatenate(pixels)
+    else:
+        rows = np.zeros(0, dtype='int')
+        pixels = np.zeros(0, dtype='int')
+
+    rowSums = np.bincount(rows, minlength=nObjects).astype('float')
+    rowSums[rowSums == 0] = 1
+    values = 1.0 / rowSums[rows]
+
+    return sparse.csr_matrix((values, (rows, pixels)), shape=(nObjects, Xsize * Ysize))
+
 def avgFromROIInSeries(imageSeries, binaryMask):
     """Computes an avgerage time series across all pixels in the mask.  
 
@@ -81,22 +303,79 @@ def allPixelsFromROIInSeries(imageSeries, binaryMask):
     :param binaryMask: binary mask image
     :returns: pixelValues: numpy array, 2D, pixel number by time
     """
-    pixelValues = np.zeros((binaryMask.sum(), imageSeries.shape[2]))
-    for i in range(imageSeries.shape[2]):
-        iii = imageSeries[:,:,i]
-        pixelValues[:,i] = iii[binaryMask.astype('bool')]
-    return pixelValues
-
-def watershedSegment(image, diskSize=20):
+    Xsize, Ysize, nTimePoints = imageSeries.shape
+    pixelIndex = np.flatnonzero(binaryMask)
+    pixelValues = imageSeries.reshape(Xsize * Ysize, nTimePoints).take(pixelIndex, axis=0)
+    return pixelValues.astype('float')
+
+def allPixelsFromROIsInSeries(imageSeries, mask, labels=None):
+    """Pixel by pixel timeseries for many ROIs at once, as a ragged array.
+
+    All pixels are gathered with a single flat-index take from the series
+    (reshaped to pixels by time, which is free for C ordered arrays and
+    memmaps), so only the ROI pixels are ever read.
+
+    :param imageSeries: X by Y by time (an array or memmap)
+    :param mask: 2-D labeled image, or an X by Y by N binary array of (possibly overlapping) ROIs
+    :param labels: labels to extract from a labeled image, in order.  Defaults to all nonzero labels.
+    :returns: offsets, pixelValues: the pixels of ROI i, in raster order, are 
+              pixelValues[offsets[i]:offsets[i+1]], a pixel number by time array
+              of the series' dtype.
+    """
+    Xsize, Ysize, nTimePoints = imageSeries.shape
+
+    if mask.ndim == 3:
+        masks = mask.reshape(Xsize * Ysize, -1).astype('bool')
+        roiIndex, pixelIndex = np.nonzero(masks.T)
+        counts = np.bincount(roiIndex, minlength=masks.shape[1])
+    else:
+        labelImage = mask.ravel()
+        if labels is None:
+            labels = np.unique(labelImage[labelImage > 0])
+        labels = np.asarray(labels)
+
+        # pixels grouped by label, raster order within each label
+        order = np.argsort(labelImage, kind='mergesort')
+        sortedLabels = labelImage[order]
+        starts = np.searchsorted(sortedLabels, labels, side='left')
+        counts = np.searchsorted(sortedLabels, labels, side='right') - starts
+
+        # concatenate order[starts[i]:starts[i]+counts[i]] without a loop
+        runStarts = np.cumsum(counts) - counts
+        pixelIndex = order[np.repeat(starts - runStarts, counts) + np.arange(counts.sum())]
+
+    offsets = np.zeros(len(counts) + 1, dtype='int')
+    offsets[1:] = np.cumsum(counts)
+    pixelValues = np.asarray(imageSeries.reshape(Xsize * Ysize, nTimePoints).take(pixelIndex, axis=0))
+    return offsets, pixelValues
+
+def watershedSegment(image, diskSize=20, reconstruction='hybrid', projection='mean'):
     """This routine implements the watershed example from 
     http://www.mathworks.com/help/images/examples/marker-controlled-watershed-segmentation.html, 
     but using pymorph and mahotas.
 
-    :param image: an image (2d numpy array) to be segemented
+    :param image: an image (2d numpy array) to be segemented.  Can also be an image
+                  series (X by Y by time) or a SummaryImages of one, in which case
+                  the cached summary projection is segmented.
     :param diskSize: an integer used as a size for a structuring element used 
                      for morphological preprocessing.
+    :param reconstruction: 'hybrid' (default) for the queue based grayscale reconstruction
+                           used to impose the minima, or 'iterative' for the much slower
+                           repeated conditional dilation (kept as a reference).  'none'
+                           skips the reconstruction and floods min(gradient + 1, markers)
+                           instead, which is what this routine did before the minima were
+                           imposed properly (the old call returned its mask unchanged), so
+                           old segmentations can be reproduced and compared.
+    :param projection: which summary projection of a series to segment, e.g. 'mean',
+                       'max', 'std' or 'localCorrelation' (see SummaryImages.projection)
     :returns: tuple of binarized and labeled segmention masks
     """
+    from imaging.morphProcessing.imimposemin import hybrid_reconstruct, fast_conditional_dilate
+
+    if reconstruction not in ('hybrid', 'iterative', 'none'):
+        raise ValueError("reconstruction must be 'hybrid', 'iterative' or 'none'")
+
+    image = _projectionImage(image, projection)
 
     def gradientMagnitudue(image):
         sobel_x = nd.sobel(image.astype('double'), 0)
@@ -111,25 +390,20 @@ def watershedSegment(image, diskSize=20):
         fp1 = image + 1
         
         g = np.minimum(fp1, fm)
-        
-        j = infrec(fm, g)
+        if reconstruction == 'none':
+            return g
+
+        # reconstruction by erosion of fm over g, done as the complement of
+        # a reconstruction by dilation
+        j = -infrec(-fm, -g, connectivity)
         return j
 
     def infrec(f, g, Bc=None):
         if Bc is None: Bc = pymorph.secross()
+        if reconstruction == 'hybrid':
+            return hybrid_reconstruct(f, g, Bc)
         n = f.size
-        return fast_conditional_dilate(f, g, Bc, n);
-
-    def fast_conditional_dilate(f, g, Bc=None, n=1):
-        if Bc is None:
-            Bc = pymorph.secross()
-        f = pymorph.intersec(f,g)
-        for i in xrange(n):
-            prev = f
-            f = pymorph.intersec(mahotas.dilate(f, Bc), g)
-            if pymorph.isequal(f, prev):
-                break
-        return f
+        return fast_conditional_dilate(f, g, Bc, n)
 
     gradmag = gradientMagnitudue(image)
 
@@ -171,3 +445,133 @@ def watershedSegment(image, diskSize=20):
     # seperate watershed regions
     segmented_cells[gradientMagnitudue(segmented_cells) > 0] = 0
     return segmented_cells > 0, segmented_cells
+
+def tiledWatershedSegment(image, diskSize=20, tileSize=512, overlap=None, nProcesses=None, reconstruction='hybrid',
+                          projection='mean'):
+    """Segment a large image (e.g. a tiled mosaic) with watershedSegment, tile by tile,
+    in a process pool.
+
+    See segmentPlanes for how tiles are cut and stitched.
+
+    :param image: an image (2d numpy array) to be segemented, or an image series
+                  or SummaryImages, as for watershedSegment
+    :param diskSize: passed to watershedSegment
+    :param tileSize: size of the (square) tiles each process segments, before overlap
+    :param overlap: pixels each tile is extended by on every side, defaults to 2*diskSize.
+                    Should be larger than the largest cell.
+    :param nProcesses: size of the process pool (defaults to the number of cpus, 1 runs serially)
+    :param reconstruction: passed to watershedSegment
+    :param projection: which summary projection of a series to segment
+    :returns: tuple of binarized and labeled segmention masks
+    """
+    return segmentPlanes([_projectionImage(image, projection)], diskSize=diskSize, tileSize=tileSize, overlap=overlap,
+                         nProcesses=nProcesses, reconstruction=reconstruction)[0]
+
+def segmentPlanes(planes, diskSize=20, tileSize=512, overlap=None, nProcesses=None, reconstruction='hybrid'):
+    """Segment several planes (e.g. of a multi-plane volume), tile by tile, in one process pool.
+
+    Every plane is cut into tileSize by tileSize core tiles, each extended by
+    overlap pixels on every side, and watershedSegment is run on each
+    extended tile in parallel.  Cells are stitched across the seams by
+    giving each cell to the tile whose core holds its centroid: a cell
+    crossing a seam is segmented whole by both neighbouring tiles (as long
+    as the overlap is larger than the cell), and only one copy is kept.
+    Where kept cells from neighbouring tiles still overlap, the pixels go to
+    the cell placed first.  Labels are then unique across the whole plane.
+
+    Note that watershedSegment thresholds each tile separately, so results
+    can differ slightly from segmenting the whole image at once.
+
+    :param planes: list of images (2d numpy arrays), or an X by Y by plane array
+    :param diskSize: passed to watershedSegment
+    :param tileSize: size of the (square) tiles each process segments, before overlap
+    :param overlap: pixels each tile is extended by on every side, defaults to 2*diskSize
+    :param nProcesses: size of the process pool (defaults to the number of cpus, 1 runs serially)
+    :param reconstruction: passed to watershedSegment
+    :returns: list of (binarized, labeled) segmentation mask tuples, one per plane
+    """
+    if isinstance(planes, np.ndarray) and planes.ndim == 3:
+        planes = [planes[:, :, i] for i in range(planes.shape[2])]
+    if overlap is None:
+        overlap = 2 * diskSize
+
+    jobs = []
+    for planeIndex, plane in enumerate(planes):
+        for core, window in _tiles(plane.shape, tileSize, overlap):
+            jobs.append((planeIndex, core, window, plane[window], diskSize, reconstruction))
+
+    if nProcesses == 1:
+        tileLabels = map(_segmentTile, jobs)
+    else:
+        pool = mp.Pool(processes=nProcesses)
+        try:
+            tileLabels = pool.map(_segmentTile, jobs)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    segmented = []
+    for planeIndex, plane in enumerate(planes):
+        tiles = [(job[1], job[2], labels) for job, labels in zip(jobs, tileLabels) if job[0] == planeIndex]
+        labels = _stitchTiles(plane.shape, tiles)
+        segmented.append((labels > 0, labels))
+    return segmented
+
+def _projectionImage(image, projection):
+    """The image to segment: image itself if 2d, else a cached summary projection."""
+    if isinstance(image, SummaryImages):
+        return image.projection(projection)
+    if image.ndim == 3:
+        return SummaryImages(image).projection(projection)
+    return image
+
+def _tiles(shape, tileSize, overlap):
+    """Yields (core, window) pairs of slice tuples covering an image of the given shape."""
+    Xsize, Ysize = shape
+    for x0 in range(0, Xsize, tileSize):
+        for y0 in range(0, Ysize, tileSize):
+            x1 = min(x0 + tileSize, Xsize)
+            y1 = min(y0 + tileSize, Ysize)
+            core = (slice(x0, x1), slice(y0, y1))
+            window = (slice(max(x0 - overlap, 0), min(x1 + overlap, Xsize)),
+                      slice(max(y0 - overlap, 0), min(y1 + overlap, Ysize)))
+            yield core, window
+
+def _segmentTile(job):
+    """Process pool worker for segmentPlanes: the labeled mask of one tile."""
+    planeIndex, core, window, tile, diskSize, reconstruction = job
+    return watershedSegment(tile, diskSize=diskSize, reconstruction=reconstruction)[1]
+
+def _stitchTiles(shape, tiles):
+    """Stitch labeled tiles into one label image, keeping each cell only in the
+    tile whose core holds its centroid.
+
+    :param shape: shape of the full image
+    :param tiles: list of (core, window, labels) tuples, labels being the labeled mask of image[window]
+    :returns: labeled mask of the full image, labels numbered from 1
+    """
+    stitched = np.zeros(shape, dtype='int')
+    nextLabel = 1
+    for core, window, labels in tiles:
+        nLabels = labels.max()
+        if nLabels < 1:
+            continue
+        index = np.arange(1, nLabels + 1)
+        centroids = np.array(nd.center_of_mass(np.ones(labels.shape), labels, index)).reshape(-1, 2)
+        centroids += [window[0].start, window[1].start]
+
+        inCore = ((centroids[:, 0] >= core[0].start) & (centroids[:, 0] < core[0].stop) &
+                  (centroids[:, 1] >= core[1].start) & (centroids[:, 1] < core[1].stop))
+
+        target = stitched[window]
+        for label, objectSlice in zip(index, nd.find_objects(labels)):
+            if objectSlice is None or not inCore[label - 1]:
+                continue
+            pixels = (labels[objectSlice] == label) & (target[objectSlice] == 0)
+            if pixels.any():
+                target[objectSlice][pixels] = nextLabel
+                nextLabel += 1
+    return stitched
@@ -0,0 +1,231 @@
+# summary images of image series, for display and segmentation
+import numpy as np
+
+__all__ = ['SummaryImages', 'traceCorrelationMap', 'localCorrelationImage']
+
+class SummaryImages(object):
+    """Summary projections of an image series, computed once and cached.
+
+    The mean, max, min and std images are all filled by one streaming pass
+    over the series, framesPerBlock frames at a time, the first time any of
+    them is asked for.  The local correlation image and percentile images
+    are computed on first use in their own pass.  Everything is cached until
+    the data changes: the cache is dropped if a different array is seen
+    (by identity, shape or dtype), or when invalidate() or setData() is
+    called.  Call invalidate() after changing the series in place.
+
+    >>> summary = SummaryImages(imageSeries)  # doctest: +SKIP
+    >>> background = summary.mean()           # one pass over the series
+    >>> spread = summary.std()                # cached, no pass
+
+    :param imageSeries: X by Y by time (may be a memmap).  A 2d image is
+                        treated as a single frame.
+    :param framesPerBlock: number of frames read at once
+    """
+    def __init__(self, imageSeries, framesPerBlock=500):
+        self.framesPerBlock = framesPerBlock
+        self.setData(imageSeries)
+
+    def setData(self, imageSeries):
+        """Point the cache at a new series, dropping all cached images"""
+        self.imageSeries = imageSeries
+        self.invalidate()
+
+    def invalidate(self):
+        """Drop all cached images"""
+        self._cache = {}
+        self._key = self._dataKey()
+
+    def mean(self):
+        return self._moments()['mean']
+
+    def max(self):
+        return self._moments()['max']
+
+    def min(self):
+        return self._moments()['min']
+
+    def std(self):
+        return self._moments()['std']
+
+    def localCorrelation(self, connectivity=8):
+        """Mean correlation of each pixel with its neighbours, see localCorrelationImage"""
+        key = ('localCorrelation', connectivity)
+        if key not in self._cached():
+            self._cache[key] = localCorrelationImage(self._series(), connectivity, self.framesPerBlock)
+        return self._cache[key]
+
+    def percentile(self, q):
+        """Per pixel percentile (0-100) of the series over time.
+
+        Computed over blocks of rows, so that no more than about
+        framesPerBlock frames worth of pixels are held at a time.
+        """
+        key = ('percentile', float(q))
+        if key not in self._cached():
+            series = self._series()
+            x, y, nFrames = series.shape
+            image = np.empty((x, y))
+            rowsPerBlock = max(1, self.framesPerBlock * x // max(nFrames, 1))
+            for start in range(0, x, rowsPerBlock):
+                rows = slice(start, min(start + rowsPerBlock, x))
+                image[rows] = np.percentile(np.asarray(series[rows]), q, axis=2)
+            self._cache[key] = image
+        return self._cache[key]
+
+    def projection(self, name, *args):
+        """A cached projection by name: 'mean', 'max', 'min', 'std',
+        'localCorrelation' or 'percentile' (with q as the extra argument)"""
+        if name not in ('mean', 'max', 'min', 'std', 'localCorrelation', 'percentile'):
+            raise ValueError('unknown projection: %s' % name)
+        return getattr(self, name)(*args)
+
+    def _dataKey(self):
+        return (id(self.imageSeries), self.imageSeries.shape, self.imageSeries.dtype.str)
+
+    def _cached(self):
+        if self._dataKey() != self._key:
+            self.invalidate()
+        return self._cache
+
+    def _series(self):
+        if self.imageSeries.ndim == 2:
+            return self.imageSeries[:, :, np.newaxis]
+        return self.imageSeries
+
+    def _moments(self):
+        if 'mean' not in self._cached():
+            series = self._series()
+            nFrames = series.shape[2]
+            offset = None
+            for start in range(0, nFrames, self.framesPerBlock):
+                block = np.asarray(series[:, :, start:start + self.framesPerBlock], dtype='float')
+                if offset is None:
+                    # accumulate about the first block's mean, to avoid cancellation
+                    offset = block.mean(axis=2)
+                    sums = np.zeros(offset.shape)
+                    squares = np.zeros(offset.shape)
+                    maxImage = block.max(axis=2)
+                    minImage = block.min(axis=2)
+                else:
+                    np.maximum(maxImage, block.max(axis=2), maxImage)
+                    np.minimum(minImage, block.min(axis=2), minImage)
+                block -= offset[:, :, np.newaxis]
+                sums += block.sum(axis=2)
+                squares += np.einsum('ijk,ijk->ij', block, block)
+
+            means = sums / nFrames
+            self._cache['mean'] = offset + means
+            self._cache['std'] = np.sqrt(np.maximum(squares / nFrames - means ** 2, 0))
+            self._cache['max'] = maxImage
+            self._cache['min'] = minImage
+        return self._cache
+
+def traceCorrelationMap(imageSeries, trace, normalize=True, framesPerBlock=500):
+    """Correlate the time course of every pixel in a series with a trace.
+
+    Each block of frames is reshaped to a pixel by time matrix and multiplied
+    with the trace in one matrix product, so the series can be a memmap and
+    is only read once.
+
+    :param imageSeries: X by Y by time (or a window cropped out of a series)
+    :param trace: 1d array, one value per frame
+    :param normalize: if True, return Pearson correlation coefficients.  If
+                      False, return the dot products of the mean subtracted
+                      time courses with the mean subtracted trace (what
+                      np.correlate gives per pixel)
+    :param framesPerBlock: number of frames read at once
+    :returns: X by Y array
+    """
+    x, y, nFrames = imageSeries.shape
+    trace = np.asarray(trace, dtype='float')
+    if trace.shape != (nFrames,):
+        raise ValueError('trace must have one value per frame')
+    # with a zero mean trace, the pixel means drop out of the products
+    trace = trace - trace.mean()
+
+    products = np.zeros(x * y)
+    sums = np.zeros(x * y)
+    squares = np.zeros(x * y)
+    offset = None
+    for start in range(0, nFrames, framesPerBlock):
+        frames = slice(start, min(start + framesPerBlock, nFrames))
+        block = np.asarray(imageSeries[:, :, frames], dtype='float').reshape(x * y, -1)
+        products += block.dot(trace[frames])
+        if normalize:
+            # accumulate about the first block's mean, to avoid cancellation
+            if offset is None:
+                offset = block.mean(axis=1)
+            block -= offset[:, np.newaxis]
+            sums += block.sum(axis=1)
+            squares += np.einsum('ij,ij->i', block, block)
+
+    if normalize:
+        pixelNorms = np.sqrt(np.maximum(squares - sums ** 2 / nFrames, 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            products = products / (pixelNorms * np.sqrt(np.dot(trace, trace)))
+        products[~np.isfinite(products)] = 0
+
+    return products.reshape(x, y)
+
+def localCorrelationImage(imageSeries, connectivity=8, framesPerBlock=500):
+    """Mean correlation of the time course of each pixel with its neighbours.
+
+    Cells show up as bright patches whether or not they are bright in the
+    mean image.  Computed in one pass over the series, framesPerBlock frames
+    at a time, from running sums of the pixels, their squares and the
+    products of neighbouring pixels.
+
+    :param imageSeries: X by Y by time (may be a memmap)
+    :param connectivity: 4 or 8 neighbours
+    :param framesPerBlock: number of frames read at once
+    :returns: X by Y array of mean correlation coefficients
+    """
+    if connectivity == 4:
+        offsets = [(0, 1), (1, 0)]
+    elif connectivity == 8:
+        offsets = [(0, 1), (1, 0), (1, 1), (1, -1)]
+    else:
+        raise ValueError('connectivity must be 4 or 8')
+
+    x, y, nFrames = imageSeries.shape
+    pairs = [_pairSlices(x, y, dx, dy) for dx, dy in offsets]
+
+    sums = np.zeros((x, y))
+    squares = np.zeros((x, y))
+    products = [np.zeros((p[0].stop - p[0].start, p[1].stop - p[1].start)) for p, q in pairs]
+    offset = None
+    for start in range(0, nFrames, framesPerBlock):
+        block = np.asarray(imageSeries[:, :, start:start + framesPerBlock], dtype='float')
+        # accumulate about the first block's mean, to avoid cancellation
+        if offset is None:
+            offset = block.mean(axis=2)
+        block -= offset[:, :, np.newaxis]
+        sums += block.sum(axis=2)
+        squares += np.einsum('ijk,ijk->ij', block, block)
+        for (p, q), product in zip(pairs, products):
+            product += np.einsum('ijk,ijk->ij', block[p], block[q])
+
+    means = sums / nFrames
+    norms = np.sqrt(np.maximum(squares - sums * means, 0))
+
+    total = np.zeros((x, y))
+    count = np.zeros((x, y))
+    for (p, q), product in zip(pairs, products):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            correlation = (product - sums[p] * means[q]) / (norms[p] * norms[q])
+        correlation[~np.isfinite(correlation)] = 0
+        total[p] += correlation
+        total[q] += correlation
+        count[p] += 1
+        count[q] += 1
+
+    return total / np.maximum(count, 1)
+
+def _pairSlices(x, y, dx, dy):
+    """Slices p, q such that image[q] is the (dx, dy) neighbour of image[p]."""
+    def axis(n, d):
+        return slice(max(-d, 0), n - max(d, 0)), slice(max(d, 0), n - max(-d, 0))
+    px, qx = axis(x, dx)
+    py, qy = axis(y, dy)
+    return (px, py), (qx, qy)
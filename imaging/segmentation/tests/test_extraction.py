@@ -0,0 +1,136 @@
+"""Time courses extracted through the sparse ROI matrices, from a stack or
+straight from tiff files, equal the mean of each label's pixels, frame by
+frame, however the frames are blocked."""
+import os
+import sys
+
+import numpy as np
+import pytest
+import scipy.ndimage as nd
+
+pytest.importorskip('PyQt4')
+pytest.importorskip('pymorph')
+pytest.importorskip('mahotas')
+
+# import the module on its own, as the segmentation package imports the CellPicker GUI
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import segmentationRoutines as sr
+
+def make_mask(shape=(40, 50), seed=0):
+    """A labeled mask of discs, with a label missing (so an empty row)"""
+    random = np.random.RandomState(seed)
+    x, y = np.indices(shape)
+    mask = np.zeros(shape, dtype='int')
+    for label in (1, 2, 3, 5, 6):
+        cx, cy = random.uniform(4, np.array(shape) - 4)
+        mask[((x - cx) ** 2 + (y - cy) ** 2 <= random.uniform(2, 5) ** 2) & (mask == 0)] = label
+    return mask
+
+def make_stack(shape=(40, 50), nFrames=23, nTrials=2, seed=1):
+    return np.random.RandomState(seed).rand(shape[0], shape[1], nFrames, nTrials) * 100
+
+def label_means(stack, pixels, weights=None):
+    """time by trial mean (or weighted mean) of the stack over a boolean pixel mask, 0 if empty"""
+    if not pixels.any():
+        return np.zeros(stack.shape[2:])
+    if weights is None:
+        weights = np.ones(pixels.shape)
+    w = weights[pixels]
+    return np.tensordot(w, stack[pixels], axes=(0, 0)) / w.sum()
+
+@pytest.mark.parametrize('framesPerBlock', [500, 5, 1])
+def test_label_means(framesPerBlock):
+    mask, stack = make_mask(), make_stack()
+    traces = sr.extractTimeCoursesFromStack(stack, mask, framesPerBlock=framesPerBlock)
+    assert traces.shape == (23, mask.max() + 1, 2)
+    for label in range(mask.max() + 1):
+        np.testing.assert_allclose(traces[:, label, :], label_means(stack, mask == label), rtol=1e-10)
+
+def test_weighted_label_means():
+    mask, stack = make_mask(), make_stack()
+    weights = np.random.RandomState(2).rand(*mask.shape)
+    traces = sr.extractTimeCoursesFromStack(stack, mask, weights=weights, framesPerBlock=7)
+    for label in range(mask.max() + 1):
+        np.testing.assert_allclose(traces[:, label, :], label_means(stack, mask == label, weights), rtol=1e-10)
+
+@pytest.mark.parametrize('radii', [(2, 6), (0, 3)])
+def test_neuropil_ring(radii):
+    innerRadius, outerRadius = radii
+    mask, stack = make_mask(), make_stack()
+    traces, neuropil = sr.extractTimeCoursesFromStack(stack, mask, neuropilRadii=radii, framesPerBlock=4)
+    np.testing.assert_allclose(traces, sr.extractTimeCoursesFromStack(stack, mask), rtol=1e-12)
+    for label in range(1, mask.max() + 1):
+        distance = nd.distance_transform_edt(mask != label)
+        ring = (distance <= outerRadius) & (mask == 0)
+        if innerRadius:
+            ring &= distance > innerRadius
+        if not (mask == label).any():
+            ring[:] = False
+        np.testing.assert_allclose(neuropil[:, label, :], label_means(stack, ring), rtol=1e-10)
+    np.testing.assert_array_equal(neuropil[:, 0, :], 0)
+
+def test_footprints():
+    mask, stack = make_mask(), make_stack()
+    footprints = np.random.RandomState(3).rand(mask.shape[0], mask.shape[1], 3)
+    footprints[footprints < 0.7] = 0
+    traces = sr.extractTimeCoursesFromStack(stack, footprints, framesPerBlock=6)
+    assert traces.shape == (23, 4, 2)
+    np.testing.assert_array_equal(traces[:, 0, :], 0)
+    for i in range(3):
+        np.testing.assert_allclose(traces[:, i + 1, :],
+                                   label_means(stack, footprints[:, :, i] > 0, footprints[:, :, i]), rtol=1e-10)
+
+def test_footprints_with_weights_raise():
+    footprints = np.ones((10, 10, 2))
+    with pytest.raises(ValueError):
+        sr.roiMatrix(footprints, weights=np.ones((10, 10)))
+    with pytest.raises(ValueError):
+        sr.extractTimeCoursesFromStack(make_stack((10, 10)), footprints, weights=np.ones((10, 10)))
+
+@pytest.mark.parametrize('asTrials', [False, True])
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_tiffs_match_stack(tmpdir, asTrials, prefetch):
+    pytest.importorskip('image_registration')
+    from imaging.io import tifffile
+    mask = make_mask()
+    stack = np.round(make_stack(nFrames=11, nTrials=3) * 10).astype('uint16')
+    filenames = []
+    for trial in range(3):
+        filenames.append(str(tmpdir.join('trial%d.tif' % trial)))
+        tifffile.imsave(filenames[-1], np.ascontiguousarray(stack[:, :, :, trial].transpose(2, 0, 1)))
+
+    traces, neuropil = sr.extractTimeCoursesFromTiffs(filenames, mask, neuropilRadii=(2, 6), asTrials=asTrials,
+                                                      framesPerBlock=4, prefetch=prefetch)
+    expected = sr.extractTimeCoursesFromStack(stack, mask, neuropilRadii=(2, 6))
+    if not asTrials:
+        # the files one after another
+        expected = [e.transpose(2, 0, 1).reshape(-1, e.shape[1]) for e in expected]
+    np.testing.assert_allclose(traces, expected[0], rtol=1e-10)
+    np.testing.assert_allclose(neuropil, expected[1], rtol=1e-10)
+
+    with pytest.raises(ValueError):
+        sr.extractTimeCoursesFromTiffs(filenames, mask.T, framesPerBlock=4, prefetch=prefetch)
+
+@pytest.mark.parametrize('labels', [None, [5, 1, 3], [6, 6, 2], [4, 2], []])
+def test_all_pixels_split(labels):
+    # any order, repeats, a label with no pixels and no labels at all
+    mask = make_mask()
+    series = make_stack(nFrames=9)[:, :, :, 0]
+    offsets, pixelValues = sr.allPixelsFromROIsInSeries(series, mask, labels=labels)
+    if labels is None:
+        labels = [1, 2, 3, 5, 6]
+    assert len(offsets) == len(labels) + 1
+    assert offsets[-1] == len(pixelValues)
+    assert pixelValues.dtype == series.dtype
+    for i, label in enumerate(labels):
+        np.testing.assert_array_equal(pixelValues[offsets[i]:offsets[i + 1]],
+                                      sr.allPixelsFromROIInSeries(series, mask == label))
+
+def test_all_pixels_split_overlapping():
+    series = make_stack(nFrames=5)[:, :, :, 0]
+    masks = np.random.RandomState(4).rand(series.shape[0], series.shape[1], 4) > 0.8
+    masks[:, :, 2] = False
+    offsets, pixelValues = sr.allPixelsFromROIsInSeries(series, masks)
+    for i in range(4):
+        np.testing.assert_array_equal(pixelValues[offsets[i]:offsets[i + 1]],
+                                      sr.allPixelsFromROIInSeries(series, masks[:, :, i]))
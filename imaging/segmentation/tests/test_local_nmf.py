@@ -0,0 +1,61 @@
+"""localNMF recovers planted non-negative low rank factors, never increases
+its residual from one iteration to the next, and starts from given factors."""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('PyQt4')
+pytest.importorskip('pymorph')
+pytest.importorskip('mahotas')
+
+# import the module on its own, as the segmentation package imports every routine module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from CellPicker import localNMF
+
+def make_factors(nPixels=60, nFrames=80, nComponents=3, seed=0):
+    """Sparse, non-negative spatial footprints and temporal components"""
+    random = np.random.RandomState(seed)
+    W = random.rand(nPixels, nComponents)
+    W[W < 0.5] = 0
+    H = random.rand(nComponents, nFrames)
+    H[H < 0.3] = 0
+    return W, H
+
+def residual(X, W, H):
+    return np.linalg.norm(X - W.dot(H)) / np.linalg.norm(X)
+
+def test_recovers_planted_factors():
+    W0, H0 = make_factors()
+    X = W0.dot(H0)
+    W, H = localNMF(X, 3, maxIter=2000, tol=1e-12)
+    assert W.shape == W0.shape and H.shape == H0.shape
+    assert (W >= 0).all() and (H >= 0).all()
+    assert residual(X, W, H) < 1e-3
+    # the components match up to order and scale
+    correlations = np.corrcoef(H, H0)[:3, 3:]
+    assert (np.sort(correlations.max(axis=0)) > 0.999).all()
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_residual_non_increasing(seed):
+    W0, H0 = make_factors(seed=seed)
+    X = W0.dot(H0) + np.random.RandomState(seed).rand(*W0.dot(H0).shape) * 0.1
+    # the same seed starts from the same factors, so each fit is one more iteration of the last
+    residuals = [residual(X, *localNMF(X, 3, maxIter=n, tol=0, seed=seed)) for n in range(1, 30)]
+    assert np.all(np.diff(residuals) <= 1e-12)
+    assert residuals[-1] < residuals[0]
+
+def test_warm_start():
+    W0, H0 = make_factors()
+    X = W0.dot(H0)
+    # at the solution already, one iteration leaves it there
+    W, H = localNMF(X, 3, W=W0, H=H0, maxIter=1)
+    assert residual(X, W, H) < 1e-6
+    # from H alone, W is projected, and the fit ends up closer in few iterations than from random factors
+    W, H = localNMF(X, 3, H=H0 * 1.5, maxIter=5, tol=0)
+    assert residual(X, W, H) < residual(X, *localNMF(X, 3, maxIter=5, tol=0))
+    # the given factors are not changed in place
+    H1 = H0.copy()
+    localNMF(X, 3, W=W0 + 0.1, H=H1, maxIter=3)
+    np.testing.assert_array_equal(H1, H0)
@@ -0,0 +1,111 @@
+"""ROIRegistry keeps the same ROIs as relabelling the mask after every edit,
+and undo restores the mask and labels exactly.  Needs no Qt."""
+import os
+import sys
+
+import numpy as np
+import scipy.ndimage as nd
+
+# the segmentation package imports the CellPicker GUI, so import the module on its own
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from roiRegistry import ROIRegistry
+
+def square(shape, x, y, size):
+    mask = np.zeros(shape, dtype=bool)
+    mask[x:x + size, y:y + size] = True
+    return mask
+
+def check_consistent(rois):
+    """The registry's ROIs are the connected components of its mask, as a reloaded mask would give"""
+    relabelled, nROIs = nd.label(rois.mask > 0)
+    assert len(rois) == nROIs
+    reloaded = ROIRegistry(rois.mask)
+    for label, indices in rois.pixels.items():
+        np.testing.assert_array_equal(np.flatnonzero(rois.labels == label), indices)
+        components = np.unique(relabelled.flat[indices])
+        assert len(components) == 1
+        np.testing.assert_array_equal(indices, np.flatnonzero(relabelled == components[0]))
+        np.testing.assert_array_equal(reloaded.roiMask(reloaded.labelAt(*np.unravel_index(indices[0], rois.mask.shape))),
+                                      rois.roiMask(label))
+        xs, ys = np.unravel_index(indices, rois.mask.shape)
+        assert rois.boxes[label] == (xs.min(), ys.min(), xs.max() + 1, ys.max() + 1)
+
+def test_add_separate_rois():
+    rois = ROIRegistry(shape=(40, 40))
+    assert rois.addROI(square((40, 40), 2, 2, 5), 1) == [1]
+    assert rois.addROI(square((40, 40), 20, 20, 5), 2) == [2]
+    assert len(rois) == 2
+    assert rois.labelAt(3, 3) == 1 and rois.labelAt(21, 21) == 2 and rois.labelAt(10, 10) == 0
+    assert rois.mask[21, 21] == 2
+    check_consistent(rois)
+
+def test_touching_roi_joins_it():
+    rois = ROIRegistry(shape=(40, 40))
+    rois.addROI(square((40, 40), 2, 2, 5), 1)
+    # overlaps and touches the first ROI, only the new pixels are added, with their own value
+    assert rois.addROI(square((40, 40), 5, 5, 5), 3) == [1]
+    assert len(rois) == 1
+    assert rois.mask[3, 3] == 1 and rois.mask[9, 9] == 3
+    check_consistent(rois)
+
+def test_bridge_merges_rois_and_undo_splits_them():
+    rois = ROIRegistry(shape=(40, 40))
+    rois.addROI(square((40, 40), 2, 2, 5), 1)
+    rois.addROI(square((40, 40), 2, 10, 5), 2)
+    mask, labels = rois.mask.copy(), rois.labels.copy()
+
+    bridge = np.zeros((40, 40), dtype=bool)
+    bridge[4, 7:10] = True
+    assert rois.addROI(bridge, 1) == [1]
+    assert len(rois) == 1
+    assert rois.mask[3, 12] == 2    # the merged ROI keeps its values
+    check_consistent(rois)
+
+    assert rois.undo()
+    np.testing.assert_array_equal(rois.mask, mask)
+    np.testing.assert_array_equal(rois.labels, labels)
+    assert sorted(rois.pixels) == [1, 2]
+    check_consistent(rois)
+
+def test_recolor_remove_undo():
+    starting = np.zeros((30, 30), dtype='uint16')
+    starting[2:6, 2:6] = 1
+    starting[10:15, 10:15] = 4
+    rois = ROIRegistry(starting)
+    assert len(rois) == 2
+    label = rois.labelAt(12, 12)
+
+    rois.recolorROI(label, 7)
+    assert np.all(rois.mask[10:15, 10:15] == 7)
+    np.testing.assert_array_equal(rois.lastChange(), rois.roiMask(label))
+    rois.removeROI(rois.labelAt(3, 3))
+    assert len(rois) == 1 and not rois.mask[2:6, 2:6].any()
+    check_consistent(rois)
+
+    assert rois.undo() and rois.undo()
+    np.testing.assert_array_equal(rois.mask, starting)
+    check_consistent(rois)
+    assert not rois.undo()
+    assert rois.lastChange() is None
+
+def test_random_edits_match_relabelling():
+    random = np.random.RandomState(0)
+    rois = ROIRegistry(shape=(50, 50))
+    masks = [rois.mask.copy()]
+    for i in range(60):
+        if len(rois) and random.rand() < 0.3:
+            label = random.choice(sorted(rois.pixels))
+            if random.rand() < 0.5:
+                rois.removeROI(label)
+            else:
+                rois.recolorROI(label, random.randint(1, 9))
+        else:
+            x, y = random.randint(0, 46, 2)
+            rois.addROI(square((50, 50), x, y, random.randint(2, 6)), random.randint(1, 9))
+        check_consistent(rois)
+        if len(rois.history) == len(masks):    # adding only covered pixels is not a step
+            masks.append(rois.mask.copy())
+    masks.pop()
+    while rois.undo():
+        np.testing.assert_array_equal(rois.mask, masks.pop())
+        check_consistent(rois)
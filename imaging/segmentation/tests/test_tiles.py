@@ -0,0 +1,79 @@
+"""Tiles cover the image once, and stitching keeps every cell exactly once
+across the seams, with labels unique over the whole image."""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('PyQt4')
+pytest.importorskip('pymorph')
+pytest.importorskip('mahotas')
+
+# import the module on its own, as the segmentation package imports the CellPicker GUI
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import segmentationRoutines as sr
+
+def make_cells(shape, radius=4, spacing=11, seed=0):
+    """A labeled image of non-touching discs on a jittered grid, many of them across tile seams"""
+    random = np.random.RandomState(seed)
+    x, y = np.indices(shape)
+    cells = np.zeros(shape, dtype='int')
+    label = 0
+    for cx in range(radius + 1, shape[0] - radius - 1, spacing):
+        for cy in range(radius + 1, shape[1] - radius - 1, spacing):
+            label += 1
+            cx1, cy1 = cx + random.randint(-1, 2), cy + random.randint(-1, 2)
+            cells[(x - cx1) ** 2 + (y - cy1) ** 2 <= radius ** 2] = label
+    return cells
+
+def segment_tiles(cells, tileSize, overlap, seed=0):
+    """What each tile's segmentation would give: the cells in its window, shuffled labels
+    (every tile starts from 1, so labels collide between tiles)"""
+    random = np.random.RandomState(seed)
+    tiles = []
+    for core, window in sr._tiles(cells.shape, tileSize, overlap):
+        local = cells[window]
+        present = np.unique(local[local > 0])
+        relabel = np.zeros(cells.max() + 1, dtype='int')
+        relabel[present] = random.permutation(len(present)) + 1
+        tiles.append((core, window, relabel[local]))
+    return tiles
+
+@pytest.mark.parametrize('shape', [(100, 100), (97, 130), (20, 35)])
+@pytest.mark.parametrize('tileSize', [16, 25, 64, 200])
+def test_tiles_cover_once(shape, tileSize):
+    covered = np.zeros(shape, dtype='int')
+    for core, window in sr._tiles(shape, tileSize, 7):
+        covered[core] += 1
+        for c, w, size in zip(core, window, shape):
+            assert w.start == max(c.start - 7, 0) and w.stop == min(c.stop + 7, size)
+            assert c.stop - c.start <= tileSize
+    np.testing.assert_array_equal(covered, 1)
+
+@pytest.mark.parametrize('tileSize', [16, 25, 40])
+@pytest.mark.parametrize('shape', [(100, 100), (97, 130)])
+def test_stitch_keeps_each_cell_once(tileSize, shape):
+    cells = make_cells(shape)
+    stitched = sr._stitchTiles(shape, segment_tiles(cells, tileSize, overlap=10))
+    # the same pixels as the cells, each cell one label, and the labels 1..n
+    np.testing.assert_array_equal(stitched > 0, cells > 0)
+    pairs = set(zip(cells[cells > 0], stitched[cells > 0]))
+    assert len(pairs) == cells.max()
+    assert len(set(label for cell, label in pairs)) == cells.max()
+    np.testing.assert_array_equal(np.unique(stitched[stitched > 0]), np.arange(1, cells.max() + 1))
+
+def test_stitch_with_partial_copies():
+    # with an overlap smaller than the cells, a cell cut by a window edge can be kept in
+    # pieces by two tiles, but no label spans two cells and no pixel is labeled twice
+    cells = make_cells((80, 80))
+    stitched = sr._stitchTiles(cells.shape, segment_tiles(cells, 20, overlap=3))
+    assert ((stitched > 0) <= (cells > 0)).all()
+    for label in np.unique(stitched[stitched > 0]):
+        assert len(np.unique(cells[stitched == label])) == 1
+
+def test_empty_tiles():
+    shape = (50, 50)
+    tiles = [(core, window, np.zeros((window[0].stop - window[0].start, window[1].stop - window[1].start), 'int'))
+             for core, window in sr._tiles(shape, 20, 5)]
+    np.testing.assert_array_equal(sr._stitchTiles(shape, tiles), 0)
@@ -1,6 +1,13 @@
 """
 Basic trace manipulation routines (baselining, normalizing, level detecting,
-baseline correction and threshold evaluation)
+baseline correction and threshold evaluation), a filter bank with cached
+designs for filtering long multi-channel recordings in chunks, and power
+spectra and spectrograms of whole channel x trial batches, and a pipeline
+that runs chains of these on blocks of cells in a single pass
 """
 
+from dtypeRoutines import *
 from traceRoutines import *
+from filterRoutines import *
+from spectralRoutines import *
+from pipelineRoutines import *
@@ -0,0 +1,28 @@
+"""
+The dtype policy for traces (and events): results keep the floating point
+precision of their input, so float32 traces stay float32 through smoothing,
+baselining, filtering and thresholding.  Integer (or other) inputs are
+worked on as float64.  Sums and other reductions are still accumulated in
+float64 where precision matters, and only the results are cast.  Routines
+take a dtype= keyword to override this.
+"""
+import numpy as np
+
+__all__ = ['float_dtype']
+
+def float_dtype(A, dtype=None):
+    """The floating point dtype to compute results for A in.
+
+    :param A: numpy array (or memmap, or anything with a dtype)
+    :param dtype: optional explicit dtype, returned as is
+    :returns: numpy dtype: dtype if given, else the dtype of A if it is
+              float32 or float64, else float64
+    """
+    if dtype is not None:
+        return np.dtype(dtype)
+    A_dtype = getattr(A, 'dtype', None)
+    if A_dtype is None:
+        A_dtype = np.asarray(A).dtype
+    if A_dtype in (np.float32, np.float64):
+        return np.dtype(A_dtype)
+    return np.dtype(np.float64)
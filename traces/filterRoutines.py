@@ -0,0 +1,266 @@
+"""
+Filter bank: cached filter designs, applied along an axis of Nd arrays,
+either all at once or chunk by chunk with the filter state carried over.
+"""
+import numpy as np
+
+import scipy.signal
+from scipy.fftpack import next_fast_len
+
+from dtypeRoutines import float_dtype
+
+__all__ = ['design_filter', 'filter_traces', 'StreamingFilter']
+
+# filter designs, by (family, kind, fs, cutoffs, order) or (family, kind, fs, cutoffs, taps, window, firwin keywords)
+_designs = {}
+
+def design_filter(fs, cutoffs, kind='band', family='butter', order=2, taps=101, window='hamming', **kwargs):
+    """Design a filter, or return the cached design if it has been made before.
+
+    IIR filters ('butter', 'bessel') are returned as second order sections,
+    FIR filters ('fir') as a kernel.  The returned arrays are shared between
+    calls, so don't change them in place.
+
+    :param fs: sampling frequency (Hz)
+    :param cutoffs: cutoff frequency (Hz), or (low, high) for band pass
+    :param kind: one of 'low', 'high' or 'band' (default)
+    :param family: one of 'butter' (default), 'bessel' or 'fir'
+    :param order: order of an IIR filter
+    :param taps: number of taps of an FIR filter (made odd)
+    :param window: window for an FIR filter design, passed to scipy.signal.firwin
+    :param kwargs: passed on to scipy.signal.firwin
+    :returns: sos array (sections by 6) for IIR filters, 1d kernel for FIR filters
+    """
+    kind = _filter_kind(kind)
+    assert family in ('butter', 'bessel', 'fir'), 'traces.design_filter: Unknown family \'%s\'' % family
+
+    cutoffs = tuple(np.atleast_1d(np.asarray(cutoffs, dtype=np.float64)))
+    if family == 'fir':
+        key = (family, kind, float(fs), cutoffs, taps, window, tuple(sorted(kwargs.items())))
+    else:
+        key = (family, kind, float(fs), cutoffs, order)
+    if key not in _designs:
+        if family == 'fir':
+            design = make_fir_filter(float(fs), cutoffs if kind == 'band' else cutoffs[0], window, taps, kind, **kwargs)
+        else:
+            normalized_cutoffs = np.array(cutoffs) / (fs / 2.)
+            if kind != 'band':
+                normalized_cutoffs = normalized_cutoffs[0]
+            btype = {'low': 'lowpass', 'high': 'highpass', 'band': 'bandpass'}[kind]
+            design_function = getattr(scipy.signal, family)
+            design = design_function(order, normalized_cutoffs, btype=btype, output='sos')
+        _designs[key] = design
+    return _designs[key]
+
+def filter_traces(data, fs, cutoffs, kind='band', family='butter', order=2, taps=101, window='hamming',
+                  axis=0, zero_phase=False, method='direct', chunk_size=None, out=None, dtype=None, **kwargs):
+    """Filter every trace in an Nd array along one axis, with a cached filter design.
+
+    IIR filters run as second order sections (sosfilt), or forward and
+    backward for zero phase (sosfiltfilt).  FIR filters are applied directly
+    (lfilter) or by FFT overlap-add (method='fft', faster for long kernels);
+    zero phase FIR filtering compensates for the (taps-1)/2 sample delay of
+    the linear phase kernel, padding the ends with zeros.
+
+    With chunk_size, the data (e.g. a memmap of hours of multi-channel
+    ephys) is read and filtered chunk_size samples at a time along axis, with
+    the filter state carried from one chunk to the next, so the result is the
+    same as filtering all at once.  Zero phase IIR filtering needs the whole
+    signal, so can't be chunked.
+
+    :param data: Nd numpy array (may be a memmap)
+    :param fs: sampling frequency (Hz)
+    :param cutoffs: cutoff frequency (Hz), or (low, high) for band pass
+    :param kind: one of 'low', 'high' or 'band' (default)
+    :param family: one of 'butter' (default), 'bessel' or 'fir'
+    :param order: order of an IIR filter
+    :param taps: number of taps of an FIR filter
+    :param window: window for an FIR filter design
+    :param axis: the time axis
+    :param zero_phase: filter without phase shift
+    :param method: 'direct' or 'fft', for FIR filters
+    :param chunk_size: optional number of samples to filter at a time
+    :param out: optional array to write into (e.g. a memmap), same shape as data
+    :param dtype: dtype of the result, defaults to that of data if floating point, else float64
+    :param kwargs: passed on to scipy.signal.firwin
+    :returns: filtered array, same shape as data (out, if given)
+    """
+    design = design_filter(fs, cutoffs, kind=kind, family=family, order=order, taps=taps, window=window, **kwargs)
+
+    if chunk_size is None and not (family == 'fir' and method == 'fft'):
+        dtype = float_dtype(data, dtype)
+        data = np.asarray(data, dtype=dtype)
+        if family != 'fir':
+            if zero_phase:
+                filtered = scipy.signal.sosfiltfilt(design, data, axis=axis)
+            else:
+                filtered = scipy.signal.sosfilt(design, data, axis=axis)
+        elif zero_phase:
+            filtered = _centred_fir(design, data, axis)
+        else:
+            filtered = scipy.signal.lfilter(design, [1.], data, axis=axis)
+        if out is None:
+            return filtered.astype(dtype, copy=False)
+        out[...] = filtered
+        return out
+
+    if zero_phase and family != 'fir':
+        raise ValueError('zero phase IIR filtering needs the whole signal, so can not be chunked')
+
+    n = data.shape[axis]
+    if chunk_size is None:
+        chunk_size = n
+    if out is None:
+        out = np.empty(data.shape, dtype=float_dtype(data, dtype))
+
+    stream = StreamingFilter(design, axis=axis, zero_phase=zero_phase, method=method)
+    written = 0
+    for start in range(0, n, chunk_size):
+        chunk = _take(data, slice(start, min(start + chunk_size, n)), axis)
+        written = _put(out, stream.process(chunk), written, axis)
+    _put(out, stream.flush(), written, axis)
+    return out
+
+class StreamingFilter(object):
+    """Filter a long recording chunk by chunk, carrying the filter state over.
+
+    >>> stream = StreamingFilter(design_filter(20000., (300., 6000.)))  # doctest: +SKIP
+    >>> for chunk in chunks:                                            # doctest: +SKIP
+    ...     filtered = stream.process(chunk)
+    >>> tail = stream.flush()                                           # doctest: +SKIP
+
+    Concatenating the outputs of process() and flush() gives the same result
+    as filtering the whole recording at once.  For a zero phase FIR filter
+    the output lags the input by (taps-1)/2 samples, and flush() returns the
+    remaining samples; otherwise flush() returns an empty chunk.
+
+    :param design: from design_filter, sos (IIR) or a kernel (FIR)
+    :param axis: the time axis of the chunks
+    :param zero_phase: compensate for the delay of an FIR kernel
+    :param method: 'direct' or 'fft' (overlap-add), for FIR kernels
+    """
+    def __init__(self, design, axis=0, zero_phase=False, method='direct'):
+        self.design = np.asarray(design)
+        self.fir = self.design.ndim == 1
+        if zero_phase and not self.fir:
+            raise ValueError('zero phase IIR filtering needs the whole signal, so can not be streamed')
+        assert method in ('direct', 'fft'), 'traces.StreamingFilter: Unknown method \'%s\'' % method
+        self.axis = axis
+        self.method = method
+        self.delay = (len(self.design) - 1) // 2 if (self.fir and zero_phase) else 0
+        self.state = None
+        self.to_skip = self.delay
+        self.last_shape = None
+
+    def process(self, chunk):
+        """Filter the next chunk.  Returns the filtered samples that are ready."""
+        chunk = np.asarray(chunk, dtype=float_dtype(chunk))
+        axis = self.axis % chunk.ndim
+        chunk = np.rollaxis(chunk, axis, 0)
+        self.last_shape = chunk.shape[1:]
+        self.dtype = chunk.dtype
+        if chunk.shape[0] == 0:
+            filtered = chunk
+        elif self.fir:
+            filtered = self._process_fir(chunk)
+        else:
+            if self.state is None:
+                self.state = np.zeros((self.design.shape[0], 2) + chunk.shape[1:], dtype=chunk.dtype)
+            filtered, self.state = scipy.signal.sosfilt(self.design, chunk, axis=0, zi=self.state)
+
+        if self.to_skip:
+            skipped = min(self.to_skip, filtered.shape[0])
+            filtered = filtered[skipped:]
+            self.to_skip -= skipped
+        return np.rollaxis(filtered.astype(chunk.dtype, copy=False), 0, axis + 1)
+
+    def flush(self):
+        """The samples still held back by a delay compensated filter."""
+        if self.last_shape is None:
+            return np.empty((0,))
+        zeros = np.zeros((self.delay,) + self.last_shape, dtype=self.dtype)
+        return self.process(np.rollaxis(zeros, 0, self.axis % zeros.ndim + 1))
+
+    def _process_fir(self, chunk):
+        n = chunk.shape[0]
+        taps = len(self.design)
+        kernel = self.design.reshape((taps,) + (1,) * (chunk.ndim - 1))
+        if self.method == 'direct':
+            if self.state is None:
+                self.state = np.zeros((taps - 1,) + chunk.shape[1:], dtype=chunk.dtype)
+            filtered, self.state = scipy.signal.lfilter(self.design, [1.], chunk, axis=0, zi=self.state)
+            return filtered
+
+        # overlap-add: the full convolution of this chunk, plus the tail left by the previous one
+        nfft = next_fast_len(n + taps - 1)
+        full = np.fft.irfft(np.fft.rfft(chunk, nfft, axis=0) * np.fft.rfft(kernel, nfft, axis=0), nfft, axis=0)
+        full = full[:n + taps - 1].astype(chunk.dtype)
+        if self.state is not None:
+            full[:taps - 1] += self.state
+        self.state = full[n:].copy()
+        return full[:n]
+
+def _centred_fir(kernel, data, axis):
+    """FIR filter with the (taps-1)/2 sample delay removed, zero padded at the ends"""
+    delay = (len(kernel) - 1) // 2
+    axis = axis % data.ndim
+    data = np.rollaxis(data, axis, 0)
+    padding = np.zeros((delay,) + data.shape[1:], dtype=data.dtype)
+    filtered = scipy.signal.lfilter(kernel, [1.], np.concatenate([data, padding]), axis=0)[delay:]
+    return np.rollaxis(filtered, 0, axis + 1)
+
+def _take(data, index, axis):
+    return data[(slice(None),) * (axis % data.ndim) + (index,)]
+
+def _put(out, chunk, start, axis):
+    stop = start + chunk.shape[axis % out.ndim] if chunk.ndim == out.ndim else start
+    if stop > start:
+        out[(slice(None),) * (axis % out.ndim) + (slice(start, stop),)] = chunk
+    return stop
+
+def _filter_kind(kind):
+    for name, aliases in (('low', ['low', 'low pass', 'low_pass']),
+                          ('high', ['high', 'high pass', 'high_pass']),
+                          ('band', ['band', 'band pass', 'band_pass'])):
+        if kind.lower() in aliases:
+            return name
+    raise ValueError('Unknown filter kind \'%s\'' % kind)
+
+# -------------------- FIR kernel design ------------------------------------------
+# from http://code.google.com/p/python-neural-analysis-scripts/source/browse/trunk/scripts/Filtering/Fir.py
+
+# used by make_fir_filter
+def spectral_inversion(kernel):
+    kernel = -kernel
+    kernel[len(kernel)/2] += 1.0
+    return kernel
+
+# used by design_filter and fir_filter
+def make_fir_filter(sampling_freq, critical_freq, kernel_window, taps, kind, **kwargs):
+    nyquist_freq = sampling_freq/2
+    critical_freq = np.array(critical_freq, dtype = np.float64)
+    normalized_critical_freq = critical_freq/nyquist_freq
+
+    if not taps % 2: #The order must be even for high and bandpass
+        taps += 1
+
+    if kind.lower() in ['low', 'low pass', 'low_pass']:
+        kernel = scipy.signal.firwin(taps, normalized_critical_freq,
+                               window=kernel_window, **kwargs)
+
+    elif kind.lower() in ['high', 'high pass', 'high_pass']:
+        lp_kernel = scipy.signal.firwin(taps, normalized_critical_freq,
+                                  window = kernel_window, **kwargs)
+        kernel = spectral_inversion(lp_kernel)
+
+    elif kind.lower() in ['band', 'band pass', 'band_pass']:
+        lp_kernel = scipy.signal.firwin(taps, normalized_critical_freq[0],
+                                  window = kernel_window, **kwargs)
+        hp_kernel = scipy.signal.firwin(taps, normalized_critical_freq[1],
+                                  window = kernel_window, **kwargs)
+        hp_kernel = spectral_inversion(hp_kernel)
+
+        bp_kernel = spectral_inversion(lp_kernel + hp_kernel)
+        kernel = bp_kernel
+
+    return kernel
@@ -0,0 +1,128 @@
+"""
+A chain of trace processing stages, run block by block over the cells of a
+time x cells x trials array in a single pass.
+"""
+import numpy as np
+import scipy.ndimage as nd
+
+from traceRoutines import baseline_splines, sliding_dff, smooth
+from filterRoutines import filter_traces
+from dtypeRoutines import float_dtype
+
+__all__ = ['TracePipeline']
+
+class TracePipeline(object):
+    """Chain baseline, normalize, smooth, filter and dF/F stages, and run them
+    all on one block of cells at a time.
+
+    Every stage works along time, so a block of cells (with all their
+    frames and trials) is read once, goes through every stage, and is
+    written out, instead of each step making full size copies of all the
+    traces.  Peak memory is a small multiple of one block, so the traces
+    and the output can both be memmaps, and the output can be the input
+    (in place).  Blocks are computed in the dtype of the output, so float32
+    traces stay float32 end to end.
+
+    >>> pipeline = TracePipeline().normalize((0, 100)).baseline((0, 100)).boxcar(3)  # doctest: +SKIP
+    >>> dff = pipeline.run(traces)             # doctest: +SKIP
+    >>> pipeline.run(traces, out=traces)       # doctest: +SKIP
+
+    Stages can also be any function taking and returning a time x cells x
+    trials block, added with apply().
+
+    :param cells_per_block: number of cells read and processed at a time
+    """
+    def __init__(self, cells_per_block=64):
+        self.cells_per_block = cells_per_block
+        self.stages = []
+
+    def __repr__(self):
+        return 'TracePipeline(%s)' % ' -> '.join(name for name, function in self.stages)
+
+    def apply(self, function, name=None):
+        """Add a stage: function(block) -> block, for time x cells x trials blocks"""
+        self.stages.append((name or getattr(function, '__name__', 'function'), function))
+        return self
+
+    def baseline(self, base_range):
+        """Subtract the mean over a range of frames, as traces.baseline"""
+        def stage(block):
+            block -= block[base_range[0]:base_range[1]].mean(axis=0, dtype='float').astype(block.dtype)
+            return block
+        return self.apply(stage, 'baseline')
+
+    def normalize(self, norm_range):
+        """Divide by the mean over a range of frames, as traces.normalize"""
+        def stage(block):
+            block /= block[norm_range[0]:norm_range[1]].mean(axis=0, dtype='float').astype(block.dtype)
+            return block
+        return self.apply(stage, 'normalize')
+
+    def boxcar(self, box_width=3):
+        """Smooth with a flat window, as traces.boxcar"""
+        kernel = np.ones(box_width) / float(box_width)
+        def stage(block):
+            return nd.convolve1d(block, kernel, axis=0, output=block.dtype)
+        return self.apply(stage, 'boxcar')
+
+    def smooth(self, window_len=11, window='hanning', mode='mirror'):
+        """Smooth with a normalized window, see traces.smooth"""
+        def stage(block):
+            return smooth(block, window_len, window, mode=mode, axis=0)
+        return self.apply(stage, 'smooth')
+
+    def filter(self, fs, cutoffs, **kwargs):
+        """Filter along time, see filter_traces for the keywords"""
+        def stage(block):
+            block[...] = filter_traces(block, fs, cutoffs, axis=0, **kwargs)
+            return block
+        return self.apply(stage, 'filter')
+
+    def dff(self, window, **kwargs):
+        """(F - F0) / F0 with a sliding window baseline F0, see sliding_dff for the keywords"""
+        def stage(block):
+            block[...] = sliding_dff(block, window, axis=0, **kwargs)
+            return block
+        return self.apply(stage, 'dff')
+
+    def normalize_splines(self, n_control_points, std_cutoff=2.25):
+        """Divide by the spline fit to the baseline, see baseline_splines"""
+        def stage(block):
+            # baseline_splines squeezes its result, so put back any one cell or trial axis
+            fit = baseline_splines(block, n_control_points, std_cutoff=std_cutoff)
+            block /= fit.reshape(block.shape).astype(block.dtype)
+            return block
+        return self.apply(stage, 'normalize_splines')
+
+    def run(self, traces, out=None, dtype=None):
+        """Run every stage over traces, one block of cells at a time.
+
+        :param traces: time x cells (x trials) array, or a memmap
+        :param out: optional array (or memmap) for the result, the same shape
+                    as traces.  Pass traces itself to work in place.
+        :param dtype: dtype of the result if out isn't given.  Defaults to
+                      the dtype of traces if that is floating point, else float64.
+        :returns: out, or a new array
+        """
+        if out is None:
+            out = np.empty(traces.shape, dtype=float_dtype(traces, dtype))
+        elif out.shape != traces.shape:
+            raise ValueError('out must be the same shape as traces')
+
+        if traces.ndim == 1:
+            out[:] = self._process(np.array(traces[:, np.newaxis, np.newaxis], dtype=out.dtype))[:, 0, 0]
+            return out
+
+        for start in range(0, traces.shape[1], self.cells_per_block):
+            cells = slice(start, min(start + self.cells_per_block, traces.shape[1]))
+            block = np.array(traces[:, cells], dtype=out.dtype)
+            if block.ndim == 2:
+                out[:, cells] = self._process(block[:, :, np.newaxis])[:, :, 0]
+            else:
+                out[:, cells] = self._process(block)
+        return out
+
+    def _process(self, block):
+        for name, function in self.stages:
+            block = function(block)
+        return block
@@ -0,0 +1,285 @@
+"""
+Power spectra and spectrograms of whole time x channel x trial arrays,
+Welch averaged or multitaper, without matplotlib.
+
+All windows of all traces are cut out of the data as one strided view and
+transformed together, so there is no python loop over channels or trials.
+"""
+import numpy as np
+from fractions import Fraction
+
+import scipy.signal
+from numpy.lib.stride_tricks import as_strided
+
+from dtypeRoutines import float_dtype
+
+__all__ = ['psd', 'specgram', 'resample_signal', 'find_NFFT', 'find_frequency_resolution',
+           'find_NFFT_and_noverlap']
+
+# -------------------- SPECTROGRAM ROUTINES------------------------------------------
+# modified from http://code.google.com/p/python-neural-analysis-scripts/source/browse/trunk/LFP/signal_utils.py
+
+def find_NFFT(frequency_resolution, sampling_frequency,
+              force_power_of_two=False):
+    #This function returns the NFFT
+    NFFT = (sampling_frequency*1.0)/frequency_resolution-2
+    if force_power_of_two:
+        pow_of_two = 1
+        pot_nfft = 2**pow_of_two
+        while pot_nfft < NFFT:
+            pow_of_two += 1
+            pot_nfft = 2**pow_of_two
+        return pot_nfft
+    else:
+        return NFFT
+
+def find_frequency_resolution(NFFT, sampling_frequency):
+    return (sampling_frequency*1.0)/(NFFT + 2)
+
+def find_NFFT_and_noverlap(frequency_resolution, sampling_frequency,
+                           time_resolution, num_data_samples):
+    NFFT =  find_NFFT(frequency_resolution, sampling_frequency)
+
+    # finds the power of two which is just greater than NFFT
+    pow_of_two = 1
+    pot_nfft = 2**pow_of_two
+    noverlap = pot_nfft-sampling_frequency*time_resolution
+    while pot_nfft < NFFT or noverlap < 0:
+        pow_of_two += 1
+        pot_nfft = 2**pow_of_two
+        noverlap = pot_nfft-sampling_frequency*time_resolution
+
+    pot_frequency_resolution = find_frequency_resolution(pot_nfft,
+                                                         sampling_frequency)
+
+    return {'NFFT':int(NFFT), 'power_of_two_NFFT':int(pot_nfft),
+            'noverlap':int(noverlap),
+            'power_of_two_frequency_resolution':pot_frequency_resolution}
+
+def resample_signal(signal, prev_sample_rate, new_sample_rate, axis=0, dtype=None):
+    """Resample along axis with a polyphase filter (scipy.signal.resample_poly).
+
+    The rate ratio is approximated by a fraction with a denominator of at
+    most 1000.  Unlike FFT resampling, the cost doesn't depend on the signal
+    length having small prime factors, and the ends don't wrap around.
+
+    :param: signal - numpy array
+    :param: prev_sample_rate - sampling rate of signal (Hz)
+    :param: new_sample_rate - sampling rate wanted (Hz)
+    :param: axis - the time axis
+    :param: dtype - dtype of the result, defaults to that of signal if floating point, else float64
+    :returns: resampled signal
+    """
+    ratio = Fraction(float(new_sample_rate) / prev_sample_rate).limit_denominator(1000)
+    resampled = scipy.signal.resample_poly(signal, ratio.numerator, ratio.denominator, axis=axis)
+    return resampled.astype(float_dtype(signal, dtype), copy=False)
+
+def psd(signal, sampling_frequency, frequency_resolution,
+        high_frequency_cutoff=None, axis=0, window='hanning', noverlap=0,
+        detrend='none', method='welch', NW=4, segments_per_block=256, dtype=None, **kwargs):
+    """Power spectral density of every trace in an array, by Welch's method
+    (the mean periodogram of windowed segments) or multitaper.
+
+    With the defaults, a 1d signal gives the same result as
+    matplotlib.mlab.psd, which this used to wrap.
+
+    :param: signal - the input signal, e.g. time x channels x trials
+    :param: sampling_frequency - the sampling frequency of signal (i.e.: 10000)
+    :param: frequency_resolution - the desired frequency resolution of the specgram.
+        this is the guaranteed worst frequency resolution.
+    :param: high_frequency_cutoff - optional high freq. cutoff.  resamples data
+        to this value and then uses that for Fs parameter
+    :param: axis - the time axis
+    :param: window - name of a numpy window function ('hanning', 'hamming',
+        'bartlett', 'blackman', 'flat'), an array of NFFT values, or a function of
+        the segment as for matplotlib.mlab (e.g. mlab.window_hanning).  Not used by multitaper.
+    :param: noverlap - number of samples that segments overlap by
+    :param: detrend - 'none', 'mean' or 'linear', applied to each segment
+    :param: method - 'welch' (default), or 'multitaper' to average over 2*NW-1
+        discrete prolate spheroidal (Slepian) tapers of each segment
+    :param: NW - multitaper time half bandwidth product
+    :param: segments_per_block - number of segments transformed at once,
+        bounds the memory used
+    :param: dtype - dtype of the power, defaults to that of signal if floating point, else float64
+    :param: **kwargs - scale_by_freq (default True), as for matplotlib.mlab.psd.  The other
+        mlab keywords (NFFT, Fs, pad_to, sides) are no longer passed on, and raise a TypeError:
+        the spectra are always one sided, of NFFT points set by frequency_resolution.
+    :returns: - tuple of two numpy arrays, power and freqs.  power has the
+        shape of signal, with the time axis replaced by frequencies.
+        float32 signals give float32 power, unless dtype says otherwise.
+    """
+    signal, sampling_frequency = _resampled(signal, sampling_frequency, high_frequency_cutoff, axis, dtype)
+    NFFT = find_NFFT(frequency_resolution, sampling_frequency,
+                     force_power_of_two=True)
+
+    scale_by_freq = _scale_by_freq('psd', kwargs)
+    power, freqs, starts = _spectra(signal, sampling_frequency, NFFT, noverlap, axis, window, detrend,
+                                    method, NW, segments_per_block, True, scale_by_freq)
+    return np.moveaxis(power, 0, axis % signal.ndim), freqs
+
+def specgram(signal, sampling_frequency, time_resolution,
+             frequency_resolution, high_frequency_cutoff=None,
+             logscale=True, axis=0, window='hanning', detrend='none',
+             method='welch', NW=4, segments_per_block=256, dtype=None, **kwargs):
+    """Spectrogram of every trace in an array.
+
+    With the defaults, a 1d signal gives the same result as
+    matplotlib.mlab.specgram, which this used to wrap.
+
+    Plot with:
+        power, freqs, bins = specgram(...)
+        extent = (bins[0], bins[-1], freqs[0], freqs[-1])
+        imshow(power, aspect='auto', origin='lower', extent=extent) # from pyplot
+
+    :param: signal - the input signal, e.g. time x channels x trials
+    :param: sampling_frequency - the sampling frequency of signal (i.e.: 10000)
+    :param: frequency_resolution - the desired frequency resolution of the specgram.
+        this is the guaranteed worst frequency resolution.
+    :param: time_resolution - the desired frequency resolution of the specgram.
+        this is the guaranteed worst time resolution.
+    :param: high_frequency_cutoff - optional high freq. cutoff.  resamples data
+        to this value and then uses that for Fs parameter
+    :param: logscale - rescale data based on log values?  defaults is True
+    :param: axis - the time axis
+    :param: window, detrend, method, NW, segments_per_block, dtype - as for psd
+    :param: **kwargs - scale_by_freq (default True), as for matplotlib.mlab.specgram.  As for
+        psd, the other mlab keywords (NFFT, Fs, noverlap, pad_to, sides, mode) raise a TypeError.
+
+    :returns: - tuple of three numpy arrays:
+            power - power (dB/Hz), the time axis of signal replaced by
+                    two axes, freqs by bins
+            freqs - in Hz
+            bins - in seconds
+    """
+    signal, sampling_frequency = _resampled(signal, sampling_frequency, high_frequency_cutoff, axis, dtype)
+    num_data_samples = signal.shape[axis]
+    specgram_settings = find_NFFT_and_noverlap(frequency_resolution,
+                                               sampling_frequency,
+                                               time_resolution,
+                                               num_data_samples)
+    NFFT     = specgram_settings['power_of_two_NFFT']
+    noverlap = specgram_settings['noverlap']
+
+    scale_by_freq = _scale_by_freq('specgram', kwargs)
+    power, freqs, starts = _spectra(signal, sampling_frequency, NFFT, noverlap, axis, window, detrend,
+                                    method, NW, segments_per_block, False, scale_by_freq)
+    # segments by freqs by ... -> freqs by segments by ...
+    power = power.swapaxes(0, 1)
+    bins = (starts + NFFT / 2.) / sampling_frequency
+
+    if logscale:
+        power = 10*np.log10(power)
+
+    axis = axis % signal.ndim
+    return np.moveaxis(power, [0, 1], [axis, axis + 1]), freqs, bins
+
+# matplotlib.mlab keywords psd and specgram used to pass on
+_mlab_keywords = ('NFFT', 'Fs', 'noverlap', 'pad_to', 'sides', 'mode')
+
+def _scale_by_freq(name, kwargs):
+    """scale_by_freq from the **kwargs of psd or specgram, rejecting any other keyword"""
+    kwargs = dict(kwargs)
+    scale_by_freq = kwargs.pop('scale_by_freq', True)
+    for key in sorted(kwargs):
+        if key in _mlab_keywords:
+            raise TypeError("%s() no longer passes %s on to matplotlib.mlab: the spectra are one sided, "
+                            "with NFFT (and noverlap) set by the resolution" % (name, key))
+        raise TypeError("%s() got an unexpected keyword argument '%s'" % (name, key))
+    return scale_by_freq
+
+def _resampled(signal, sampling_frequency, high_frequency_cutoff, axis, dtype):
+    """The signal as a float array, resampled to high_frequency_cutoff if that is lower"""
+    signal = np.asarray(signal, dtype=float_dtype(signal, dtype))
+    if (high_frequency_cutoff is not None
+        and high_frequency_cutoff < sampling_frequency):
+        return resample_signal(signal, sampling_frequency, high_frequency_cutoff, axis), high_frequency_cutoff
+    return signal, sampling_frequency
+
+def _tapers(NFFT, window, method, NW, dtype):
+    """K by NFFT array of the windows to average over"""
+    if method == 'multitaper':
+        return scipy.signal.windows.dpss(NFFT, NW, int(2 * NW) - 1).astype(dtype)
+    if method != 'welch':
+        raise ValueError('Unknown method \'%s\'' % method)
+    if callable(window):
+        # a matplotlib.mlab window function, e.g. mlab.window_hanning
+        window = window(np.ones(NFFT, dtype=dtype))
+    elif isinstance(window, basestring):
+        if window == 'flat':
+            window = np.ones(NFFT)
+        elif window in ('hanning', 'hamming', 'bartlett', 'blackman'):
+            window = getattr(np, window)(NFFT)
+        else:
+            raise ValueError("Window is one of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
+    window = np.asarray(window, dtype=dtype)
+    if window.shape != (NFFT,):
+        raise ValueError('window must have NFFT (%d) values' % NFFT)
+    return window[np.newaxis]
+
+def _spectra(signal, Fs, NFFT, noverlap, axis, window, detrend, method, NW, segments_per_block,
+             average, scale_by_freq):
+    """One sided power spectra of the windowed segments of signal along axis.
+
+    :returns: tuple of power (frequencies by the other axes of signal if
+              average, else segments by frequencies by the other axes),
+              the frequencies and the first sample of each segment
+    """
+    dtype = signal.dtype
+    signal = np.rollaxis(signal, axis % signal.ndim, 0)
+    if signal.shape[0] < NFFT:
+        # zero pad short signals to one segment, like mlab
+        padding = np.zeros((NFFT - signal.shape[0],) + signal.shape[1:], dtype=dtype)
+        signal = np.concatenate([signal, padding])
+    signal = np.ascontiguousarray(signal)
+    rest = signal.shape[1:]
+
+    step = NFFT - noverlap
+    nSegments = (signal.shape[0] - noverlap) // step
+    starts = np.arange(nSegments) * step
+    # a view of all segments of all traces: segments by NFFT by the other axes
+    segments = as_strided(signal, shape=(nSegments, NFFT) + rest,
+                          strides=(signal.strides[0] * step,) + signal.strides)
+
+    tapers = _tapers(NFFT, window, method, NW, dtype)
+    tapers = tapers.reshape(tapers.shape + (1,) * len(rest))
+    nFreqs = NFFT // 2 + 1
+    freqs = np.arange(nFreqs) * (float(Fs) / NFFT)
+
+    # one sided: double everything but DC and (for even NFFT) the nyquist frequency
+    scaling = np.full(nFreqs, 2.)
+    scaling[0] = 1.
+    if NFFT % 2 == 0:
+        scaling[-1] = 1.
+    scaling = scaling.reshape((nFreqs,) + (1,) * len(rest)) / len(tapers)
+
+    if average:
+        power = np.zeros((nFreqs,) + rest, dtype=dtype)
+    else:
+        power = np.empty((nSegments, nFreqs) + rest, dtype=dtype)
+    for start in range(0, nSegments, segments_per_block):
+        block = segments[start:start + segments_per_block]
+        if detrend == 'mean':
+            block = block - block.mean(axis=1)[:, np.newaxis]
+        elif detrend == 'linear':
+            block = scipy.signal.detrend(block, axis=1).astype(dtype)
+        elif detrend != 'none':
+            raise ValueError('Unknown detrend \'%s\'' % detrend)
+
+        blockPower = 0
+        for taper in tapers:
+            if scale_by_freq:
+                norm = Fs * (taper * taper).sum()
+            else:
+                norm = taper.sum() ** 2
+            spectrum = np.fft.rfft(block * taper, axis=1)
+            blockPower = blockPower + (spectrum.real ** 2 + spectrum.imag ** 2) / norm
+        blockPower = blockPower * scaling
+
+        if average:
+            power += blockPower.sum(axis=0).astype(dtype)
+        else:
+            power[start:start + segments_per_block] = blockPower
+
+    if average:
+        power /= nSegments
+    return power, freqs, starts
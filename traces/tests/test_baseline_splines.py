@@ -0,0 +1,69 @@
+"""The batched baseline_splines gives the splines the per-trace splrep fit
+did, control point by control point."""
+import numpy as np
+import pytest
+from scipy.interpolate import splrep, splev
+
+import traces as tm
+
+def reference(traces, n_control_points, std_cutoff=2.25):
+    """The old loop: mask each trace, average its control point ranges, splrep"""
+    traces = traces.reshape(traces.shape[0], -1)
+    num_points = traces.shape[0]
+    baselines = np.empty(traces.shape)
+    for trace in range(traces.shape[1]):
+        masked = tm.mask_deviations(traces[:, trace], std_cutoff=std_cutoff)
+        num_segments = n_control_points - 2
+        edge_size = int(np.ceil(num_points * 0.1))
+        parts = [masked[:edge_size]]
+        xs = [0]
+        if num_segments > 0:
+            middle = np.array_split(masked[edge_size:-edge_size], num_segments)
+            parts.extend(middle)
+            xs.extend([len(middle[0]) / 2 + len(middle[0]) * i for i in range(num_segments)])
+        parts.append(masked[-edge_size:])
+        xs.append(num_points)
+
+        # nan for ranges with every point masked, then the mean of the others
+        means = np.array([np.nan if part.count() == 0 else part.mean() for part in parts])
+        means[np.isnan(means)] = means[~np.isnan(means)].mean()
+        tck = splrep(xs, means, k=1 if n_control_points <= 3 else 3)
+        baselines[:, trace] = splev(np.arange(num_points), tck)
+    return baselines
+
+def make_traces(shape, seed=0):
+    random = np.random.RandomState(seed)
+    time = np.arange(shape[0]).reshape((-1,) + (1,) * (len(shape) - 1))
+    traces = 100 + 10 * np.sin(time / 90.) + random.randn(*shape)
+    # transients for the masking to remove
+    traces[50:60] += 30
+    traces[200:215] += 20
+    return traces
+
+@pytest.mark.parametrize('n_control_points', [2, 3, 4, 5, 8])
+@pytest.mark.parametrize('shape', [(400,), (400, 3), (401, 3, 2)])
+def test_matches_per_trace_fit(n_control_points, shape):
+    traces = make_traces(shape)
+    baselines = tm.baseline_splines(traces, n_control_points)
+    assert baselines.shape == traces.shape
+    np.testing.assert_allclose(baselines.reshape(shape[0], -1), reference(traces, n_control_points),
+                               rtol=1e-8)
+
+# n_control_points: range raised far enough to be masked, covering an edge or middle control point range
+NAN_RANGES = {3: (0, 45), 8: (90, 150)}
+
+@pytest.mark.parametrize('n_control_points', sorted(NAN_RANGES))
+def test_nan_control_points(n_control_points):
+    # a range with every point masked has no mean, and gets that of the others
+    traces = make_traces((400, 2))
+    start, stop = NAN_RANGES[n_control_points]
+    traces[start:stop, 1] += 500
+    assert tm.mask_deviations(traces).mask[start:stop, 1].all()
+    baselines = tm.baseline_splines(traces, n_control_points)
+    assert np.isfinite(baselines).all()
+    np.testing.assert_allclose(baselines, reference(traces, n_control_points), rtol=1e-8)
+
+def test_dtype():
+    traces = make_traces((300, 2)).astype(np.float32)
+    assert tm.baseline_splines(traces, 5).dtype == np.float32
+    assert tm.baseline_splines(traces, 5, dtype=np.float64).dtype == np.float64
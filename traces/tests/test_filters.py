@@ -0,0 +1,100 @@
+"""Chunked and FFT filtering give the same result as filtering all at once,
+and the wrappers match the lfilter versions they replaced."""
+import numpy as np
+import pytest
+import scipy.signal
+
+import traces as tm
+from traces import traceRoutines
+from traces.filterRoutines import make_fir_filter
+
+FS = 1000.
+
+def make_signal(shape, seed=0):
+    random = np.random.RandomState(seed)
+    return random.randn(*shape) + 0.5 * np.sin(np.arange(shape[0]) / 7.).reshape((-1,) + (1,) * (len(shape) - 1))
+
+FILTERS = {
+    'butter': dict(family='butter', cutoffs=(20., 200.)),
+    'bessel_low': dict(family='bessel', cutoffs=50., kind='low'),
+    'fir': dict(family='fir', cutoffs=(20., 200.), taps=61),
+    'fir_fft': dict(family='fir', cutoffs=(20., 200.), taps=61, method='fft'),
+    'fir_high_zero_phase': dict(family='fir', cutoffs=100., kind='high', taps=31, zero_phase=True),
+    'fir_fft_zero_phase': dict(family='fir', cutoffs=(20., 200.), taps=61, method='fft', zero_phase=True),
+}
+
+@pytest.mark.parametrize('name', sorted(FILTERS))
+@pytest.mark.parametrize('chunk_size', [1, 7, 100, 1000])
+@pytest.mark.parametrize('axis', [0, -1])
+def test_chunked_matches_whole(name, chunk_size, axis):
+    settings = dict(FILTERS[name])
+    cutoffs = settings.pop('cutoffs')
+    data = make_signal((500, 3))
+    if axis == -1:
+        data = data.T.copy()
+    whole = tm.filter_traces(data, FS, cutoffs, axis=axis, **dict(settings, method='direct'))
+    chunked = tm.filter_traces(data, FS, cutoffs, axis=axis, chunk_size=chunk_size, **settings)
+    np.testing.assert_allclose(chunked, whole, rtol=0, atol=1e-10)
+
+def test_chunked_into_out():
+    data = make_signal((300, 2)).astype(np.float32)
+    out = np.zeros(data.shape, dtype=np.float32)
+    result = tm.filter_traces(data, FS, 50., kind='low', chunk_size=64, out=out)
+    assert result is out
+    np.testing.assert_allclose(out, tm.filter_traces(data, FS, 50., kind='low'), rtol=0, atol=1e-5)
+
+@pytest.mark.parametrize('taps', [5, 101, 301])
+def test_fft_matches_lfilter(taps):
+    data = make_signal((700, 4))
+    kernel = tm.design_filter(FS, 100., kind='low', family='fir', taps=taps)
+    stream = tm.StreamingFilter(kernel, method='fft')
+    filtered = np.concatenate([stream.process(data[start:start + 128]) for start in range(0, 700, 128)])
+    np.testing.assert_allclose(filtered, scipy.signal.lfilter(kernel, [1.], data, axis=0), rtol=0, atol=1e-10)
+
+@pytest.mark.parametrize('method', ['direct', 'fft'])
+def test_flush_emits_zero_phase_tail(method):
+    data = make_signal((250, 2))
+    kernel = tm.design_filter(FS, 100., kind='low', family='fir', taps=41)
+    stream = tm.StreamingFilter(kernel, zero_phase=True, method=method)
+    chunks = [stream.process(data[start:start + 60]) for start in range(0, 250, 60)]
+    # the first (taps-1)/2 filtered samples are held back ...
+    assert sum(len(c) for c in chunks) == 250 - 20
+    tail = stream.flush()
+    assert tail.shape == (20, 2)
+    # ... and the kernel delay is removed, zero padding the end
+    padded = np.concatenate([data, np.zeros((20, 2))])
+    expected = scipy.signal.lfilter(kernel, [1.], padded, axis=0)[20:]
+    np.testing.assert_allclose(np.concatenate(chunks + [tail]), expected, rtol=0, atol=1e-10)
+
+def test_flush_without_delay_is_empty():
+    stream = tm.StreamingFilter(tm.design_filter(FS, 50., kind='low'))
+    assert len(stream.flush()) == 0
+    stream.process(make_signal((40, 2)))
+    assert stream.flush().shape == (0, 2)
+
+def test_chunked_zero_phase_iir_raises():
+    data = make_signal((200, 2))
+    with pytest.raises(ValueError):
+        tm.filter_traces(data, FS, 50., kind='low', zero_phase=True, chunk_size=50)
+    with pytest.raises(ValueError):
+        tm.StreamingFilter(tm.design_filter(FS, 50., kind='low'), zero_phase=True)
+    # all at once it is sosfiltfilt
+    np.testing.assert_allclose(tm.filter_traces(data, FS, 50., kind='low', zero_phase=True),
+                               scipy.signal.sosfiltfilt(tm.design_filter(FS, 50., kind='low'), data, axis=0))
+
+def test_fir_filter_matches_rolled_lfilter():
+    # the old fir_filter: lfilter, then np.roll back by the kernel delay (wrapping the end around)
+    sig = make_signal((1000,))
+    kernel = make_fir_filter(FS, (20., 200.), 'hamming', 101, 'band')
+    old = np.roll(scipy.signal.lfilter(kernel, [1], sig), -101 // 2 + 1)
+    new = tm.fir_filter(sig, FS, (20., 200.))
+    np.testing.assert_allclose(new[:-50], old[:-50], rtol=0, atol=1e-10)
+    np.testing.assert_allclose(tm.fir_filter(np.tile(sig, (2, 1)), FS, (20., 200.))[1], new, rtol=0, atol=1e-12)
+
+@pytest.mark.parametrize('family', ['butter', 'bessel'])
+def test_bandpass_matches_lfilter(family):
+    # the old wrappers: (b, a) designs run through lfilter
+    sig = make_signal((1000,))
+    b, a = getattr(scipy.signal, family)(2, [20. / (FS / 2), 200. / (FS / 2)], btype='band')
+    wrapper = getattr(traceRoutines, family + '_bandpass_filter')
+    np.testing.assert_allclose(wrapper(sig, 20., 200., FS), scipy.signal.lfilter(b, a, sig), rtol=0, atol=1e-10)
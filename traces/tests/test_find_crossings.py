@@ -0,0 +1,90 @@
+"""findCrossings gives the crossings of findLevelsNd (and of a scalar
+Schmitt trigger with a fallingLevel), however the time axis is chunked."""
+import numpy as np
+import pytest
+
+import traces as tm
+
+def make_traces(shape, seed=0):
+    # floats, so no sample is exactly at a level
+    random = np.random.RandomState(seed)
+    return np.cumsum(random.randn(*shape), axis=0) * 0.3 + random.randn(*shape)
+
+def schmitt_crossings(trace, level, fallingLevel, mode):
+    """Time indices (sample before) of the crossings of one trace, one sample at a time"""
+    times = []
+    state = None
+    for t, value in enumerate(trace):
+        new = state
+        if value > level[t]:
+            new = 1
+        elif value < fallingLevel[t]:
+            new = 0
+        if state is not None and new != state:
+            if mode == 'both' or (mode == 'rising') == (new == 1):
+                times.append(t - 1)
+        state = new
+    return times
+
+def spaced(times, minSpacing):
+    kept = []
+    for t in times:
+        if not kept or t - kept[-1] >= minSpacing:
+            kept.append(t)
+    return kept
+
+@pytest.mark.parametrize('chunkSize', [None, 1, 7, 64, 1000])
+@pytest.mark.parametrize('boxWidth', [0, 5])
+@pytest.mark.parametrize('mode', ['rising', 'falling'])
+def test_matches_find_levels(chunkSize, boxWidth, mode):
+    A = make_traces((300, 4, 3))
+    expected = np.nonzero(tm.findLevelsNd(A, 0.5, mode=mode, boxWidth=boxWidth))
+    found = tm.findCrossings(A, 0.5, mode=mode, boxWidth=boxWidth, chunkSize=chunkSize)
+    # findLevelsNd's nonzero is in C order, findCrossings' by trace then time
+    order = np.lexsort((expected[0], expected[2], expected[1]))
+    for e, f in zip(expected, found):
+        np.testing.assert_array_equal(e[order], f)
+
+@pytest.mark.parametrize('chunkSize', [None, 3, 50])
+@pytest.mark.parametrize('axis', [0, 1])
+def test_per_trace_and_wave_levels(chunkSize, axis):
+    A = make_traces((200, 5))
+    random = np.random.RandomState(1)
+    perTrace = random.randn(5)
+    wave = random.randn(200, 5)
+    if axis == 1:
+        A, wave = A.T, wave.T
+    for level, broadcast in ((perTrace, np.expand_dims(perTrace, axis)), (wave, wave)):
+        expected = np.nonzero(tm.findLevelsNd(A, broadcast, mode='rising', axis=axis))
+        found = tm.findCrossings(A, level, mode='rising', axis=axis, chunkSize=chunkSize)
+        other = 1 - axis
+        order = np.lexsort((expected[axis], expected[other]))
+        for e, f in zip(expected, found):
+            np.testing.assert_array_equal(e[order], f)
+
+@pytest.mark.parametrize('chunkSize', [None, 1, 13])
+@pytest.mark.parametrize('mode', ['rising', 'falling', 'both'])
+@pytest.mark.parametrize('minSpacing', [0, 10])
+def test_schmitt_trigger(chunkSize, mode, minSpacing):
+    A = make_traces((400, 3, 2), seed=2)
+    level = np.linspace(0.5, 1.5, 400)
+    (times, cells, trials), direction = tm.findCrossings(A, level[:, np.newaxis, np.newaxis] * np.ones(A.shape), -0.5,
+                                                          mode=mode, minSpacing=minSpacing, chunkSize=chunkSize,
+                                                          returnDirection=True)
+    for cell in range(3):
+        for trial in range(2):
+            mine = (cells == cell) & (trials == trial)
+            expected = schmitt_crossings(A[:, cell, trial], level, np.full(400, -0.5), mode)
+            np.testing.assert_array_equal(times[mine], spaced(expected, minSpacing))
+            if mode == 'both' and not minSpacing:
+                assert np.all(direction[mine][1:] == -direction[mine][:-1])
+
+def test_falling_level_above_level():
+    with pytest.raises(ValueError):
+        tm.findCrossings(make_traces((50, 2)), 0., 1.)
+
+def test_empty():
+    for shape in ((0, 3), (0,), (1, 4)):
+        found = tm.findCrossings(np.zeros(shape), 0.5, boxWidth=3, minSpacing=2)
+        assert len(found) == len(shape)
+        assert all(len(f) == 0 for f in found)
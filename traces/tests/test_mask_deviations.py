@@ -0,0 +1,77 @@
+"""mask_deviations' running sums give the masks and pass counts of
+recomputing the statistics over a numpy masked array on every pass."""
+import numpy as np
+import pytest
+
+import traces as tm
+
+def reference(trace, std_cutoff, iterations, method):
+    """Mask of one trace and the number of passes, with np.ma statistics"""
+    mask = np.zeros(len(trace), dtype=bool)
+    passes = 0
+    for i in range(iterations + 1):
+        masked = np.ma.masked_array(trace, mask)
+        if method == 'std':
+            cutoff = masked.mean() + masked.std() * std_cutoff
+        else:
+            center = np.ma.median(masked)
+            cutoff = center + 1.4826 * np.ma.median(np.ma.abs(masked - center)) * std_cutoff
+        passes += 1
+        new = mask | (trace >= cutoff)
+        if np.array_equal(new, mask):
+            break
+        mask = new
+    return mask, passes
+
+def make_traces(shape, seed=0):
+    random = np.random.RandomState(seed)
+    traces = random.randn(*shape)
+    # transients of different sizes, so traces converge after different numbers of passes
+    ramp = np.linspace(1, 8, 40).reshape((-1,) + (1,) * (len(shape) - 1))
+    traces[100:140] += ramp * random.uniform(0.2, 2, shape[1:])
+    traces[300:310] += 4
+    return traces
+
+@pytest.mark.parametrize('method', ['std', 'mad'])
+@pytest.mark.parametrize('iterations', [0, 2, 40])
+@pytest.mark.parametrize('axis', [0, 1])
+def test_matches_masked_array(method, iterations, axis):
+    traces = make_traces((500, 4, 3))
+    # rounded, so the mad method has ties
+    if method == 'mad':
+        traces = np.round(traces, 1)
+    if axis == 1:
+        traces = traces.swapaxes(0, 1)
+    masked, passes = tm.mask_deviations(traces, axis=axis, iterations=iterations, method=method,
+                                        return_iterations=True)
+    assert passes.shape == (4, 3)
+    data = traces if axis == 0 else traces.swapaxes(0, 1)
+    mask = masked.mask if axis == 0 else masked.mask.swapaxes(0, 1)
+    for cell in range(4):
+        for trial in range(3):
+            expected_mask, expected_passes = reference(data[:, cell, trial], 2.25, iterations, method)
+            np.testing.assert_array_equal(mask[:, cell, trial], expected_mask)
+            assert passes[cell, trial] == expected_passes
+    if iterations == 40:
+        # some traces converged, and dropped out, before others
+        assert passes.min() < passes.max()
+
+def test_1d():
+    trace = make_traces((500,))
+    masked, passes = tm.mask_deviations(trace, return_iterations=True)
+    expected_mask, expected_passes = reference(trace, 2.25, 40, 'std')
+    np.testing.assert_array_equal(masked.mask, expected_mask)
+    assert passes == expected_passes
+
+def test_percentile():
+    traces = make_traces((300, 3))
+    masked, passes = tm.mask_deviations(traces, method='percentile', window=51, percentile=20,
+                                        return_iterations=True)
+    np.testing.assert_array_equal(passes, 1)
+    for i in range(3):
+        baseline = [np.percentile(traces[max(t - 25, 0):t + 26, i], 20) for t in range(300)]
+        residuals = traces[:, i] - baseline
+        spread = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+        np.testing.assert_array_equal(masked.mask[:, i], residuals >= 2.25 * spread)
+    with pytest.raises(ValueError):
+        tm.mask_deviations(traces, method='percentile')
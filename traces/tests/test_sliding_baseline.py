@@ -0,0 +1,64 @@
+"""The running percentile baseline equals np.percentile over each centred
+window, truncated at the ends of the trace."""
+import numpy as np
+import pytest
+
+import traces as tm
+from traces.traceRoutines import _rolling_percentile
+
+def brute_force(trace, window, percentile):
+    n = len(trace)
+    baseline = np.empty(n)
+    for t in range(n):
+        start = max(t - window // 2, 0)
+        baseline[t] = np.percentile(trace[start:min(t - window // 2 + window, n)], percentile)
+    return baseline
+
+def make_traces(shape, rounded=False, seed=0):
+    random = np.random.RandomState(seed)
+    traces = np.cumsum(random.randn(*shape), axis=0) + 100
+    if rounded:
+        # many ties, as with integer camera counts
+        traces = np.round(traces)
+    return traces
+
+@pytest.mark.parametrize('window', [1, 2, 7, 30, 31, 500])
+@pytest.mark.parametrize('percentile', [0, 8, 37.5, 50, 100])
+@pytest.mark.parametrize('rounded', [False, True])
+def test_rolling_percentile(window, percentile, rounded):
+    trace = make_traces((200,), rounded)
+    np.testing.assert_allclose(_rolling_percentile(trace, window, percentile),
+                               brute_force(trace, window, percentile), rtol=0, atol=1e-9)
+
+def test_constant_trace():
+    trace = np.full(50, 3.)
+    np.testing.assert_array_equal(_rolling_percentile(trace, 10, 8), trace)
+
+@pytest.mark.parametrize('n_processes', [1, 2])
+@pytest.mark.parametrize('window', [41, 400])
+def test_sliding_baseline(n_processes, window):
+    traces = make_traces((150, 3, 2), rounded=True)
+    baseline = tm.sliding_baseline(traces, window, percentile=20, n_processes=n_processes)
+    for cell in range(3):
+        for trial in range(2):
+            np.testing.assert_allclose(baseline[:, cell, trial], brute_force(traces[:, cell, trial], window, 20),
+                                       rtol=0, atol=1e-9)
+
+def test_sliding_baseline_axis():
+    traces = make_traces((4, 120))
+    baseline = tm.sliding_baseline(traces, 25, percentile=8, axis=1, n_processes=2)
+    for i in range(4):
+        np.testing.assert_allclose(baseline[i], brute_force(traces[i], 25, 8), rtol=0, atol=1e-9)
+
+@pytest.mark.parametrize('step', [2, 5, 40])
+@pytest.mark.parametrize('window', [51, 300])
+def test_stepped_percentile(step, window):
+    traces = make_traces((203, 3), rounded=True)
+    baseline = tm.sliding_baseline(traces, window, percentile=8, step=step)
+    # exact every step points and at the end, linear in between
+    points = np.append(np.arange(0, 203, step), 202)
+    for i in range(3):
+        expected = brute_force(traces[:, i], window, 8)
+        np.testing.assert_allclose(baseline[points, i], expected[points], rtol=0, atol=1e-9)
+        np.testing.assert_allclose(baseline[:, i], np.interp(np.arange(203), points, expected[points]),
+                                   rtol=0, atol=1e-9)
@@ -0,0 +1,76 @@
+"""psd and specgram of a 1d signal match matplotlib.mlab, which they used to
+wrap, and batches of traces match the traces one at a time."""
+import numpy as np
+import pytest
+
+import traces as tm
+
+mlab = pytest.importorskip('matplotlib.mlab')
+
+FS = 1000.
+
+def make_signal(shape, seed=0):
+    random = np.random.RandomState(seed)
+    time = np.arange(shape[0]).reshape((-1,) + (1,) * (len(shape) - 1)) / FS
+    return np.sin(2 * np.pi * 60 * time) + random.randn(*shape)
+
+@pytest.mark.parametrize('n', [5000, 100])
+@pytest.mark.parametrize('scale_by_freq', [True, False])
+@pytest.mark.parametrize('detrend', ['none', 'mean', 'linear'])
+def test_psd_matches_mlab(n, scale_by_freq, detrend):
+    signal = make_signal((n,))
+    power, freqs = tm.psd(signal, FS, 4., detrend=detrend, scale_by_freq=scale_by_freq)
+    NFFT = tm.find_NFFT(4., FS, force_power_of_two=True)
+    expected, expected_freqs = mlab.psd(signal, NFFT=NFFT, Fs=FS, noverlap=0, detrend=detrend,
+                                        scale_by_freq=scale_by_freq)
+    np.testing.assert_allclose(freqs, expected_freqs)
+    np.testing.assert_allclose(power, expected, rtol=1e-10, atol=0)
+
+# window: (as given to psd, as given to mlab.psd)
+WINDOWS = {
+    'hamming': ('hamming', lambda x: np.hamming(len(x)) * x),
+    'flat': ('flat', mlab.window_none),
+    'mlab_function': (mlab.window_hanning, mlab.window_hanning),
+}
+
+@pytest.mark.parametrize('window', sorted(WINDOWS))
+def test_psd_windows_match_mlab(window):
+    signal = make_signal((3000,))
+    window, mlab_window = WINDOWS[window]
+    power, freqs = tm.psd(signal, FS, 4., window=window)
+    NFFT = tm.find_NFFT(4., FS, force_power_of_two=True)
+    np.testing.assert_allclose(power, mlab.psd(signal, NFFT=NFFT, Fs=FS, noverlap=0, window=mlab_window)[0],
+                               rtol=1e-10, atol=0)
+
+def test_specgram_matches_mlab():
+    signal = make_signal((4000,))
+    power, freqs, bins = tm.specgram(signal, FS, 0.05, 10., logscale=False)
+    settings = tm.find_NFFT_and_noverlap(10., FS, 0.05, 4000)
+    expected, expected_freqs, expected_bins = mlab.specgram(signal, NFFT=settings['power_of_two_NFFT'], Fs=FS,
+                                                            noverlap=settings['noverlap'])
+    np.testing.assert_allclose(freqs, expected_freqs)
+    np.testing.assert_allclose(bins, expected_bins)
+    np.testing.assert_allclose(power, expected, rtol=1e-10, atol=0)
+    np.testing.assert_allclose(tm.specgram(signal, FS, 0.05, 10.)[0], 10 * np.log10(expected), rtol=1e-10)
+
+def test_batch_matches_single_traces():
+    signals = make_signal((2000, 3, 2))
+    power, freqs = tm.psd(signals, FS, 4.)
+    bins_power = tm.specgram(signals.transpose(1, 0, 2), FS, 0.05, 10., axis=1)[0]
+    for channel in range(3):
+        for trial in range(2):
+            np.testing.assert_allclose(power[:, channel, trial], tm.psd(signals[:, channel, trial], FS, 4.)[0],
+                                       rtol=1e-10)
+            np.testing.assert_allclose(bins_power[channel, :, :, trial],
+                                       tm.specgram(signals[:, channel, trial], FS, 0.05, 10.)[0], rtol=1e-10)
+
+@pytest.mark.parametrize('keyword', ['pad_to', 'sides', 'NFFT'])
+def test_mlab_keywords_rejected(keyword):
+    signal = make_signal((1000,))
+    with pytest.raises(TypeError) as error:
+        tm.psd(signal, FS, 4., **{keyword: 512})
+    assert keyword in str(error.value)
+    with pytest.raises(TypeError):
+        tm.specgram(signal, FS, 0.05, 10., **{keyword: 512})
+    with pytest.raises(TypeError):
+        tm.psd(signal, FS, 4., scale_by_frequency=False)
@@ -0,0 +1,67 @@
+"""float32 traces stay float32 through the trace routines, match float64
+within float32 tolerance, and dtype= overrides the result dtype."""
+import numpy as np
+import pytest
+
+import traces as tm
+
+def make_traces(dtype, shape=(600, 5, 3), seed=0):
+    random = np.random.RandomState(seed)
+    time = np.arange(shape[0])[:, np.newaxis, np.newaxis]
+    slow = 100 + 10 * np.sin(time / 80.) + random.rand(1, shape[1], shape[2]) * 20
+    return (slow + random.randn(*shape)).astype(dtype)
+
+# name: function of a time x cells x trials array
+ROUTINES = {
+    'baseline': lambda A, **kw: tm.baseline(A, [0, 50], 0, **kw),
+    'normalize': lambda A, **kw: tm.normalize(A, [0, 50], 0, **kw),
+    'normalizeAndBaseline': lambda A, **kw: tm.normalizeAndBaseline(A, [0, 50], 0, **kw),
+    'boxcar': lambda A, **kw: tm.boxcar(A, 5, axis=0, **kw),
+    'smooth': lambda A, **kw: tm.smooth(A, 11, **kw),
+    'smooth_flat': lambda A, **kw: tm.smooth(A, 40, 'flat', **kw),
+    'smooth_fft': lambda A, **kw: tm.smooth(A, 11, method='fft', **kw),
+    'lowess': lambda A, **kw: tm.lowess(np.arange(len(A)), A[:, :2, 0], f=0.1, iters=2, **kw),
+    'baseline_splines': lambda A, **kw: tm.baseline_splines(A, 5, **kw),
+    'sliding_baseline': lambda A, **kw: tm.sliding_baseline(A, 101, step=10, **kw),
+    'sliding_dff': lambda A, **kw: tm.sliding_dff(A, 101, method='min_smoothed', **kw),
+    'filter_traces': lambda A, **kw: tm.filter_traces(A, 30., 2., kind='low', zero_phase=True, **kw),
+    'fir_filter': lambda A, **kw: tm.fir_filter(A, 30., 2., kind='low', taps=31, axis=0, **kw),
+    'butter_bandpass_filter': lambda A, **kw: tm.butter_bandpass_filter(A, 0.5, 5., 30., axis=0, **kw),
+    'psd': lambda A, **kw: tm.psd(A, 30., 0.5, **kw)[0],
+    'specgram': lambda A, **kw: tm.specgram(A, 30., 2., 1., logscale=False, **kw)[0],
+    'pipeline': lambda A, **kw: tm.TracePipeline(cells_per_block=2).normalize((0, 50)).baseline((0, 50))
+                                  .boxcar(3).run(A, **kw),
+}
+
+@pytest.mark.parametrize('name', sorted(ROUTINES))
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_dtype_preserved(name, dtype):
+    result = ROUTINES[name](make_traces(dtype))
+    assert result.dtype == dtype
+
+@pytest.mark.parametrize('name', sorted(ROUTINES))
+def test_float32_matches_float64(name):
+    result32 = ROUTINES[name](make_traces(np.float32))
+    result64 = ROUTINES[name](make_traces(np.float64))
+    scale = np.abs(result64).max()
+    np.testing.assert_allclose(result32, result64, rtol=0, atol=1e-4 * scale)
+
+@pytest.mark.parametrize('name', sorted(ROUTINES))
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_dtype_override(name, dtype):
+    result = ROUTINES[name](make_traces(np.int32), dtype=dtype)
+    assert result.dtype == dtype
+
+@pytest.mark.parametrize('dtype', [np.int16, np.int64, bool])
+def test_non_float_is_float64(dtype):
+    assert tm.float_dtype(np.zeros(3, dtype=dtype)) == np.float64
+    assert tm.boxcar(np.arange(10).astype(dtype), 3).dtype == np.float64
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_crossings_match_float64(dtype):
+    A = make_traces(dtype)
+    crossings = tm.findCrossings(A, 105., fallingLevel=103., mode='both', boxWidth=3)
+    reference = tm.findCrossings(A.astype(np.float64), 105., fallingLevel=103., mode='both', boxWidth=3)
+    # crossings can only move where a float32 rounding lands on the other side of a level
+    assert abs(len(crossings[0]) - len(reference[0])) <= 2
+    assert tm.findLevelsNd(A, 105., boxWidth=3, dtype=np.float64).shape == (A.shape[0] - 1,) + A.shape[1:]
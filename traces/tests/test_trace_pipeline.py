@@ -0,0 +1,54 @@
+"""Each TracePipeline stage gives the same result as calling its trace
+routine directly, for 1, 2 and 3d traces and for a last block of one cell."""
+import numpy as np
+import pytest
+
+import traces as tm
+
+def make_traces(shape, seed=0):
+    random = np.random.RandomState(seed)
+    time = np.arange(shape[0]).reshape((-1,) + (1,) * (len(shape) - 1))
+    return 100 + 10 * np.sin(time / 80.) + random.randn(*shape)
+
+# name: (add the stage to a pipeline, the same thing done directly on a time x ... array)
+STAGES = {
+    'baseline': (lambda p: p.baseline((0, 50)),
+                 lambda A: tm.baseline(A, [0, 50], 0)),
+    'normalize': (lambda p: p.normalize((0, 50)),
+                  lambda A: tm.normalize(A, [0, 50], 0)),
+    'boxcar': (lambda p: p.boxcar(5),
+               lambda A: tm.boxcar(A, 5, axis=0)),
+    'smooth': (lambda p: p.smooth(11),
+               lambda A: tm.smooth(A, 11, axis=0)),
+    'filter': (lambda p: p.filter(30., 2., kind='low', zero_phase=True),
+               lambda A: tm.filter_traces(A, 30., 2., kind='low', zero_phase=True, axis=0)),
+    'dff': (lambda p: p.dff(101, step=10),
+            lambda A: tm.sliding_dff(A, 101, step=10, axis=0)),
+    'normalize_splines': (lambda p: p.normalize_splines(5),
+                          lambda A: A / tm.baseline_splines(A, 5).reshape(A.shape)),
+}
+
+SHAPES = {
+    '1d': (400,),
+    '2d': (400, 6),
+    '3d': (400, 6, 3),
+    '3d_one_trial': (400, 6, 1),
+    'one_cell_last_block': (400, 5, 2),
+}
+
+@pytest.mark.parametrize('shape', sorted(SHAPES))
+@pytest.mark.parametrize('stage', sorted(STAGES))
+def test_stage_matches_routine(stage, shape):
+    add_stage, direct = STAGES[stage]
+    traces = make_traces(SHAPES[shape])
+    # blocks of 2 cells, so 5 cells leave a last block of one
+    result = add_stage(tm.TracePipeline(cells_per_block=2)).run(traces)
+    assert result.shape == traces.shape
+    np.testing.assert_allclose(result, direct(traces), rtol=1e-10, atol=1e-10)
+
+def test_chain_matches_routines():
+    traces = make_traces((400, 5, 2))
+    pipeline = tm.TracePipeline(cells_per_block=2).normalize((0, 50)).smooth(11).normalize_splines(5)
+    expected = tm.smooth(tm.normalize(traces, [0, 50], 0), 11, axis=0)
+    expected = expected / tm.baseline_splines(expected, 5)
+    np.testing.assert_allclose(pipeline.run(traces), expected, rtol=1e-10)
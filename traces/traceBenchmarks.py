@@ -0,0 +1,131 @@
+# speed / correctness benchmarks for the trace routines
+"""
+Benchmarks lowess on long traces, and checks it against the dense n by n
+weight matrix implementation it replaced on traces short enough for that
+to run.
+
+>>> results = benchmarkLowess(sizes=(1000, 100000))  # doctest: +SKIP
+>>> printLowessResults(results)  # doctest: +SKIP
+
+or from the shell: python traceBenchmarks.py
+"""
+import numpy as np
+import time
+
+from traceRoutines import lowess
+
+__all__ = ['lowessReference', 'benchmarkLowess', 'printLowessResults']
+
+def lowessReference(x, y, f=2./3., iters=3):
+    """The original O(n^2) lowess, with a full n by n weight matrix and a
+    python loop over the points.  Kept to check lowess against.
+
+    :param x: x values
+    :param y: y values (1d)
+    :param f: span (region size to weight for smoothing)
+    :param iters: number of times to apply smoothing
+    :returns: a smoothed version of y
+    """
+    n = len(x)
+    r = int(np.ceil(f*n))
+    h = [np.sort(abs(x-x[i]))[r] for i in range(n)]
+    w = np.clip(abs(([x]-np.transpose([x]))/h),0.0,1.0)
+    w = 1-w*w*w
+    w = w*w*w
+    yest = np.zeros(n)
+    delta = np.ones(n)
+    for iteration in range(iters):
+        for i in xrange(n):
+            weights = delta * w[:,i]
+            weights_mul_x = weights * x
+            b1 = np.dot(weights,y)
+            b2 = np.dot(weights_mul_x,y)
+            A11 = sum(weights)
+            A12 = sum(weights_mul_x)
+            A21 = A12
+            A22 = np.dot(weights_mul_x,x)
+            determinant = A11*A22 - A12*A21
+            beta1 = (A22*b1-A12*b2) / determinant
+            beta2 = (A11*b2-A21*b1) / determinant
+            yest[i] = beta1 + beta2*x[i]
+        residuals = y-yest
+        s = np.median(abs(residuals))
+        delta[:] = np.clip(residuals/(6*s),-1,1)
+        delta[:] = 1-delta*delta
+        delta[:] = delta*delta
+    return yest
+
+def benchmarkLowess(sizes=(1000, 10000, 100000), f=0.05, iters=3, deltaFraction=0.01,
+                    nTraces=1, exactLimit=20000, referenceLimit=2000, seed=0, verbose=True):
+    """Time lowess on noisy traces of several lengths.
+
+    :param sizes: trace lengths to run
+    :param f: lowess span
+    :param iters: lowess robustifying iterations
+    :param deltaFraction: delta passed to lowess, as a fraction of the x range
+    :param nTraces: number of traces smoothed in one call
+    :param exactLimit: also time the exact (delta=0) fit on traces up to this length
+    :param referenceLimit: also run lowessReference on traces up to this length
+    :param seed: random seed for the traces
+    :param verbose: print each result as it is measured
+    :returns: list of dicts with the size, seconds for the delta fit, the
+              exact fit and the reference (None where not run), and the
+              largest difference between the exact fit and the reference
+    """
+    random = np.random.RandomState(seed)
+    results = []
+    for size in sizes:
+        x = np.arange(size, dtype='float')
+        y = np.sin(x / (size / 10.))[:, np.newaxis] + random.randn(size, nTraces) * 0.3
+
+        start = time.time()
+        lowess(x, y, f, iters, delta=deltaFraction * size)
+        deltaSeconds = time.time() - start
+
+        exactSeconds = None
+        if size <= max(exactLimit, referenceLimit):
+            start = time.time()
+            exact = lowess(x, y, f, iters)
+            exactSeconds = time.time() - start
+
+        referenceSeconds = None
+        difference = None
+        if size <= referenceLimit:
+            start = time.time()
+            reference = np.column_stack([lowessReference(x, y[:, i], f, iters) for i in range(nTraces)])
+            referenceSeconds = time.time() - start
+            difference = np.abs(reference - exact).max()
+
+        result = {'size': size,
+                  'nTraces': nTraces,
+                  'exactSeconds': exactSeconds,
+                  'deltaSeconds': deltaSeconds,
+                  'referenceSeconds': referenceSeconds,
+                  'difference': difference}
+        results.append(result)
+        if verbose:
+            printLowessResults([result], header=len(results) == 1)
+    return results
+
+def printLowessResults(results, header=True):
+    """Print the results of benchmarkLowess as a table
+
+    :param results: list of dicts from benchmarkLowess
+    :param header: print the column names
+    """
+    if header:
+        print '%10s %8s %12s %12s %15s %12s' % ('size', 'nTraces', 'delta (s)', 'exact (s)',
+                                               'reference (s)', 'difference')
+    for r in results:
+        if r['exactSeconds'] is None:
+            exact = '%12s' % '-'
+        else:
+            exact = '%12.3f' % r['exactSeconds']
+        if r['referenceSeconds'] is None:
+            reference = '%15s %12s' % ('-', '-')
+        else:
+            reference = '%15.3f %12.2g' % (r['referenceSeconds'], r['difference'])
+        print '%10i %8i %12.3f %s %s' % (r['size'], r['nTraces'], r['deltaSeconds'], exact, reference)
+
+if __name__ == '__main__':
+    benchmarkLowess()
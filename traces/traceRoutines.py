@@ -1,4 +1,7 @@
 import numpy as np
+import warnings
+import heapq
+import multiprocessing as mp
 
 from scipy.interpolate import interp1d, splrep, splev
 import scipy.interpolate as interpolate
@@ -6,31 +9,34 @@ from scipy.interpolate import interp1d
 import scipy.ndimage as nd
 import scipy.stats
 import scipy
+from scipy.fftpack import next_fast_len
 
-from scipy.signal import butter, bessel, lfilter
-
-import matplotlib as mpl
-from matplotlib import mlab
+from dtypeRoutines import float_dtype
+from filterRoutines import filter_traces, spectral_inversion, make_fir_filter
+from spectralRoutines import psd, specgram, resample_signal, find_NFFT, \
+                             find_frequency_resolution, find_NFFT_and_noverlap
 
 __all__ = ['baseline', 'normalize', 'normalizeAndBaseline', \
-           'findLevels', 'findLevels1d', 'findLevelsNd', \
+           'findLevels', 'findLevels1d', 'findLevelsNd', 'findCrossings', \
            'boxcar', 'smooth', 'lowess', \
            'fir_filter', 'butter_bandpass_filter', 'psd', 'specgram',\
-           'mask_deviations', 'baseline_splines']
+           'mask_deviations', 'baseline_splines', 'sliding_baseline', 'sliding_dff']
 
-def baseline(A, baseRange, baseAxis):
+def baseline(A, baseRange, baseAxis, dtype=None):
     """Baseline a numpy array using a given range over a specfied axis.
 
     :param A: numpy array of arbitrary dimension
     :param baseRange: list of 2 numbers, specifying the range over which to compute the average for baselining.
     :param baseAxis: the axis of the np to baseline over
+    :param dtype: optional dtype of the result, defaults to that of A if floating point, else float64
     :returns: basedlined array
     """
 
+    A = np.asarray(A, dtype=float_dtype(A, dtype))
     shape = A.shape
     # make a slice to take the mean in the right dimension
     baseSlice = [slice(baseRange[0], baseRange[1]) if a is baseAxis else slice(None) for a in range(len(shape))]
-    base = np.mean(A[baseSlice], axis=baseAxis)
+    base = np.mean(A[tuple(baseSlice)], axis=baseAxis, dtype='float').astype(A.dtype)
 
     # make a slice to pad the numbers to make the broadcasting work
     try:
@@ -41,20 +47,22 @@ def baseline(A, baseRange, baseAxis):
     finally:
         pass
     
-def normalize(A, normRange, normAxis):
+def normalize(A, normRange, normAxis, dtype=None):
     """Normalize a numpy array using a given range over a specfied axis.
 
     :param A: numpy array of arbitrary dimension
     :param normRange: list of 2 numbers, specifying the range over which to compute the average for normalization.
     :param normAxis: the axis of the np to normalize over
+    :param dtype: optional dtype of the result, defaults to that of A if floating point, else float64
     :returns: normalized array
     """
 
+    A = np.asarray(A, dtype=float_dtype(A, dtype))
     shape = A.shape
     # make a slice to take the mean in the right dimension
     # slice(None) effectively means ':', or all the elements
     normSlice = [slice(normRange[0], normRange[1]) if a is normAxis else slice(None) for a in range(len(shape))]
-    norm = np.mean(A[normSlice], axis=normAxis)
+    norm = np.mean(A[tuple(normSlice)], axis=normAxis, dtype='float').astype(A.dtype)
 
     # make a slice to pad the numbers to make the broadcasting work
     # again, slice(None) means ':' and None means an empty dimension (note difference!)
@@ -67,7 +75,7 @@ def normalize(A, normRange, normAxis):
     finally:
         pass
     
-def normalizeAndBaseline(A, baseRange, baseAxis):
+def normalizeAndBaseline(A, baseRange, baseAxis, dtype=None):
     """Normalize, then baseline a numpy array over a given range and on a specfied axis.
 
     Calls normalize, and then baseline
@@ -75,13 +83,14 @@ def normalizeAndBaseline(A, baseRange, baseAxis):
     :param A: numpy array of arbitrary dimension
     :param baseRange: list of 2 numbers, specifying the range over which to compute the average for baselining and normalization
     :param baseAxis: the axis of the np to baseline and normalize over
+    :param dtype: optional dtype of the result, defaults to that of A if floating point, else float64
     :returns: normalized, baselined array
     """
-    return baseline(normalize(A, baseRange, baseAxis), baseRange, baseAxis)
+    return baseline(normalize(A, baseRange, baseAxis, dtype=dtype), baseRange, baseAxis)
 
 # -------------------- LEVEL FINDING ROUTINES------------------------------------------
 
-def findLevels(A, level, mode='rising', boxWidth=0, rangeSubset=None):
+def findLevels(A, level, mode='rising', boxWidth=0, rangeSubset=None, dtype=None):
     """Function to find level crossings in an 1d numpy array.  Based on the Igor
     function FindLevel. 
 
@@ -94,12 +103,14 @@ def findLevels(A, level, mode='rising', boxWidth=0, rangeSubset=None):
     :param mode: optional string: mode specfication. one of 'rising', 'falling' or 'both'
     :param boxWidth: optional int for local boxcar smoothing
     :param rangeSubset: optional list of ints to limit the search
+    :param dtype: optional dtype to smooth and compare in, defaults to that of A if floating point, else float64
     :returns: tuple, a numpy array of level crossings and the number of crossings
     """
     assert mode in ('rising', 'falling', 'both'), 'traceManip.findLevels: Unknown mode \'%s\'' % mode
 
     if boxWidth is not 0:
-        A = np.convolve(A, np.array([1]*boxWidth)/float(boxWidth))
+        dtype = float_dtype(A, dtype)
+        A = np.convolve(np.asarray(A, dtype=dtype), (np.array([1]*boxWidth)/float(boxWidth)).astype(dtype))
 
     crossings = np.diff(np.sign(A-level), axis=0)
     
@@ -113,10 +124,10 @@ def findLevels(A, level, mode='rising', boxWidth=0, rangeSubset=None):
         all_crossing_points = np.where(np.abs(crossings) > 0)
         return all_crossing_points, len(all_crossing_points)
 
-def findLevels1d(A, level, mode='rising', boxWidth=0):
-    return findLevelsNd(A, level, mode=mode, axis=0, boxWidth=boxWidth)
+def findLevels1d(A, level, mode='rising', boxWidth=0, dtype=None):
+    return findLevelsNd(A, level, mode=mode, axis=0, boxWidth=boxWidth, dtype=dtype)
 
-def findLevelsNd(A, level, mode='rising', axis=0, boxWidth=0):
+def findLevelsNd(A, level, mode='rising', axis=0, boxWidth=0, dtype=None):
     """Function to find level crossings in an Nd numpy array. 
 
     Can find rising and/or falling crossings, control with the 'mode' paramter.
@@ -137,12 +148,13 @@ def findLevelsNd(A, level, mode='rising', axis=0, boxWidth=0):
     :param mode: optional string: mode specfication. one of 'rising', 'falling' or 'both'
     :param axis: optional integer, specifies dimension
     :param boxWidth: optional int for local boxcar smoothing
+    :param dtype: optional dtype to smooth and compare in, defaults to that of A if floating point, else float64
     :returns: binary array of level crossing locations
     """
     assert mode in ('rising', 'falling', 'both'), 'traceManip.findLevels: Unknown mode \'%s\'' % mode
 
     if boxWidth is not 0:
-        A = nd.convolve1d(A, np.array([1]*boxWidth)/float(boxWidth), axis=axis)
+        A = nd.convolve1d(np.asarray(A, dtype=float_dtype(A, dtype)), np.array([1]*boxWidth)/float(boxWidth), axis=axis)
 
     crossings = np.diff(np.sign(A-level), axis=axis)
     
@@ -153,9 +165,167 @@ def findLevelsNd(A, level, mode='rising', axis=0, boxWidth=0):
     else:
         return np.abs(crossings>0)
 
+def findCrossings(A, level, fallingLevel=None, mode='rising', axis=0, minSpacing=0, boxWidth=0,
+                  chunkSize=None, returnDirection=False, dtype=None):
+    """Find level crossings in an Nd numpy array, as a compact table of indices.
+
+    Scans A along axis once, chunkSize samples at a time (A can be a
+    memmap), and returns the crossings as a tuple of index arrays, like
+    np.nonzero(findLevelsNd(A, level)) but without building any arrays the
+    size of A.  The time index is that of the sample just before the
+    crossing, as in findLevelsNd.  The crossings are sorted by trace (in C
+    order of the other axes), then time, so for a time x cells x trials array:
+
+    times, cells, trials = findCrossings(traces, stds * 2.5)
+    counts = np.bincount(cells * nTrials + trials, minlength=nCells * nTrials)
+
+    With fallingLevel, the detection has hysteresis (a Schmitt trigger): a
+    trace only rises once it goes above level, and only falls once it goes
+    below fallingLevel, so noise around a single threshold doesn't give
+    bursts of crossings.  Without it, both are level (a sample exactly at the
+    level keeps the previous state).
+
+    Levels can be a single number, one number per trace (the shape of A
+    without axis) or an explicit wave per trace (the shape of A).
+
+    :param A: Nd numpy array
+    :param level: level to search for in A, and the rising level with hysteresis
+    :param fallingLevel: optional falling level, must not be above level
+    :param mode: optional string: mode specfication. one of 'rising', 'falling' or 'both'
+    :param axis: optional integer, specifies dimension
+    :param minSpacing: drop crossings less than this many samples after the
+                       last crossing kept in the same trace
+    :param boxWidth: optional int for local boxcar smoothing
+    :param chunkSize: number of samples along axis read at a time, defaults
+                      to about 2**22 values per chunk
+    :param returnDirection: also return +1 / -1 for rising / falling crossings
+    :param dtype: optional dtype to smooth and compare in, defaults to that of A if floating point, else float64
+    :returns: tuple of index arrays, one per dimension of A (and the directions)
+    """
+    assert mode in ('rising', 'falling', 'both'), 'traceManip.findCrossings: Unknown mode \'%s\'' % mode
+
+    if not isinstance(A, np.ndarray):
+        A = np.asarray(A)
+    axis = axis % A.ndim
+    A = np.rollaxis(A, axis, 0)
+    n = A.shape[0]
+    rest = A.shape[1:]
+
+    risingLevel = _traceLevel(level, A.ndim, axis)
+    if fallingLevel is None:
+        fallingLevel = risingLevel
+    else:
+        fallingLevel = _traceLevel(fallingLevel, A.ndim, axis)
+        if np.any(fallingLevel > risingLevel):
+            raise ValueError('fallingLevel must not be above level')
+
+    if chunkSize is None:
+        chunkSize = max(1, 2**22 // max(int(np.prod(rest)), 1))
+    dtype = float_dtype(A, dtype)
+
+    # state of each trace: 1 above, 0 below, -1 not known yet
+    state = np.full(rest, -1, dtype=np.int8)
+    found = []
+    for start in range(0, n, chunkSize):
+        stop = min(start + chunkSize, n)
+        chunk = _smoothedChunk(A, start, stop, boxWidth, dtype)
+        up = chunk > _chunkLevel(risingLevel, start, stop, n)
+        down = chunk < _chunkLevel(fallingLevel, start, stop, n)
+
+        marked = up | down
+        if marked.all():
+            current = up.view(np.int8)
+        else:
+            # carry the last state set forward, through samples between the levels
+            last = np.arange(stop - start).reshape((-1,) + (1,) * len(rest))
+            last = np.where(marked, last, -1)
+            np.maximum.accumulate(last, axis=0, out=last)
+            current = np.take_along_axis(up, np.maximum(last, 0), axis=0).view(np.int8)
+            current[last < 0] = np.broadcast_to(state, current.shape)[last < 0]
+
+        previous = np.concatenate([state[np.newaxis], current[:-1]])
+        if mode == 'rising':
+            crossed = (previous == 0) & (current == 1)
+        elif mode == 'falling':
+            crossed = (previous == 1) & (current == 0)
+        else:
+            crossed = (previous >= 0) & (current != previous)
+        indices = np.nonzero(crossed)
+        if len(indices[0]):
+            found.append((indices[0] + start - 1,) + indices[1:] + (current[indices] * 2 - 1,))
+        state = current[-1].copy()
+
+    if found:
+        found = [np.concatenate(column) for column in zip(*found)]
+    else:
+        found = [np.zeros(0, dtype=np.intp)] * (A.ndim + 1)
+    times, others, direction = found[0], found[1:-1], found[-1].astype(np.int8)
+
+    # sort by trace, then time
+    if rest:
+        trace = np.ravel_multi_index(others, rest)
+    else:
+        trace = np.zeros(len(times), dtype=np.intp)
+    order = np.lexsort((times, trace))
+    times, trace, direction = times[order], trace[order], direction[order]
+    others = [o[order] for o in others]
+
+    if minSpacing > 0 and len(times):
+        keep = _spacedCrossings(times, trace, minSpacing)
+        times, direction = times[keep], direction[keep]
+        others = [o[keep] for o in others]
+
+    crossings = tuple(others[:axis]) + (times,) + tuple(others[axis:])
+    if returnDirection:
+        return crossings, direction
+    return crossings
+
+def _traceLevel(level, ndim, axis):
+    """A level as an array that broadcasts against a time-first array"""
+    level = np.asarray(level, dtype='float')
+    if level.ndim == 0:
+        return level
+    if level.ndim == ndim - 1:
+        return level[np.newaxis]
+    if level.ndim == ndim:
+        return np.rollaxis(level, axis, 0)
+    raise ValueError('level must be a number, one per trace or one wave per trace')
+
+def _chunkLevel(level, start, stop, n):
+    if level.ndim and level.shape[0] == n and n > 1:
+        return level[start:stop]
+    return level
+
+def _smoothedChunk(A, start, stop, boxWidth, dtype):
+    """A[start:stop] as floats, boxcar smoothed as if the whole array had been"""
+    if not boxWidth:
+        return np.asarray(A[start:stop], dtype=dtype)
+    lo = max(start - boxWidth, 0)
+    hi = min(stop + boxWidth, A.shape[0])
+    block = np.asarray(A[lo:hi], dtype=dtype)
+    block = nd.convolve1d(block, np.array([1]*boxWidth)/float(boxWidth), axis=0)
+    return block[start - lo:stop - lo]
+
+def _spacedCrossings(times, trace, minSpacing):
+    """Mask of the crossings kept when, in each trace, any crossing less than
+    minSpacing after the last kept one is dropped.  Times are sorted by trace."""
+    first = np.ones(len(times), dtype=bool)
+    first[1:] = trace[1:] != trace[:-1]
+    positions = np.arange(len(times))
+    keep = np.ones(len(times), dtype=bool)
+    # each pass settles at least one more crossing of every run of close crossings
+    while True:
+        lastKept = np.where(keep, positions, -1)
+        lastKept[1:] = np.maximum.accumulate(lastKept)[:-1]
+        lastKept[0] = -1
+        newKeep = first | (times - times[np.maximum(lastKept, 0)] >= minSpacing)
+        if np.array_equal(newKeep, keep):
+            return keep
+        keep = newKeep
+
 # -------------------- SMOOTHING ROUTINES------------------------------------------
 
-def lowess(x, y, f=2./3., iters=3): 
+def lowess(x, y, f=2./3., iters=3, delta=0.0, chunkSize=2**22, dtype=None):
     """Lowess smoother: Robust locally weighted regression. 
     The lowess function fits a nonparametric regression curve to a scatterplot. 
     The arrays x and y contain an equal number of elements; each pair 
@@ -166,375 +336,410 @@ def lowess(x, y, f=2./3., iters=3):
     smoother curve. The number of robustifying iterations is given by iter. The 
     function will run faster with a smaller number of iterations. 
 
-    x and y should be numpy float arrays of equal length.  The return value is 
-    also a numpy float array of that length. 
+    Only the r = ceil(f*n) nearest neighbours of a point have a nonzero
+    weight, and for sorted x they are a contiguous window, so each fit only
+    looks at its window instead of a full n by n weight matrix.  As in
+    statsmodels, delta skips the fit at points within delta of the last
+    fitted point and linearly interpolates them instead; delta = 0.01 *
+    (x.max() - x.min()) is a good choice for long traces.
 
-    :param: x - x values
-    :param: y - y values
+    y can hold many traces (e.g. time by cells by trials), all smoothed
+    against the same x at once.
+
+    :param: x - x values (1d, need not be sorted)
+    :param: y - y values, 1d or Nd with the first axis the same length as x
     :param: f - span (region size to weight for smoothing)
     :param: iters - number of times to apply smoothing
-    :returns: yest - a smoothed version of y
+    :param: delta - distance within which to interpolate instead of fitting
+    :param: chunkSize - maximum number of elements in the temporary window arrays
+    :param: dtype - dtype of the result, defaults to that of y if floating point, else float64.
+            The fits are always done in float64.
+    :returns: yest - a smoothed version of y, same shape as y
     """ 
-    n = len(x) 
-    r = int(np.ceil(f*n)) 
-    h = [np.sort(abs(x-x[i]))[r] for i in range(n)] 
-    w = np.clip(abs(([x]-np.transpose([x]))/h),0.0,1.0) 
-    w = 1-w*w*w 
-    w = w*w*w 
-    yest = np.zeros(n) 
-    delta = np.ones(n) 
-    for iteration in range(iters): 
-        for i in xrange(n): 
-            weights = delta * w[:,i] 
-            weights_mul_x = weights * x 
-            b1 = np.dot(weights,y) 
-            b2 = np.dot(weights_mul_x,y) 
-            A11 = sum(weights) 
-            A12 = sum(weights_mul_x) 
-            A21 = A12 
-            A22 = np.dot(weights_mul_x,x) 
-            determinant = A11*A22 - A12*A21 
-            beta1 = (A22*b1-A12*b2) / determinant 
-            beta2 = (A11*b2-A21*b1) / determinant 
-            yest[i] = beta1 + beta2*x[i] 
-        residuals = y-yest 
-        s = np.median(abs(residuals)) 
-        delta[:] = np.clip(residuals/(6*s),-1,1) 
-        delta[:] = 1-delta*delta 
-        delta[:] = delta*delta 
-    return yest 
-
-def boxcar(A, boxWidth=3, axis=1):
+    dtype = float_dtype(y, dtype)
+    x = np.asarray(x, dtype='float')
+    y = np.asarray(y, dtype='float')
+    n = len(x)
+    shape = y.shape
+    y = y.reshape(n, -1)
+    nTraces = y.shape[1]
+
+    order = np.argsort(x, kind='mergesort')
+    x = x[order]
+    y = y[order]
+
+    r = min(int(np.ceil(f*n)), n-1)
+
+    # the r+1 nearest neighbours of point i are x[lo[i]:lo[i]+r+1].  find lo by
+    # bisection, for all points at once
+    fitPoints = _lowessFitPoints(x, delta)
+    xFit = x[fitPoints]
+    lo = np.clip(fitPoints - r, 0, n-r-1)
+    hi = np.clip(fitPoints, 0, n-r-1)
+    active = lo < hi
+    while np.any(active):
+        mid = (lo + hi) // 2
+        # move right if the point after the window is nearer than its first point
+        tooFarLeft = (xFit - x[mid]) > (x[np.minimum(mid+r+1, n-1)] - xFit)
+        lo = np.where(active & tooFarLeft, mid+1, lo)
+        hi = np.where(active & ~tooFarLeft, mid, hi)
+        active = lo < hi
+    h = np.maximum(xFit - x[lo], x[lo+r] - xFit)
+
+    window = np.arange(r+1)
+    pointsPerChunk = max(1, chunkSize // ((r+1) * nTraces))
+
+    yest = np.zeros((n, nTraces))
+    robustWeights = None
+    for iteration in range(iters):
+        yFit = np.empty((len(fitPoints), nTraces))
+        for start in range(0, len(fitPoints), pointsPerChunk):
+            chunk = slice(start, start+pointsPerChunk)
+            neighbours = lo[chunk, np.newaxis] + window
+            # centred on the fitted point, so yest is the intercept
+            dx = x[neighbours] - xFit[chunk, np.newaxis]
+            w = np.clip(np.abs(dx / h[chunk, np.newaxis]), 0.0, 1.0)
+            w = 1-w*w*w
+            w = w*w*w
+            if robustWeights is None:
+                weights = w[:, :, np.newaxis] * np.ones(nTraces)
+            else:
+                weights = w[:, :, np.newaxis] * robustWeights[neighbours]
+            weights_mul_x = weights * dx[:, :, np.newaxis]
+            yNeighbours = y[neighbours]
+            b1 = (weights * yNeighbours).sum(axis=1)
+            b2 = (weights_mul_x * yNeighbours).sum(axis=1)
+            A11 = weights.sum(axis=1)
+            A12 = weights_mul_x.sum(axis=1)
+            A22 = (weights_mul_x * dx[:, :, np.newaxis]).sum(axis=1)
+            determinant = A11*A22 - A12*A12
+            yFit[chunk] = (A22*b1 - A12*b2) / determinant
+
+        yest = _lowessInterpolate(x, fitPoints, yFit)
+        if iteration < iters-1:
+            residuals = y - yest
+            s = np.median(np.abs(residuals), axis=0)
+            robustWeights = np.clip(residuals/(6*s), -1, 1)
+            robustWeights = 1-robustWeights*robustWeights
+            robustWeights = robustWeights*robustWeights
+
+    result = np.empty(yest.shape, dtype=dtype)
+    result[order] = yest
+    return result.reshape(shape)
+
+def _lowessFitPoints(x, delta):
+    """Indices of sorted x at which lowess fits: every point if delta is 0,
+    else greedily the furthest point within delta of the last one fitted
+    (or the next point, if none is), always including the last point."""
+    n = len(x)
+    if delta <= 0:
+        return np.arange(n)
+    fitPoints = [0]
+    while fitPoints[-1] < n-1:
+        last = fitPoints[-1]
+        furthest = np.searchsorted(x, x[last] + delta, side='right') - 1
+        fitPoints.append(min(max(furthest, last+1), n-1))
+    return np.array(fitPoints)
+
+def _lowessInterpolate(x, fitPoints, yFit):
+    """Linearly interpolate fitted values (fit points by traces) to all of x."""
+    if len(fitPoints) == len(x):
+        return yFit
+    right = np.clip(np.searchsorted(x[fitPoints], x, side='left'), 1, len(fitPoints)-1)
+    left = right - 1
+    x0 = x[fitPoints[left]]
+    x1 = x[fitPoints[right]]
+    t = ((x - x0) / (x1 - x0))[:, np.newaxis]
+    return (1-t) * yFit[left] + t * yFit[right]
+
+def boxcar(A, boxWidth=3, axis=1, dtype=None):
     """Boxcar smoothes a matrix of 1d traces with a boxcar of a specified width.
     Does this by convolving the traces with another flat array.
 
     :param A: a 1d (time) or 2d numpy array (traces by time)
     :param boxWidth: an optional int, specifying the width of the boxcar
+    :param dtype: optional dtype of the result, defaults to that of A if floating point, else float64
     :returns: 2d numpy array, a smoothed version of A.
     """
     if A.ndim is 1:
         axis=0
     
+    A = np.asarray(A, dtype=float_dtype(A, dtype))
     return nd.convolve1d(A, np.array([1]*boxWidth)/float(boxWidth), axis=axis)
 
-def smooth(A, window_len=11, window='hanning', mode = 'same'):
-    """smooth the data (1D numpy array) using a window with requested size.
-    
-    This method is based on the convolution of a scaled window with the signal.
-    The signal is prepared by introducing reflected copies of the signal 
-    (with the window size) in both ends so that transient parts are minimized
-    in the begining and end part of the output signal.
-
-    ripped off from http://www.scipy.org/Cookbook/SignalSmooth
-  
-    :param A: the input signal 
-    
+def smooth(A, window_len=11, window='hanning', mode='mirror', axis=0, method='auto', dtype=None):
+    """Smooth every trace in an Nd array along axis, with a window of the requested size.
+
+    Based on the convolution of a scaled window with the signal, from
+    http://www.scipy.org/Cookbook/SignalSmooth.  The ends are handled by
+    extending the signal as for scipy.ndimage (mode), and the result has the
+    same shape as A.  The default, 'mirror', extends the signal with
+    reflected copies that don't repeat the end points, as the cookbook
+    version did at the start of the signal.  (That version only took 1d
+    arrays, and returned the whole convolution of the padded signal, which
+    is longer than A.)
+
+    Windows are made once and cached.  A time x cells x trials array is
+    smoothed in one call, by one of:
+
+    'direct' - scipy.ndimage.convolve1d
+    'cumsum' - a running sum (scipy.ndimage.uniform_filter1d), O(1) per
+               point whatever the window size, 'flat' windows only
+    'fft'    - an FFT convolution of the padded traces, for wide windows
+    'auto'   - 'cumsum' for 'flat' windows, 'fft' for windows of
+               _fft_smooth_length or more points, else 'direct'
+
+    :param A: Nd numpy array
     :param window_len: the dimension of the smoothing window; should be an odd integer
     :param window: the type of window from 'flat', 'hanning', 'hamming', 'bartlett', 'blackman' flat window will produce a moving average smoothing.
-    :returns: the smoothed signal
-    
-    from np.convolve:
-    
-    mode : {'full', 'valid', 'same'}, optional
-    'full':
-      By default, mode is 'full'.  This returns the convolution
-      at each point of overlap, with an output shape of (N+M-1,). At
-      the end-points of the convolution, the signals do not overlap
-      completely, and boundary effects may be seen.
-
-    'same':
-      Mode `same` returns output of length ``max(M, N)``.  Boundary
-      effects are still visible.
-
-    'valid':
-      Mode `valid` returns output of length
-      ``max(M, N) - min(M, N) + 1``.  The convolution product is only given
-      for points where the signals overlap completely.  Values outside
-      the signal boundary have no effect.
-     
+    :param mode: how the ends are extended, one of 'mirror', 'reflect', 'nearest', 'constant' (zeros) or 'wrap'.
+                 'same' is kept as another name for 'mirror'.
+    :param axis: the axis to smooth along (time)
+    :param method: one of 'auto', 'direct', 'cumsum' or 'fft'
+    :param dtype: optional dtype of the result, defaults to that of A if floating point, else float64
+    :returns: the smoothed array, same shape as A
     """
-
-    if A.ndim != 1:
-        raise ValueError, "smooth only accepts 1 dimension arrays."
-
-    if A.size < window_len:
-        raise ValueError, "Input vector needs to be bigger than window size."
-
-    if window_len<3:
-        return A
-
+    if mode == 'same':
+        mode = 'mirror'
+    if mode not in _pad_modes:
+        raise ValueError, "mode is one of 'mirror', 'reflect', 'nearest', 'constant', 'wrap'"
     if not window in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
         raise ValueError, "Window is one of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'"
+    if method == 'auto':
+        if window == 'flat':
+            method = 'cumsum'
+        elif window_len >= _fft_smooth_length:
+            method = 'fft'
+        else:
+            method = 'direct'
+    if method not in ('direct', 'cumsum', 'fft'):
+        raise ValueError, "method is one of 'auto', 'direct', 'cumsum', 'fft'"
+    if method == 'cumsum' and window != 'flat':
+        raise ValueError, "the cumsum method only makes 'flat' windows"
+
+    A = np.asarray(A, dtype=float_dtype(A, dtype))
+    if window_len<3:
+        return A
 
-    s=np.r_[A[window_len-1:0:-1],A,A[-1:-window_len:-1]]
-    if window == 'flat': #moving average
-        w=np.ones(window_len,'d')
-    else:
-        w=eval('np.'+window+'(window_len)')
-
-    y=np.convolve(w/w.sum(),s,mode=mode)
-    return y
+    if method == 'cumsum':
+        # uniform_filter1d centres even windows one point to the right of convolve1d
+        return nd.uniform_filter1d(A, window_len, axis=axis, mode=mode, origin=-1 if window_len % 2 == 0 else 0)
+
+    kernel = _smoothing_window(window, window_len)
+    if method == 'direct':
+        return nd.convolve1d(A, kernel, axis=axis, mode=mode)
+
+    # pad as convolve1d would, and keep the fully overlapping part of the convolution
+    axis = axis % A.ndim
+    left = (window_len - 1) // 2
+    padding = [(0, 0)] * A.ndim
+    padding[axis] = (left, window_len - 1 - left)
+    padded = np.pad(A, padding, mode=_pad_modes[mode])
+    n = padded.shape[axis]
+    nfft = next_fast_len(n + window_len - 1)
+    kernel = kernel[::-1].reshape([-1 if a == axis else 1 for a in range(A.ndim)])
+    smoothed = np.fft.irfft(np.fft.rfft(padded, nfft, axis=axis) * np.fft.rfft(kernel, nfft, axis=axis),
+                            nfft, axis=axis)
+    index = [slice(None)] * A.ndim
+    index[axis] = slice(window_len - 1, window_len - 1 + A.shape[axis])
+    return smoothed[tuple(index)].astype(A.dtype)
+
+# windows of at least this many points are convolved by FFT in smooth()
+_fft_smooth_length = 192
+
+# scipy.ndimage modes, and the np.pad modes that extend a signal the same way
+_pad_modes = {'mirror': 'reflect', 'reflect': 'symmetric', 'nearest': 'edge', 'constant': 'constant', 'wrap': 'wrap'}
+
+# normalized smoothing windows, by (window, window_len)
+_smoothing_windows = {}
+
+def _smoothing_window(window, window_len):
+    key = (window, window_len)
+    if key not in _smoothing_windows:
+        if window == 'flat': #moving average
+            w = np.ones(window_len, 'd')
+        else:
+            w = getattr(np, window)(window_len)
+        _smoothing_windows[key] = w / w.sum()
+    return _smoothing_windows[key]
 
 # -------------------- Filtering Routines ------------------------------------------
-# from http://code.google.com/p/python-neural-analysis-scripts/source/browse/trunk/scripts/Filtering/Fir.py
+# thin wrappers around the filter bank in filterRoutines
 
-def fir_filter(sig, sampling_freq, critical_freq, kernel_window = 'hamming', taps = 101, kind = 'band', **kwargs):
+def fir_filter(sig, sampling_freq, critical_freq, kernel_window = 'hamming', taps = 101, kind = 'band', axis=-1, dtype=None, **kwargs):
     """This is a wrapper around scipy.signal.lfilter(), which is for finite impulse response filters.
 
-    Build a filter kernel of type <kind> and apply it to the signal
+    Build a filter kernel of type <kind> (cached, see design_filter) and apply it to the signal,
+    compensating for the delay of the kernel.  The ends are zero padded, rather than wrapped around.
     Returns the filtered signal.
 
-    Internally, this uses two private functions, spectral_inversion() and make_fir_filter().
-
-    :param: sig - an n element sequence
+    :param: sig - an n element sequence, or an Nd array filtered along axis
     :param: sampling_freq - rate of data collection (Hz)
     :param: critical_freq - high and low cutoffs for filtering, for bandpass this is a 2 element seq.
     :param: kernel_window - a string from the list - boxcar, triang, blackman,
                              hamming, bartlett, parzen, bohman, blackmanharris, nuttall, barthann
     :param: taps - the number of taps in the kernel (integer)
     :param: kind - the kind of filtering to be performed (one of 'high', 'low', 'band' (default))
+    :param: axis - the time axis (default last)
+    :param: dtype - dtype of the result, defaults to that of sig if floating point, else float64
     :param: **kwargs - keywords passed onto scipy.firwin
     :Returns: filtered signal
     """
+    return filter_traces(sig, sampling_freq, critical_freq, kind=kind, family='fir', taps=taps,
+                         window=kernel_window, axis=axis, zero_phase=True, dtype=dtype, **kwargs)
 
-    kernel = make_fir_filter(sampling_freq, critical_freq, kernel_window, taps, kind, **kwargs) 
-
-    return np.roll(scipy.signal.lfilter(kernel, [1], sig), -taps/2+1)
-
-# used by fir_filter
-def spectral_inversion(kernel):
-    kernel = -kernel
-    kernel[len(kernel)/2] += 1.0
-    return kernel
-
-# used by fir_filter
-def make_fir_filter(sampling_freq, critical_freq, kernel_window, taps, kind, **kwargs):
-    nyquist_freq = sampling_freq/2
-    critical_freq = np.array(critical_freq, dtype = np.float64)
-    normalized_critical_freq = critical_freq/nyquist_freq
-
-    if not taps % 2: #The order must be even for high and bandpass
-        taps += 1
-
-    if kind.lower() in ['low', 'low pass', 'low_pass']:
-        kernel = scipy.signal.firwin(taps, normalized_critical_freq,
-                               window=kernel_window, **kwargs)
-
-    elif kind.lower() in ['high', 'high pass', 'high_pass']:
-        lp_kernel = scipy.signal.firwin(taps, normalized_critical_freq,
-                                  window = kernel_window, **kwargs)
-        kernel = spectral_inversion(lp_kernel)
-          
-    elif kind.lower() in ['band', 'band pass', 'band_pass']:
-        lp_kernel = scipy.signal.firwin(taps, normalized_critical_freq[0],
-                                  window = kernel_window, **kwargs)
-        hp_kernel = scipy.signal.firwin(taps, normalized_critical_freq[1],
-                                  window = kernel_window, **kwargs)
-        hp_kernel = spectral_inversion(hp_kernel)
-        
-        bp_kernel = spectral_inversion(lp_kernel + hp_kernel)
-        kernel = bp_kernel
-    
-    return kernel
-
-def butter_bandpass_filter(data, lowcut, highcut, fs, order=2):
+def butter_bandpass_filter(data, lowcut, highcut, fs, order=2, axis=-1, dtype=None):
     """This is a wrapper for the butter bandpass filter.
 
-    :param: data - 1d numpy array to be filtered
+    :param: data - numpy array to be filtered along axis
     :param: lowcut - low pass frequency, in Hz
     :param: highcut - high pass frequency, in Hz
     :param: fs - sampling frequency, in samples / second (i.e.: 10000)
     :param: order - filter order
+    :param: axis - the time axis (default last)
+    :param: dtype - dtype of the result, defaults to that of data if floating point, else float64
     :returns: filtered data
     """
-    nyq = 0.5 * fs
-    low = lowcut / nyq
-    high = highcut / nyq
-    
-    # butter() and lfilter() are from scipy.signal
-    
-    b, a = butter(order, [low, high], btype='band')
-    y = lfilter(b, a, data)
-    return y
+    return filter_traces(data, fs, (lowcut, highcut), kind='band', family='butter', order=order, axis=axis,
+                         dtype=dtype)
 
-def bessel_bandpass_filter(data, lowcut, highcut, fs, order=2):
+def bessel_bandpass_filter(data, lowcut, highcut, fs, order=2, axis=-1, dtype=None):
     """This is a wrapper for the bessel bandpass filter.
 
-    :param: data - 1d numpy array to be filtered
+    :param: data - numpy array to be filtered along axis
     :param: lowcut - low pass frequency, in Hz
     :param: highcut - high pass frequency, in Hz
     :param: fs - sampling frequency, in samples / second (i.e.: 10000)
     :param: order - filter order
+    :param: axis - the time axis (default last)
+    :param: dtype - dtype of the result, defaults to that of data if floating point, else float64
     :returns: filtered data
     """
-
-    nyq = 0.5 * fs
-    low = lowcut / nyq
-    high = highcut / nyq
-
-    # bessel() and lfilter() are from scipy.signal
-
-    b, a = bessel(order, [low, high], btype='band')
-    y = lfilter(b, a, data)
-    return y
-
-# -------------------- SPECTROGRAM ROUTINES------------------------------------------
-# modified from http://code.google.com/p/python-neural-analysis-scripts/source/browse/trunk/LFP/signal_utils.py
-
-def find_NFFT(frequency_resolution, sampling_frequency, 
-              force_power_of_two=False):
-    #This function returns the NFFT
-    NFFT = (sampling_frequency*1.0)/frequency_resolution-2
-    if force_power_of_two:
-        pow_of_two = 1
-        pot_nfft = 2**pow_of_two
-        while pot_nfft < NFFT:
-            pow_of_two += 1
-            pot_nfft = 2**pow_of_two
-        return pot_nfft
-    else:
-        return NFFT
-        
-def find_frequency_resolution(NFFT, sampling_frequency):
-    return (sampling_frequency*1.0)/(NFFT + 2)
-
-def find_NFFT_and_noverlap(frequency_resolution, sampling_frequency,
-                           time_resolution, num_data_samples):
-    NFFT =  find_NFFT(frequency_resolution, sampling_frequency)
-    
-    # finds the power of two which is just greater than NFFT
-    pow_of_two = 1
-    pot_nfft = 2**pow_of_two
-    noverlap = pot_nfft-sampling_frequency*time_resolution
-    while pot_nfft < NFFT or noverlap < 0:
-        pow_of_two += 1
-        pot_nfft = 2**pow_of_two
-        noverlap = pot_nfft-sampling_frequency*time_resolution
-
-    pot_frequency_resolution = find_frequency_resolution(pot_nfft, 
-                                                         sampling_frequency)
-    
-    return {'NFFT':int(NFFT), 'power_of_two_NFFT':int(pot_nfft), 
-            'noverlap':int(noverlap), 
-            'power_of_two_frequency_resolution':pot_frequency_resolution} 
-
-def resample_signal(signal, prev_sample_rate, new_sample_rate):
-    rate_factor = new_sample_rate/float(prev_sample_rate)
-    return scipy.signal.resample(signal, int(len(signal)*rate_factor))    
-
-def psd(signal, sampling_frequency, frequency_resolution,
-        high_frequency_cutoff=None,  **kwargs):
-    """This function wraps matplotlib.mlab.psd to provide a more intuitive 
-    interface.
-    
-    :param: signal - the input signal (a one dimensional array)
-    :param: sampling_frequency - the sampling frequency of signal (i.e.: 10000)
-    :param: frequency_resolution - the desired frequency resolution of the specgram.
-        this is the guaranteed worst frequency resolution.
-    :param: high_frequency_cutoff - optional high freq. cutoff.  resamples data 
-        to this value and then uses that for Fs parameter
-    :param: **kwargs - Arguments passed on to matplotlib.mlab.psd
-    :returns: - tuple of two numpy arrays, power and freqs
-    """
-    if (high_frequency_cutoff is not None 
-        and high_frequency_cutoff < sampling_frequency):
-        resampled_signal = resample_signal(signal, sampling_frequency, 
-                                                    high_frequency_cutoff)
-    else:
-        high_frequency_cutoff = sampling_frequency
-        resampled_signal = signal
-    num_data_samples = len(resampled_signal)
-    NFFT= find_NFFT(frequency_resolution, high_frequency_cutoff, 
-                    force_power_of_two=True) 
-    
-    return mlab.psd(resampled_signal, NFFT=NFFT, 
-                    Fs=high_frequency_cutoff, 
-                    noverlap=0, **kwargs)
-
-def specgram(signal, sampling_frequency, time_resolution, 
-             frequency_resolution, high_frequency_cutoff=None, 
-             logscale=True, **kwargs):
-    """This function wraps matplotlib.mlab.psd to provide a more intuitive 
-    interface.
-
-    Plot with: 
-        power, freqs, bins = specgram(...)
-        extent = (bins[0], bins[-1], freqs[0], freqs[-1])
-        imshow(power, aspect='auto', origin='lower', extent=extent) # from pyplot
-    
-    :param: signal - the input signal (a one dimensional array)
-    :param: sampling_frequency - the sampling frequency of signal (i.e.: 10000)
-    :param: frequency_resolution - the desired frequency resolution of the specgram.
-        this is the guaranteed worst frequency resolution.
-    :param: time_resolution - the desired frequency resolution of the specgram.
-        this is the guaranteed worst time resolution.
-    :param: high_frequency_cutoff - optional high freq. cutoff.  resamples data 
-        to this value and then uses that for Fs parameter
-    :param: logscale - rescale data based on log values?  defaults is True
-    :param: **kwargs - Arguments passed on to matplotlib.mlab.psd
-
-    :returns: - tuple of three numpy arrays: 
-            power - 2d array of power (dB/Hz)
-            freqs - in Hz
-            bins - in seconds
-    """
-    if (high_frequency_cutoff is not None 
-        and high_frequency_cutoff < sampling_frequency):
-        resampled_signal = resample_signal(signal, sampling_frequency, 
-                                                    high_frequency_cutoff)
-    else:
-        high_frequency_cutoff = sampling_frequency
-        resampled_signal = signal
-    num_data_samples = len(resampled_signal)
-    specgram_settings = find_NFFT_and_noverlap(frequency_resolution, 
-                                               high_frequency_cutoff, 
-                                               time_resolution, 
-                                               num_data_samples)
-    NFFT     = specgram_settings['power_of_two_NFFT']
-    noverlap = specgram_settings['noverlap']
-    power, freqs, bins = mlab.specgram(resampled_signal, 
-                                                NFFT=NFFT, 
-                                                Fs=high_frequency_cutoff, 
-                                                noverlap=noverlap, **kwargs)
-
-    if logscale:
-        power = 10*np.log10(power)
-
-    return power, freqs, bins
+    return filter_traces(data, fs, (lowcut, highcut), kind='band', family='bessel', order=order, axis=axis,
+                         dtype=dtype)
 
 # -------------------- SPLINE FITTING/BASELINE ROUTINES------------------------------------------
 
-def mask_deviations(traces, std_cutoff=2.25, axis=0, iterations=40):
+def mask_deviations(traces, std_cutoff=2.25, axis=0, iterations=40, method='std',
+                    window=None, percentile=8, return_iterations=False):
     """This routine takes a 1, 2, or 3d array and masks large positive deviations from the mean.
     It works by calculating the mean and std of the trace in the given axis, then making a masked
-    numpy array where every value more than std_cutoff*std above the mean is masked.  It iterates
-    a set number of times, but could be altered to take
+    numpy array where every value more than std_cutoff*std above the mean is masked.  The mean and
+    std of the unmasked points are then recomputed and more points masked, until the mask of each
+    trace stops changing (usually after ~5 iterations), or for at most iterations passes.
+
+    The mask is kept as one boolean array, and the statistics as running sums that only the newly
+    masked points are subtracted from.  Traces drop out of the computation as they converge.
 
-    could be altered to mask both negative and postive deviations, and to go till convergence
-    with a tolerance, rather than a fixed number of iterations.
+    Other baselines can be chosen with method:
 
-    :param traces: a 1, 2 or 3d numpy array (traces by time by trial)
+    - 'std': mean + std_cutoff * std, iterated as above (the default)
+    - 'mad': median + std_cutoff * 1.4826 * the median absolute deviation, iterated the same way
+    - 'percentile': deviations from a sliding window percentile baseline (window points long,
+      the given percentile), masked where they exceed std_cutoff * 1.4826 * their MAD.  Not iterated.
+
+    :param traces: a 1, 2 or 3d numpy array (time by traces by trial)
     :param std_cutoff: optional floating point number, used for masking
     :param axis: optional integer, axis over which to calculate mean and std
-    :param interations: times to repeat the masking process
-    :returns: 2d masked numpy array, same size as traces
+    :param interations: maximum number of times to repeat the masking process
+    :param method: optional string, one of 'std', 'mad' or 'percentile'
+    :param window: window length (points) for the 'percentile' method
+    :param percentile: percentile (0-100) of the sliding window baseline for the 'percentile' method
+    :param return_iterations: also return the number of iterations each trace took
+    :returns: masked numpy array, same size as traces (and, if return_iterations, an integer
+              array with one count per trace, the shape of traces without axis)
     """
+    assert method in ('std', 'mad', 'percentile'), 'traces.mask_deviations: Unknown method \'%s\'' % method
+
+    traces = np.asarray(traces)
+    # work on a time by (all other dimensions) array
+    data = np.rollaxis(traces, axis, 0)
+    stats_shape = data.shape[1:]
+    data = data.reshape(data.shape[0], -1)
+
+    if method == 'percentile':
+        if window is None:
+            raise ValueError('mask_deviations needs a window for the percentile method')
+        residuals = data - sliding_baseline(data, window, percentile=percentile)
+        spread = 1.4826 * np.median(np.abs(residuals - np.median(residuals, axis=0)), axis=0)
+        mask = residuals >= std_cutoff * spread
+        counts = np.ones(data.shape[1], dtype='int')
+    else:
+        mask, counts = _iterate_deviation_mask(data, std_cutoff, iterations, method)
 
-    temp_traces = traces.copy()
-
-    cutoffs = temp_traces.mean(axis=axis) + temp_traces.std(axis=axis)*std_cutoff
-    masked_traces = np.ma.masked_array(traces, traces>=cutoffs)
-
-    # could go until some sort of convergence in STD
-    # but light empirical testing shows convergence after ~5 iterations
-    # going with 40 for the default for overkill (still is fast)
-    for i in range(iterations):   
-        cutoffs = masked_traces.mean(axis=axis) + masked_traces.std(axis=axis)*std_cutoff
-        masked_traces = np.ma.masked_array(masked_traces, traces>=cutoffs)
-
+    mask = np.rollaxis(mask.reshape((data.shape[0],) + stats_shape), 0, axis+1)
+    masked_traces = np.ma.masked_array(traces, mask)
+    if return_iterations:
+        return masked_traces, counts.reshape(stats_shape)
     return masked_traces
 
-def baseline_splines(traces, n_control_points, std_cutoff=2.25):
+def _iterate_deviation_mask(data, std_cutoff, iterations, method):
+    """The iterative masking for mask_deviations, on a time by traces array.
+
+    Points are only ever added to the mask, so a trace has converged as soon
+    as a pass adds nothing.  Returns the mask and the number of passes per trace.
+    """
+    num_points, num_traces = data.shape
+    mask = np.zeros(data.shape, dtype=bool)
+    counts = np.zeros(num_traces, dtype='int')
+
+    # the traces still being iterated, and working copies of their columns
+    active = np.arange(num_traces)
+    values = data.astype('float')
+    current = np.zeros(data.shape, dtype=bool)
+    newly = np.empty(data.shape, dtype=bool)
+    scratch = np.empty(data.shape)
+    if method == 'std':
+        sums = values.sum(axis=0)
+        squares = np.einsum('ij,ij->j', values, values)
+        unmasked = np.ones(num_traces) * num_points
+
+    for i in range(iterations + 1):
+        if method == 'std':
+            means = sums / unmasked
+            cutoffs = means + np.sqrt(np.maximum(squares / unmasked - means * means, 0)) * std_cutoff
+        else:
+            remaining = np.where(current, np.nan, values)
+            centers = _nanmedian(remaining)
+            cutoffs = centers + 1.4826 * _nanmedian(np.abs(remaining - centers)) * std_cutoff
+
+        np.greater_equal(values, cutoffs, out=newly)
+        newly &= ~current
+        changed = newly.any(axis=0)
+        counts[active] += 1
+
+        current |= newly
+        if method == 'std':
+            np.multiply(values, newly, out=scratch)
+            sums -= scratch.sum(axis=0)
+            squares -= np.einsum('ij,ij->j', scratch, scratch)
+            unmasked -= newly.sum(axis=0)
+
+        # store and drop the traces that have converged
+        if not changed.all():
+            mask[:, active[~changed]] = current[:, ~changed]
+            active = active[changed]
+            values = values[:, changed]
+            current = current[:, changed]
+            newly = newly[:, changed]
+            scratch = scratch[:, changed]
+            if method == 'std':
+                sums = sums[changed]
+                squares = squares[changed]
+                unmasked = unmasked[changed]
+        if active.size == 0:
+            break
+
+    mask[:, active] = current
+    return mask, counts
+
+def _nanmedian(values):
+    """median over the first axis, ignoring nans (nan where all are nan)"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(values, axis=0)
+
+def baseline_splines(traces, n_control_points, std_cutoff=2.25, dtype=None):
     """This routine takes a 1 or 2d array and fits a spline to the baseline.
     To pick points for the spline fit, the baseline is first calcuated by 
     mask_deviations().  Then, the trace is split into n_control_points-2 
@@ -554,9 +759,15 @@ def baseline_splines(traces, n_control_points, std_cutoff=2.25):
     how 'responsive' the spline is to deviations.  A good starting point
     is 5 control points or so.
 
-    :param traces: a 1 or 2d numpy array (traces by time)
+    All traces and trials are fit at once: the control point means come from
+    cumulative sums over the masked array, and as the knots are the same for
+    every trace, the splines share one basis, so they are fit with a single
+    least squares solve and evaluated with a single matrix product.
+
+    :param traces: a 1, 2 or 3d numpy array (time by traces by trials)
     :param n_control_points: integer for number of control points in spline.
-    :returns: 2d numpy array, same size as traces
+    :param dtype: optional dtype of the result, defaults to that of traces if floating point, else float64
+    :returns: numpy array, same size as traces
     """
 
     # assuming time by traces x trials
@@ -569,45 +780,265 @@ def baseline_splines(traces, n_control_points, std_cutoff=2.25):
     num_traces = traces.shape[1]
     num_trials = traces.shape[2]
 
-    fit_baselines = np.zeros_like(traces)
-    
-    for trial in range(num_trials):
-        masked_traces = mask_deviations(traces[:,:,trial], std_cutoff=std_cutoff)
-
-        for trace in range(num_traces):
-            num_segments = n_control_points - 2
-            edge_size = int(np.ceil(masked_traces.shape[0] * 0.1))
-            if num_segments>0:
-                trace_in_parts = np.array_split(masked_traces[edge_size:-edge_size,trace], n_control_points-2)
-
-                means = [x.mean() for x in trace_in_parts] # could also consider the median point
-
-                segment_length = len(trace_in_parts[0])
-                center_of_first = segment_length / 2 
-                xs = [center_of_first+segment_length*i for i in range(num_segments)]
-            else: # only using endpoints
-                means = []
-                xs = []
-
-            # add the average of the first ten and last ten points to the spline
-            means.insert(0, masked_traces[0:edge_size,trace].mean(axis=0))
-            xs.insert(0,0)
-            means.append(masked_traces[-edge_size:,trace].mean(axis=0))
-            xs.append(num_points)
-
-            # replace all nans with the average of the rest of the control point locations.
-            means = np.array(means)
-            means[np.isnan(means)] = means[np.logical_not(np.isnan(means))].mean()
-
-            # fit spline and generate a baseline
-            if n_control_points<=3:
-                k=1
-            else:
-                k=3
-            tck = splrep(xs,means,k=k)#, w=weights)#,s=20)
-            xnew = np.arange(0,num_points)
-
-            fit_baselines[:,trace,trial] = splev(xnew,tck)
+    # mask every trial of every trace at once (statistics are per trace and trial)
+    masked_traces = mask_deviations(traces, std_cutoff=std_cutoff, axis=0)
+    valid = np.logical_not(np.ma.getmaskarray(masked_traces))
+    values = np.where(valid, masked_traces.data, 0).astype('float')
+
+    # control point ranges: the first edge_size points, the middle split into
+    # n_control_points-2 segments (as np.array_split does), and the last edge_size points
+    num_segments = n_control_points - 2
+    edge_size = int(np.ceil(num_points * 0.1))
+    starts = [0]
+    stops = [edge_size]
+    xs = [0]
+    if num_segments>0:
+        middle = len(range(num_points)[edge_size:-edge_size])
+        sizes = [middle // num_segments + 1] * (middle % num_segments) + \
+                [middle // num_segments] * (num_segments - middle % num_segments)
+        segment_starts = edge_size + np.cumsum([0] + sizes[:-1])
+        starts.extend(segment_starts)
+        stops.extend(segment_starts + sizes)
+
+        segment_length = sizes[0]
+        center_of_first = segment_length / 2 
+        xs.extend([center_of_first+segment_length*i for i in range(num_segments)])
+    starts.append(num_points - edge_size)
+    stops.append(num_points)
+    xs.append(num_points)
+
+    # local means of the unmasked points, for all traces at once
+    values = np.concatenate([np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis=0)])
+    counts = np.concatenate([np.zeros((1,) + valid.shape[1:]), np.cumsum(valid, axis=0)])
+    starts = np.clip(starts, 0, num_points)
+    stops = np.clip(stops, 0, num_points)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = (values[stops] - values[starts]) / (counts[stops] - counts[starts])
+    xs = np.array(xs)
+
+    # replace all nans with the average of the rest of the control point locations.
+    means = means.reshape(len(xs), -1)
+    missing = np.isnan(means)
+    if missing.any():
+        filled = np.where(missing, 0, means).sum(axis=0) / (len(xs) - missing.sum(axis=0))
+        means = np.where(missing, filled, means)
+
+    # the knots only depend on xs, so every trace shares one basis: fit all the
+    # splines with one solve, and evaluate all the baselines with one matmul
+    if n_control_points<=3:
+        k=1
+    else:
+        k=3
+    knots = splrep(xs, np.zeros(len(xs)), k=k)[0]
+    xnew = np.arange(0,num_points)
+    fit_basis = np.empty((len(xs), len(xs)))
+    eval_basis = np.empty((num_points, len(xs)))
+    for i in range(len(xs)):
+        coefficients = np.zeros(len(knots))
+        coefficients[i] = 1
+        fit_basis[:, i] = splev(xs, (knots, coefficients, k))
+        eval_basis[:, i] = splev(xnew, (knots, coefficients, k))
+    coefficients = np.linalg.lstsq(fit_basis, means, rcond=-1)[0]
+
+    fit_baselines = eval_basis.dot(coefficients).reshape(traces.shape).astype(float_dtype(traces, dtype))
 
     return np.squeeze(fit_baselines)
 
+# -------------------- SLIDING BASELINE / DF/F ROUTINES------------------------------------------
+
+def sliding_baseline(traces, window, method='percentile', percentile=8, smooth_window=None,
+                     axis=0, step=1, n_processes=1, dtype=None):
+    """Sliding window baseline (F0) of every trace in a 1, 2 or 3d array.
+
+    method 'percentile' gives the percentile of the window centred on each
+    point (windows are truncated at the ends of the trace, and percentiles
+    are interpolated as by np.percentile).  With step=1 it is exact, and
+    runs a running-percentile structure (a pair of heaps, with lazy
+    deletion) along each trace, so each point costs O(log window) rather
+    than a sort of the window.  Traces are split across n_processes
+    processes.  With step > 1 the percentile is only computed every step
+    points, for all traces at once, and linearly interpolated in between,
+    which is much faster and, for step well below window, nearly identical
+    as the baseline changes slowly.
+
+    method 'min_smoothed' gives the minimum, over the window, of the trace
+    smoothed with a boxcar of smooth_window points (as in Jia et al.,
+    Nat. Protoc. 2011).
+
+    Traces should not contain nans.
+
+    :param traces: a 1, 2 or 3d numpy array (time by traces by trials)
+    :param window: window length in points
+    :param method: optional string, 'percentile' or 'min_smoothed'
+    :param percentile: percentile (0-100) for the 'percentile' method
+    :param smooth_window: boxcar length for the 'min_smoothed' method (default window/10)
+    :param axis: optional integer, the time axis
+    :param step: compute the percentile every step points and interpolate in between
+    :param n_processes: processes for the exact percentile (None for the number of cpus)
+    :param dtype: optional dtype of the result, defaults to that of traces if floating point, else float64
+    :returns: numpy array of baselines, same size as traces
+    """
+    assert method in ('percentile', 'min_smoothed'), 'traces.sliding_baseline: Unknown method \'%s\'' % method
+
+    traces = np.asarray(traces)
+    data = np.rollaxis(traces, axis, 0)
+    shape = data.shape
+    dtype = float_dtype(traces, dtype)
+    data = data.reshape(shape[0], -1).astype(dtype)
+    window = int(window)
+
+    if method == 'min_smoothed':
+        if smooth_window is None:
+            smooth_window = max(1, window // 10)
+        smoothed = nd.uniform_filter1d(data, int(smooth_window), axis=0, mode='nearest')
+        baselines = nd.minimum_filter1d(smoothed, window, axis=0, mode='nearest')
+    elif step > 1:
+        baselines = _stepped_percentile(data, window, percentile, int(step))
+    else:
+        jobs = [(data[:, i], window, percentile) for i in range(data.shape[1])]
+        if n_processes == 1 or len(jobs) < 2:
+            baselines = map(_rolling_percentile_job, jobs)
+        else:
+            pool = mp.Pool(processes=n_processes)
+            chunksize = max(1, len(jobs) // (4 * (n_processes or mp.cpu_count())))
+            try:
+                baselines = pool.map(_rolling_percentile_job, jobs, chunksize=chunksize)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        baselines = np.column_stack(baselines) if baselines else np.empty(data.shape)
+
+    return np.rollaxis(baselines.astype(dtype, copy=False).reshape(shape), 0, axis+1)
+
+def sliding_dff(traces, window, method='percentile', percentile=8, smooth_window=None,
+                axis=0, step=1, n_processes=1, return_baseline=False, dtype=None):
+    """dF/F of every trace, with F0 a sliding window baseline: (F - F0) / F0.
+
+    See sliding_baseline for the parameters.
+
+    :param traces: a 1, 2 or 3d numpy array (time by traces by trials)
+    :param window: window length in points
+    :param return_baseline: also return the baseline
+    :param dtype: optional dtype of the result, defaults to that of traces if floating point, else float64
+    :returns: numpy array of dF/F, same size as traces (and the baseline, if return_baseline)
+    """
+    baseline = sliding_baseline(traces, window, method=method, percentile=percentile,
+                                smooth_window=smooth_window, axis=axis, step=step,
+                                n_processes=n_processes, dtype=dtype)
+    dff = (np.asarray(traces, dtype=baseline.dtype) - baseline) / baseline
+    if return_baseline:
+        return dff, baseline
+    return dff
+
+def _window_bounds(n, window, t):
+    """start and stop of the window centred on t, truncated to [0, n)"""
+    start = t - window // 2
+    return np.maximum(start, 0), np.minimum(start + window, n)
+
+def _stepped_percentile(data, window, percentile, step):
+    """sliding window percentile of the columns of data, computed every step points"""
+    n = data.shape[0]
+    points = np.arange(0, n, step)
+    if points[-1] != n - 1:
+        points = np.append(points, n - 1)
+    starts, stops = _window_bounds(n, window, points)
+    sampled = np.empty((len(points), data.shape[1]))
+    for i, (start, stop) in enumerate(zip(starts, stops)):
+        sampled[i] = np.percentile(data[start:stop], percentile, axis=0)
+    if len(points) == 1:
+        return sampled
+    right = np.clip(np.searchsorted(points, np.arange(n)), 1, len(points) - 1)
+    left = right - 1
+    fraction = (np.arange(n) - points[left]) / (points[right] - points[left]).astype('float')
+    fraction = fraction[:, np.newaxis]
+    return (1 - fraction) * sampled[left] + fraction * sampled[right]
+
+def _rolling_percentile_job(job):
+    """process pool worker for sliding_baseline"""
+    return _rolling_percentile(*job)
+
+def _rolling_percentile(trace, window, percentile):
+    """Exact sliding window percentile of a 1d trace, centred windows truncated
+    at the ends, interpolated as by np.percentile.
+
+    The window is split between a max-heap of its lowest k+1 values and a
+    min-heap of the rest, where k is the rank below the percentile, so the
+    two order statistics to interpolate between are the two heap tops.
+    Points leaving the window are only counted out, and are popped when
+    they reach the top of a heap.
+    """
+    n = len(trace)
+    values = trace.tolist()
+    baseline = np.empty(n)
+    fraction = percentile / 100.
+
+    lower = [] # (-value, index): max-heap of the low side
+    upper = [] # (value, index): min-heap of the high side
+    in_lower = [False] * n
+    n_lower = 0
+    n_upper = 0
+    start = 0
+    stop = 0
+    heappush = heapq.heappush
+    heappop = heapq.heappop
+
+    for t in xrange(n):
+        new_start = max(t - window // 2, 0)
+        new_stop = min(t - window // 2 + window, n)
+
+        # count out the points leaving the window
+        while start < new_start:
+            if in_lower[start]:
+                n_lower -= 1
+            else:
+                n_upper -= 1
+            start += 1
+        while lower and lower[0][1] < start:
+            heappop(lower)
+        while upper and upper[0][1] < start:
+            heappop(upper)
+
+        # add the points entering it
+        while stop < new_stop:
+            value = values[stop]
+            if lower and value <= -lower[0][0]:
+                heappush(lower, (-value, stop))
+                in_lower[stop] = True
+                n_lower += 1
+            else:
+                heappush(upper, (value, stop))
+                n_upper += 1
+            stop += 1
+
+        # rebalance so the low side holds the k+1 smallest values
+        position = fraction * (stop - start - 1)
+        k = int(position)
+        while n_lower > k + 1:
+            value, index = heappop(lower)
+            if index >= start:
+                heappush(upper, (-value, index))
+                in_lower[index] = False
+                n_lower -= 1
+                n_upper += 1
+        while n_lower < k + 1:
+            value, index = heappop(upper)
+            if index >= start:
+                heappush(lower, (-value, index))
+                in_lower[index] = True
+                n_lower += 1
+                n_upper -= 1
+        while lower[0][1] < start:
+            heappop(lower)
+        while upper and upper[0][1] < start:
+            heappop(upper)
+
+        low = -lower[0][0]
+        if position > k:
+            baseline[t] = low + (position - k) * (upper[0][0] - low)
+        else:
+            baseline[t] = low
+
+    return baseline